@@ -14,9 +14,19 @@
 from __future__ import absolute_import
 
 import ast
+import hashlib
+import importlib
+import importlib.util
+import itertools
+import json
+import os
+import random
+import re
+import tempfile
+import time
 
 
-def get_pipeline_driver(module_name, passed_args=None):
+def get_pipeline_driver(module_name, passed_args=None, offline_config=None):
     """Gets the driver for generating your pipeline definition.
 
     Pipeline modules must define a get_pipeline() module-level method.
@@ -24,18 +34,48 @@ def get_pipeline_driver(module_name, passed_args=None):
     Args:
         module_name: The module name of your pipeline.
         passed_args: Optional passed arguments that your pipeline may be templated by.
+        offline_config: Optional path of an offline config (see load_offline_config),
+            or the already loaded dict. It is passed to get_pipeline() as the offline_config keyword, and
+            the pipeline then resolves the role, default bucket and code uploads
+            from it instead of calling AWS.
 
     Returns:
         The SageMaker Workflow pipeline.
     """
-    _imports = __import__(module_name, fromlist=["get_pipeline"])
+    _imports = importlib.import_module(module_name)
     kwargs = convert_struct(passed_args)
+    if isinstance(offline_config, dict):
+        kwargs["offline_config"] = offline_config
+    elif offline_config:
+        kwargs["offline_config"] = load_offline_config(offline_config)
     return _imports.get_pipeline(**kwargs)
 
 
 def convert_struct(str_struct=None):
     return ast.literal_eval(str_struct) if str_struct else {}
 
+
+def with_step_cache(passed_args, step_cache):
+    """Merges a --step-cache value into the kwargs dict string as step_cache.
+
+    Args:
+        passed_args: The kwargs dict string, or None.
+        step_cache: An ISO 8601 duration for every cacheable step (e.g. "P30D"),
+            or comma-separated step=duration pairs (e.g. "preprocess=P30D,train=P7D").
+
+    Returns:
+        The kwargs dict string to pass on to get_pipeline_driver.
+    """
+    if not step_cache:
+        return passed_args
+    kwargs = convert_struct(passed_args)
+    if "=" in step_cache:
+        kwargs["step_cache"] = dict(pair.strip().split("=", 1) for pair in step_cache.split(","))
+    else:
+        kwargs["step_cache"] = step_cache.strip()
+    return repr(kwargs)
+
+
 def get_pipeline_custom_tags(module_name, args, tags):
     """Gets the custom tags for pipeline
 
@@ -43,9 +83,620 @@ def get_pipeline_custom_tags(module_name, args, tags):
         Custom tags to be added to the pipeline
     """
     try:
-        _imports = __import__(module_name, fromlist=["get_pipeline_custom_tags"])
+        _imports = importlib.import_module(module_name)
         kwargs = convert_struct(args)
         return _imports.get_pipeline_custom_tags(tags, kwargs['region'], kwargs['sagemaker_project_arn'])
     except Exception as e:
         print(f"Error getting project tags: {e}")
     return tags
+
+
+def default_cache_dir():
+    """Returns the definition cache directory, honouring PIPELINE_DEFINITION_CACHE_DIR."""
+    return os.environ.get("PIPELINE_DEFINITION_CACHE_DIR") or os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+        "sagemaker-pipelines",
+        "definitions",
+    )
+
+
+def caller_identity(region=None):
+    """Gets the ARN of the AWS identity the pipeline definition is built as.
+
+    The account and role in it decide the default role and bucket a pipeline
+    resolves when they are not passed explicitly.
+
+    Args:
+        region: Optional AWS region of the STS endpoint.
+
+    Returns:
+        The caller ARN, or None when it cannot be fetched.
+    """
+    try:
+        import boto3
+
+        return boto3.client("sts", region_name=region).get_caller_identity()["Arn"]
+    except Exception:  # pylint: disable=W0703
+        return None
+
+
+def definition_cache_key(module_name, passed_args=None, offline_config=None, identity=None):
+    """Gets the content address of a pipeline definition.
+
+    The key hashes every Python source file in the pipeline module's package
+    (pipeline.py, preprocess.py, evaluate.py, ...), the parsed kwargs, the
+    SageMaker SDK version, the AWS profile and region from the environment, the
+    caller identity and the offline config, if any. The module itself is
+    located but not imported.
+
+    Args:
+        module_name: The module name of your pipeline.
+        passed_args: Optional passed arguments that your pipeline may be templated by.
+        offline_config: Optional path of an offline config.
+        identity: The caller ARN from caller_identity; needed unless an offline
+            config fixes the role and bucket.
+
+    Returns:
+        A hex digest identifying the definition.
+    """
+    spec = importlib.util.find_spec(module_name)
+    if spec is None or not spec.origin:
+        raise ImportError(f"No module named {module_name}")
+    package_dir = os.path.dirname(spec.origin)
+    try:
+        from importlib.metadata import version
+
+        sdk_version = version("sagemaker")
+    except ImportError:  # Python < 3.8
+        import pkg_resources
+
+        sdk_version = pkg_resources.get_distribution("sagemaker").version
+    except Exception:  # pylint: disable=W0703
+        sdk_version = None
+
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(package_dir)):
+        if name.endswith(".py"):
+            digest.update(name.encode())
+            with open(os.path.join(package_dir, name), "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    digest.update(
+        json.dumps(
+            {
+                "module": module_name,
+                "kwargs": convert_struct(passed_args),
+                "sagemaker": sdk_version,
+                "profile": os.environ.get("AWS_PROFILE"),
+                "region": os.environ.get("AWS_DEFAULT_REGION") or os.environ.get("AWS_REGION"),
+                "identity": identity,
+                "offline": load_offline_config(offline_config) if offline_config else None,
+            },
+            sort_keys=True,
+            default=str,
+        ).encode()
+    )
+    return digest.hexdigest()
+
+
+class DefinitionCache(object):
+    """A directory of pipeline definitions addressed by ``definition_cache_key``.
+
+    Hits refresh an entry's modification time, and ``put`` evicts the least
+    recently used entries beyond ``max_entries`` and any older than
+    ``max_age_seconds``. Entries are written atomically, so concurrent CLI runs
+    never see partial files.
+
+    Args:
+        cache_dir: The cache directory; created on the first ``put``.
+        max_entries: Optional maximum number of entries kept.
+        max_age_seconds: Optional age after which entries are dropped.
+    """
+
+    suffix = ".json"
+
+    def __init__(self, cache_dir=None, max_entries=None, max_age_seconds=None):
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_seconds
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + self.suffix)
+
+    def _entries(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        paths = [
+            os.path.join(self.cache_dir, name)
+            for name in os.listdir(self.cache_dir)
+            if name.endswith(self.suffix)
+        ]
+        return sorted(paths, key=os.path.getmtime, reverse=True)
+
+    def get(self, key):
+        """Returns the cached definition of ``key``, or None."""
+        path = self._path(key)
+        try:
+            if self.max_age_seconds is not None and time.time() - os.path.getmtime(path) > self.max_age_seconds:
+                return None
+            with open(path) as f:
+                content = f.read()
+            os.utime(path)
+            return content
+        except OSError:
+            return None
+
+    def put(self, key, content):
+        """Stores a definition and evicts entries over the limits."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(content)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def evict(self):
+        """Removes entries beyond ``max_entries`` or older than ``max_age_seconds``.
+
+        Returns:
+            The number of removed entries.
+        """
+        entries = self._entries()
+        stale = entries[self.max_entries:] if self.max_entries is not None else []
+        if self.max_age_seconds is not None:
+            now = time.time()
+            stale += [p for p in entries if now - os.path.getmtime(p) > self.max_age_seconds and p not in stale]
+        for path in stale:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return len(stale)
+
+    def clear(self):
+        """Removes every entry.
+
+        Returns:
+            The number of removed entries.
+        """
+        entries = self._entries()
+        for path in entries:
+            os.remove(path)
+        return len(entries)
+
+
+def load_offline_config(path):
+    """Reads the offline config that stands in for AWS lookups.
+
+    The JSON file holds the execution ``role`` ARN and the ``default_bucket``,
+    and optionally the ``account_id``.
+
+    Args:
+        path: The path of the JSON file.
+
+    Returns:
+        The config dict.
+    """
+    with open(path) as f:
+        config = json.load(f)
+    missing = sorted({"role", "default_bucket"} - set(config))
+    if missing:
+        raise ValueError(f"Offline config {path} is missing {', '.join(missing)}")
+    return config
+
+
+class OfflineSessionMixin(object):
+    """Answers the AWS lookups of a SageMaker session from an offline config.
+
+    The default bucket, the caller identity (and so get_execution_role) and
+    the account id come from the config, and uploads return the S3 URI they
+    would have written without touching S3. Image URIs need no stubbing, the
+    SDK resolves them from the configs bundled with it.
+    """
+
+    offline_config = None
+
+    def default_bucket(self):
+        return self._default_bucket_name_override or self.offline_config["default_bucket"]
+
+    def get_caller_identity_arn(self):
+        return self.offline_config["role"]
+
+    def account_id(self):
+        return self.offline_config.get("account_id", "000000000000")
+
+    def upload_data(self, path, bucket=None, key_prefix="data", extra_args=None):
+        bucket = bucket or self.default_bucket()
+        if os.path.isdir(path):
+            return f"s3://{bucket}/{key_prefix}"
+        return f"s3://{bucket}/{key_prefix}/{os.path.basename(path)}"
+
+    def upload_string_as_file_body(self, body, bucket, key, kms_key=None):
+        return f"s3://{bucket}/{key}"
+
+
+_offline_session_classes = {}
+
+
+def offline_session(session_class, offline_config, **kwargs):
+    """Builds a session_class (a sagemaker Session or PipelineSession) in offline mode.
+
+    Args:
+        session_class: The SageMaker session class to extend with OfflineSessionMixin.
+        offline_config: The dict returned by load_offline_config.
+        **kwargs: Keyword arguments for the session_class constructor.
+
+    Returns:
+        The offline session.
+    """
+    cls = _offline_session_classes.get(session_class)
+    if cls is None:
+        cls = type(f"Offline{session_class.__name__}", (OfflineSessionMixin, session_class), {})
+        _offline_session_classes[session_class] = cls
+    session = cls.__new__(cls)
+    session.offline_config = offline_config
+    session.__init__(**kwargs)
+    return session
+
+
+_job_timestamp = re.compile(r"-\d{4}-\d{2}-\d{2}-\d{2}-\d{2}-\d{2}-\d{3}")
+_code_uri = re.compile(r"^s3://[^/]+/.+/input/code/[^/]+$")
+
+
+def canonical_definition(definition, code_digest=None):
+    """Canonicalizes a pipeline definition JSON for comparisons.
+
+    The SDK names every job with a creation timestamp and uploads its code
+    under it, so two builds of the same pipeline never match byte for byte.
+    Timestamps are masked and, given ``code_digest``, every uploaded code URI
+    is replaced by the digest of the code it points to, so a change to e.g.
+    preprocess.py still shows. Keys are sorted and whitespace is dropped.
+
+    Args:
+        definition: The pipeline definition JSON string.
+        code_digest: Optional function mapping an S3 code URI to a content digest.
+
+    Returns:
+        The canonical JSON string.
+    """
+
+    def canonical(value):
+        if isinstance(value, dict):
+            return {k: canonical(v) for k, v in value.items()}
+        if isinstance(value, list):
+            return [canonical(v) for v in value]
+        if isinstance(value, str):
+            if code_digest is not None and _code_uri.match(value):
+                return f"code:{code_digest(value)}"
+            return _job_timestamp.sub("-<timestamp>", value)
+        return value
+
+    return json.dumps(canonical(json.loads(definition)), sort_keys=True, separators=(",", ":"))
+
+
+def pin_definition(pipeline):
+    """Builds a pipeline's definition once and makes later definition() calls return it.
+
+    Pipeline.upsert builds the definition again, which for steps built from
+    step_args reruns their job functions and code uploads.
+
+    Args:
+        pipeline: The SageMaker Workflow pipeline.
+
+    Returns:
+        The pipeline definition JSON string.
+    """
+    definition = pipeline.definition()
+    pipeline.definition = lambda: definition
+    return definition
+
+
+def definition_digest(definition, code_digest=None):
+    """Returns the SHA-256 of the canonical form of a pipeline definition."""
+    return hashlib.sha256(canonical_definition(definition, code_digest).encode()).hexdigest()
+
+
+def s3_code_digest(s3_client):
+    """Returns a code_digest function that hashes S3 objects, fetching each once."""
+    digests = {}
+
+    def code_digest(uri):
+        if uri not in digests:
+            bucket, key = uri[len("s3://"):].split("/", 1)
+            try:
+                body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+                digests[uri] = hashlib.sha256(body).hexdigest()
+            except Exception:  # pylint: disable=W0703
+                # Code that is gone can never match the local code.
+                digests[uri] = f"missing:{uri}"
+        return digests[uri]
+
+    return code_digest
+
+
+def deployed_definition(sagemaker_client, pipeline_name):
+    """Gets the definition of a deployed pipeline, or None if it does not exist."""
+    try:
+        return sagemaker_client.describe_pipeline(PipelineName=pipeline_name)["PipelineDefinition"]
+    except Exception as e:  # pylint: disable=W0703
+        if "ResourceNotFound" in str(e) or "does not exist" in str(e):
+            return None
+        raise
+
+
+terminal_execution_statuses = ("Succeeded", "Failed", "Stopped")
+
+
+def list_execution_steps(sagemaker_client, execution_arn):
+    """Lists every step of a pipeline execution, following NextToken."""
+    steps, kwargs = [], {"PipelineExecutionArn": execution_arn, "SortOrder": "Ascending"}
+    while True:
+        response = sagemaker_client.list_pipeline_execution_steps(**kwargs)
+        steps.extend(response.get("PipelineExecutionSteps", []))
+        if not response.get("NextToken"):
+            return steps
+        kwargs["NextToken"] = response["NextToken"]
+
+
+def _format_seconds(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    return f"{minutes}m{seconds:02d}s"
+
+
+def watch_execution(
+    sagemaker_client,
+    execution_arn,
+    min_delay=2.0,
+    max_delay=60.0,
+    backoff=1.5,
+    timeout=None,
+    printer=print,
+    sleep=time.sleep,
+    clock=time.monotonic,
+):
+    """Follows a pipeline execution, printing step transitions as they happen.
+
+    Steps are polled every ``min_delay`` seconds while anything changes, and
+    the delay grows by ``backoff`` up to ``max_delay`` while nothing does. The
+    watch ends as soon as the execution reaches a terminal status or any step
+    fails, without waiting for the rest of the execution.
+
+    Args:
+        sagemaker_client: A boto3 SageMaker client.
+        execution_arn: The pipeline execution ARN.
+        min_delay: The poll delay after a change, in seconds.
+        max_delay: The longest poll delay, in seconds.
+        backoff: The factor the delay grows by after a poll without changes.
+        timeout: Optional number of seconds after which to stop watching.
+        printer: The function progress lines are passed to.
+        sleep: The function used to wait between polls.
+        clock: The monotonic clock used for the elapsed time.
+
+    Returns:
+        A dict with the execution ``status`` (or ``StepFailed`` / ``TimedOut``),
+        the ``failed_step`` if any and the last seen ``steps``.
+    """
+    start = clock()
+    seen = {}
+    delay = min_delay
+    while True:
+        status = sagemaker_client.describe_pipeline_execution(PipelineExecutionArn=execution_arn)[
+            "PipelineExecutionStatus"
+        ]
+        steps = list_execution_steps(sagemaker_client, execution_arn)
+        changed = False
+        elapsed = _format_seconds(clock() - start)
+        for step in steps:
+            name, step_status = step["StepName"], step["StepStatus"]
+            if seen.get(name) == step_status:
+                continue
+            changed = True
+            line = f"[{elapsed}] {name}: {seen.get(name, 'Pending')} -> {step_status}"
+            if step.get("EndTime") and step.get("StartTime"):
+                line += f" after {_format_seconds((step['EndTime'] - step['StartTime']).total_seconds())}"
+            if step.get("FailureReason"):
+                line += f" ({step['FailureReason']})"
+            printer(line)
+            seen[name] = step_status
+        result = {"status": status, "failed_step": None, "steps": steps}
+        failed = [step["StepName"] for step in steps if step["StepStatus"] == "Failed"]
+        if failed:
+            result.update(status="StepFailed" if status not in terminal_execution_statuses else status)
+            result["failed_step"] = failed[0]
+            return result
+        if status in terminal_execution_statuses:
+            printer(f"[{elapsed}] Execution {status}.")
+            return result
+        if timeout is not None and clock() - start >= timeout:
+            result["status"] = "TimedOut"
+            return result
+        delay = min_delay if changed else min(max_delay, delay * backoff)
+        sleep(delay)
+
+
+# Start errors after which a sweep waits for running executions to finish before retrying.
+execution_quota_error_codes = ("ResourceLimitExceeded", "ThrottlingException", "Throttling")
+
+
+def load_sweep_spec(path):
+    """Loads a hyperparameter sweep spec from a JSON file.
+
+    A spec has a ``strategy`` of ``grid`` or ``random`` and a ``parameters``
+    dict of pipeline parameter name to either a list of values or, for
+    random searches, a ``{"min": ..., "max": ...}`` range (integers if both
+    bounds are). Random searches also take the number of ``executions`` and
+    an optional ``seed``, e.g.::
+
+        {"strategy": "random", "executions": 8, "seed": 1,
+         "parameters": {"NumRound": [50, 100], "MaxDepth": {"min": 3, "max": 8},
+                        "Eta": {"min": 0.05, "max": 0.3}}}
+    """
+    with open(path) as f:
+        spec = json.load(f)
+    if spec.get("strategy", "grid") not in ("grid", "random") or not spec.get("parameters"):
+        raise ValueError(f"Sweep spec {path} needs a grid or random strategy and parameters")
+    return spec
+
+
+def sweep_variants(spec):
+    """Expands a sweep spec into the pipeline parameters of every execution.
+
+    Returns:
+        A list of dicts of pipeline parameter name to string value.
+    """
+    names = sorted(spec["parameters"])
+    if spec.get("strategy", "grid") == "grid":
+        values = [spec["parameters"][name] for name in names]
+        return [{name: str(value) for name, value in zip(names, combo)} for combo in itertools.product(*values)]
+
+    rng = random.Random(spec.get("seed"))
+
+    def sample(values):
+        if isinstance(values, list):
+            return rng.choice(values)
+        if isinstance(values["min"], int) and isinstance(values["max"], int):
+            return rng.randint(values["min"], values["max"])
+        return round(rng.uniform(values["min"], values["max"]), 6)
+
+    return [{name: str(sample(spec["parameters"][name])) for name in names} for _ in range(spec["executions"])]
+
+
+def _json_path(document, path):
+    for key in path.split("."):
+        document = document[key]
+    return document
+
+
+def execution_metric(
+    sagemaker_client,
+    s3_client,
+    execution_arn,
+    output_name="evaluation",
+    file_name="evaluation.json",
+    json_path="regression_metrics.mse.value",
+):
+    """Reads a metric from the report a processing step of an execution wrote.
+
+    Args:
+        sagemaker_client: A boto3 SageMaker client.
+        s3_client: A boto3 S3 client.
+        execution_arn: The pipeline execution ARN.
+        output_name: The name of the processing output holding the report.
+        file_name: The report file name in that output.
+        json_path: The dotted path of the metric in the report.
+
+    Returns:
+        The metric value, or None if no step wrote the report.
+    """
+    for step in list_execution_steps(sagemaker_client, execution_arn):
+        job = step.get("Metadata", {}).get("ProcessingJob")
+        if not job:
+            continue
+        outputs = sagemaker_client.describe_processing_job(ProcessingJobName=job["Arn"].split("/")[-1])
+        for output in outputs.get("ProcessingOutputConfig", {}).get("Outputs", []):
+            if output["OutputName"] == output_name:
+                bucket, _, prefix = output["S3Output"]["S3Uri"][len("s3://") :].partition("/")
+                key = f"{prefix.rstrip('/')}/{file_name}"
+                report = json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read())
+                return _json_path(report, json_path)
+    return None
+
+
+def run_sweep(
+    sagemaker_client,
+    pipeline_name,
+    variants,
+    max_concurrent=4,
+    collect=None,
+    min_delay=5.0,
+    max_delay=60.0,
+    backoff=1.5,
+    timeout=None,
+    printer=print,
+    sleep=time.sleep,
+    clock=time.monotonic,
+):
+    """Runs one pipeline execution per variant and watches them all from one loop.
+
+    At most ``max_concurrent`` executions run at a time. When starting an
+    execution hits an account quota or throttling error, the variant is put
+    back and the limit drops to the number of executions already running.
+    Polls follow watch_execution: ``min_delay`` after a change, growing by
+    ``backoff`` up to ``max_delay`` while nothing changes.
+
+    Args:
+        sagemaker_client: A boto3 SageMaker client.
+        pipeline_name: The name of the upserted pipeline.
+        variants: A list of dicts of pipeline parameter name to value.
+        max_concurrent: The most executions to run at a time.
+        collect: Optional function of an execution ARN returning its metric,
+            called once the execution succeeded.
+        timeout: Optional number of seconds after which to stop waiting; the
+            executions still running are reported as ``TimedOut``.
+
+    Returns:
+        A list with a dict per variant holding its ``parameters``, execution
+        ``arn``, final ``status`` and ``metric``.
+    """
+    from botocore.exceptions import ClientError
+
+    results = [{"parameters": v, "arn": None, "status": "Pending", "metric": None} for v in variants]
+    pending = list(reversed(results))
+    running = []
+    limit = max(1, max_concurrent)
+    start = clock()
+    delay = min_delay
+    while pending or running:
+        elapsed = _format_seconds(clock() - start)
+        while pending and len(running) < limit:
+            result = pending.pop()
+            try:
+                response = sagemaker_client.start_pipeline_execution(
+                    PipelineName=pipeline_name,
+                    PipelineParameters=[{"Name": k, "Value": str(v)} for k, v in result["parameters"].items()],
+                )
+            except ClientError as e:
+                if e.response.get("Error", {}).get("Code") not in execution_quota_error_codes or not running:
+                    raise
+                pending.append(result)
+                limit = len(running)
+                printer(f"[{elapsed}] Execution quota reached, running at most {limit} at a time")
+                break
+            result.update(arn=response["PipelineExecutionArn"], status="Executing")
+            running.append(result)
+            printer(f"[{elapsed}] Started {result['arn']} with {result['parameters']}")
+        if timeout is not None and clock() - start >= timeout:
+            for result in running + pending:
+                result["status"] = "TimedOut"
+            break
+        sleep(delay)
+        changed = False
+        for result in list(running):
+            status = sagemaker_client.describe_pipeline_execution(PipelineExecutionArn=result["arn"])[
+                "PipelineExecutionStatus"
+            ]
+            if status not in terminal_execution_statuses:
+                continue
+            running.remove(result)
+            result["status"] = status
+            if status == "Succeeded" and collect is not None:
+                result["metric"] = collect(result["arn"])
+            changed = True
+            printer(f"[{_format_seconds(clock() - start)}] {result['arn']} {status}, metric {result['metric']}")
+        delay = min_delay if changed else min(max_delay, delay * backoff)
+    return results
+
+
+def format_sweep_results(results, metric_name="mse"):
+    """Formats sweep results as a table ranked by ascending metric, failures last."""
+    ranked = sorted(results, key=lambda r: (r["metric"] is None, r["metric"] or 0))
+    names = sorted({name for r in results for name in r["parameters"]})
+    rows = [["rank", metric_name, "status"] + names + ["execution"]]
+    for i, r in enumerate(ranked):
+        scored = r["metric"] is not None
+        rows.append(
+            [str(i + 1) if scored else "-", f"{r['metric']:.6g}" if scored else "-", r["status"]]
+            + [r["parameters"].get(name, "") for name in names]
+            + [r["arn"] or "-"]
+        )
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    return "\n".join("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows)
@@ -1,6 +1,7 @@
 """Evaluation script for measuring mean squared error."""
 import json
 import logging
+import os
 import pathlib
 import pickle
 import tarfile
@@ -16,10 +17,130 @@ logger.setLevel(logging.INFO)
 logger.addHandler(logging.StreamHandler())
 
 
+def _protobuf_fields(buf, start, end):
+    """Yields (field number, payload start, payload end) of the length-delimited fields in buf[start:end]."""
+    position = start
+    while position < end:
+        tag, position = _read_varint(buf, position)
+        if tag & 7 != 2:
+            raise ValueError(f"Unexpected protobuf wire type {tag & 7}")
+        length, position = _read_varint(buf, position)
+        yield tag >> 3, position, position + length
+        position += length
+
+
+def _read_varint(buf, position):
+    value = shift = 0
+    while True:
+        byte = int(buf[position])
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+
+def _tensor_span(buf, start, end, field):
+    """Finds the packed doubles of the ``values`` tensor in map field ``field`` of a Record."""
+    for number, entry_start, entry_end in _protobuf_fields(buf, start, end):
+        if number != field:
+            continue
+        for entry_field, value_start, value_end in _protobuf_fields(buf, entry_start, entry_end):
+            if entry_field == 2:
+                for _, tensor_start, tensor_end in _protobuf_fields(buf, value_start, value_end):
+                    for _, values_start, values_end in _protobuf_fields(buf, tensor_start, tensor_end):
+                        return values_start, values_end
+    raise ValueError(f"Record field {field} has no float64 values tensor")
+
+
+def read_recordio_protobuf(path):
+    """Decodes the dense RecordIO-protobuf Records written by preprocess.py.
+
+    All records of a file share one layout, so the first record gives the
+    offsets of the feature and label doubles and the rest are read as a
+    strided numpy view. Files with records of varying layout are rejected.
+
+    Returns:
+        A tuple of the label vector and the feature matrix.
+    """
+    data = np.fromfile(path, dtype=np.uint8)
+    if not len(data):
+        return np.empty(0), np.empty((0, 0))
+    magic, length = np.frombuffer(data[:8].tobytes(), dtype="<u4")
+    width = 8 + int(length) + (-int(length) % 4)
+    headers = data[: len(data) // width * width].reshape(-1, width)[:, :8].copy().view("<u4")
+    if magic != 0xCED7230A or len(data) % width or (headers != [magic, length]).any():
+        raise ValueError(f"{path} does not hold fixed-layout dense RecordIO-protobuf records")
+    features = _tensor_span(data, 8, 8 + length, 1)
+    label = _tensor_span(data, 8, 8 + length, 2)
+    records = data.reshape(-1, width)
+    X = records[:, features[0]:features[1]].copy().view("<f8")
+    y = records[:, label[0]:label[1]].copy().view("<f8")[:, 0]
+    return y, X
+
+
+def read_split_file(path):
+    """Reads one split file written by preprocess.py, detecting its format.
+
+    The format is detected from the file extension: ``.csv`` is parsed as
+    headerless CSV, ``.parquet`` is read with pyarrow, ``.arrow`` is
+    memory-mapped as an Arrow IPC file so its columns are not copied on load,
+    and ``.pbr`` is decoded from RecordIO-wrapped protobuf records.
+
+    Returns:
+        A tuple of the label vector and the feature matrix.
+    """
+    path = pathlib.Path(path)
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, memory_map=True)
+    elif path.suffix == ".arrow":
+        import pyarrow as pa
+
+        table = pa.ipc.open_file(pa.memory_map(str(path), "r")).read_all()
+    elif path.suffix == ".pbr":
+        return read_recordio_protobuf(path)
+    else:
+        df = pd.read_csv(path, header=None)
+        y_test = df.iloc[:, 0].to_numpy()
+        df.drop(df.columns[0], axis=1, inplace=True)
+        return y_test, df.values
+
+    columns = [column.to_numpy() for column in table.combine_chunks().columns]
+    return columns[0], np.column_stack(columns[1:])
+
+
+def read_test_data(test_dir):
+    """Reads the test split written by preprocess.py in whichever format it has.
+
+    Multi-instance preprocessing writes one ``test-part-NNNNN`` file per host;
+    all of them are read and concatenated. ``.libsvm`` parts are loaded
+    together as one sparse matrix so they agree on the number of columns.
+
+    Returns:
+        A tuple of the label vector and the feature matrix.
+    """
+    paths = sorted(p for p in pathlib.Path(test_dir).iterdir() if p.name.startswith("test"))
+    if not paths:
+        raise FileNotFoundError(f"No test split found in {test_dir}")
+    if paths[0].suffix == ".libsvm":
+        from scipy.sparse import vstack
+        from sklearn.datasets import load_svmlight_files
+
+        loaded = load_svmlight_files([str(p) for p in paths], zero_based=True)
+        return np.concatenate(loaded[1::2]), vstack(loaded[0::2]).tocsr()
+    splits = [read_split_file(p) for p in paths]
+    if len(splits) == 1:
+        return splits[0]
+    return np.concatenate([y for y, _ in splits]), np.concatenate([X for _, X in splits])
+
 
 if __name__ == "__main__":
     logger.debug("Starting evaluation.")
-    model_path = "/opt/ml/processing/model/model.tar.gz"
+    # PROCESSING_BASE_DIR stands in for /opt/ml/processing when run outside a container
+    base_dir = os.environ.get("PROCESSING_BASE_DIR", "/opt/ml/processing")
+    model_path = f"{base_dir}/model/model.tar.gz"
     with tarfile.open(model_path) as tar:
         tar.extractall(path=".")
 
@@ -27,13 +148,8 @@ if __name__ == "__main__":
     model = pickle.load(open("xgboost-model", "rb"))
 
     logger.debug("Reading test data.")
-    test_path = "/opt/ml/processing/test/test.csv"
-    df = pd.read_csv(test_path, header=None)
-
-    logger.debug("Reading test data.")
-    y_test = df.iloc[:, 0].to_numpy()
-    df.drop(df.columns[0], axis=1, inplace=True)
-    X_test = xgboost.DMatrix(df.values)
+    y_test, X_test = read_test_data(f"{base_dir}/test")
+    X_test = xgboost.DMatrix(X_test)
 
     logger.info("Performing predictions against test data.")
     predictions = model.predict(X_test)
@@ -50,7 +166,7 @@ if __name__ == "__main__":
         },
     }
 
-    output_dir = "/opt/ml/processing/evaluation"
+    output_dir = f"{base_dir}/evaluation"
     pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
 
     logger.info("Writing out evaluation report with mse: %f", mse)
@@ -8,104 +8,191 @@
 
 Implements a get_pipeline(**kwargs) method.
 """
+import functools
+import hashlib
+import json
 import os
+import threading
+import time
 
-import boto3
-import sagemaker
-import sagemaker.session
 
-from sagemaker.estimator import Estimator
-from sagemaker.inputs import TrainingInput
-from sagemaker.model_metrics import (
-    MetricsSource,
-    ModelMetrics,
-)
-from sagemaker.processing import (
-    ProcessingInput,
-    ProcessingOutput,
-    ScriptProcessor,
-)
-from sagemaker.sklearn.processing import SKLearnProcessor
-from sagemaker.workflow.conditions import ConditionLessThanOrEqualTo
-from sagemaker.workflow.condition_step import (
-    ConditionStep,
-)
-from sagemaker.workflow.functions import (
-    JsonGet,
-)
-from sagemaker.workflow.parameters import (
-    ParameterInteger,
-    ParameterString,
-)
-from sagemaker.workflow.pipeline import Pipeline
-from sagemaker.workflow.properties import PropertyFile
-from sagemaker.workflow.steps import (
-    ProcessingStep,
-    TrainingStep,
-)
-from sagemaker.workflow.model_step import ModelStep
-from sagemaker.model import Model
-from sagemaker.workflow.pipeline_context import PipelineSession
+BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
+# Content types the built-in XGBoost container accepts for each preprocess.py output format.
+TRAINING_CONTENT_TYPES = {
+    "csv": "text/csv",
+    "libsvm": "text/libsvm",
+    "parquet": "application/x-parquet",
+    "recordio-protobuf": "application/x-recordio-protobuf",
+}
+
+# Steps whose cache_config get_pipeline's step_cache sets.
+CACHEABLE_STEPS = ("preprocess", "train", "evaluate")
+
+
+def step_cache_config(step_cache, step):
+    """Gets the cache config of one step.
+
+    Args:
+        step_cache: an ISO 8601 duration (e.g. "P30D") applying to every step
+            in CACHEABLE_STEPS, or a dict of step to duration. Steps without a
+            duration, or None, are not cached.
+        step: one of CACHEABLE_STEPS.
+
+    Returns:
+        a CacheConfig, or None when the step is not cached
+    """
+    expire_after = step_cache.get(step) if isinstance(step_cache, dict) else step_cache
+    if not expire_after:
+        return None
+    from sagemaker.workflow.steps import CacheConfig
+
+    return CacheConfig(enable_caching=True, expire_after=expire_after)
+
+
+def content_addressed_code(sagemaker_session, path, key_prefix):
+    """Uploads a step script under a key derived from its content.
+
+    Processors upload their code under the timestamped job name by default,
+    which changes the step arguments, and so the cache key, on every build.
+
+    Returns:
+        the S3 URI of the script
+    """
+    with open(path, "rb") as f:
+        digest = hashlib.sha256(f.read()).hexdigest()[:16]
+    return sagemaker_session.upload_data(
+        path, bucket=sagemaker_session.default_bucket(), key_prefix=f"{key_prefix}/code/{digest}"
+    )
+
+
+class SessionCache(object):
+    """Process-wide cache of boto3 sessions, clients and SageMaker sessions.
+
+    One boto3 session is kept per region and every client or SageMaker
+    session built from it is cached alongside, so credentials are resolved
+    and service models are loaded once per process. With ``ttl`` set, a
+    region's session and everything built from it are rebuilt once they are
+    ``ttl`` seconds old, which picks up rotated static credentials.
+
+    Args:
+        ttl: optional lifetime of a region's entries, in seconds.
+    """
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._sessions = {}
+        self._entries = {}
+        self._lock = threading.RLock()
+
+    def boto_session(self, region):
+        """Returns the cached boto3 session of ``region``."""
+        with self._lock:
+            created, session = self._sessions.get(region, (None, None))
+            if session is None or (self.ttl is not None and time.monotonic() - created > self.ttl):
+                import boto3
+
+                session = boto3.Session(region_name=region)
+                self._sessions[region] = (time.monotonic(), session)
+                self._entries = {key: value for key, value in self._entries.items() if key[0] != region}
+            return session
+
+    def get(self, region, key, factory):
+        """Returns the entry ``key`` of ``region``, building it with ``factory(boto_session)``."""
+        with self._lock:
+            boto_session = self.boto_session(region)
+            cache_key = (region,) + tuple(key)
+            if cache_key not in self._entries:
+                self._entries[cache_key] = factory(boto_session)
+            return self._entries[cache_key]
+
+    def client(self, region, service_name):
+        """Returns the cached boto3 client of ``service_name`` in ``region``."""
+        return self.get(region, ("client", service_name), lambda session: session.client(service_name))
+
+    def clear(self):
+        """Drops every cached session and client."""
+        with self._lock:
+            self._sessions.clear()
+            self._entries.clear()
+
+
+# Set PIPELINE_SESSION_TTL (seconds) to rebuild sessions, and so re-resolve credentials, periodically.
+session_cache = SessionCache(
+    ttl=float(os.environ["PIPELINE_SESSION_TTL"]) if os.environ.get("PIPELINE_SESSION_TTL") else None
+)
 
-BASE_DIR = os.path.dirname(os.path.realpath(__file__))
 
 def get_sagemaker_client(region):
-     """Gets the sagemaker client.
+    """Gets the sagemaker client.
+
+    Args:
+        region: the aws region to start the session
 
-        Args:
-            region: the aws region to start the session
-            default_bucket: the bucket to use for storing the artifacts
+    Returns:
+        the cached boto3 SageMaker client of the region
+    """
+    return session_cache.client(region, "sagemaker")
+
+
+def _session_class(session_class, offline_config):
+    """Returns a constructor of session_class, offline when offline_config is set."""
+    if not offline_config:
+        return session_class
+    from pipelines._utils import offline_session
 
-        Returns:
-            `sagemaker.session.Session instance
-        """
-     boto_session = boto3.Session(region_name=region)
-     sagemaker_client = boto_session.client("sagemaker")
-     return sagemaker_client
+    return functools.partial(offline_session, session_class, offline_config)
 
 
-def get_session(region, default_bucket):
+def get_session(region, default_bucket, offline_config=None):
     """Gets the sagemaker session based on the region.
 
     Args:
         region: the aws region to start the session
         default_bucket: the bucket to use for storing the artifacts
+        offline_config: optional offline config; the session then answers AWS
+            lookups from it (see pipelines._utils.load_offline_config)
 
     Returns:
         `sagemaker.session.Session instance
     """
 
-    boto_session = boto3.Session(region_name=region)
+    import sagemaker.session
 
-    sagemaker_client = boto_session.client("sagemaker")
-    runtime_client = boto_session.client("sagemaker-runtime")
-    return sagemaker.session.Session(
-        boto_session=boto_session,
-        sagemaker_client=sagemaker_client,
-        sagemaker_runtime_client=runtime_client,
-        default_bucket=default_bucket,
-    )
+    def build(boto_session):
+        return _session_class(sagemaker.session.Session, offline_config)(
+            boto_session=boto_session,
+            sagemaker_client=session_cache.client(region, "sagemaker"),
+            sagemaker_runtime_client=session_cache.client(region, "sagemaker-runtime"),
+            default_bucket=default_bucket,
+        )
+
+    offline_key = json.dumps(offline_config, sort_keys=True) if offline_config else None
+    return session_cache.get(region, ("session", default_bucket, offline_key), build)
 
-def get_pipeline_session(region, default_bucket):
+def get_pipeline_session(region, default_bucket, offline_config=None):
     """Gets the pipeline session based on the region.
 
     Args:
         region: the aws region to start the session
         default_bucket: the bucket to use for storing the artifacts
+        offline_config: optional offline config, as for get_session
 
     Returns:
         PipelineSession instance
     """
 
-    boto_session = boto3.Session(region_name=region)
-    sagemaker_client = boto_session.client("sagemaker")
+    from sagemaker.workflow.pipeline_context import PipelineSession
 
-    return PipelineSession(
-        boto_session=boto_session,
-        sagemaker_client=sagemaker_client,
-        default_bucket=default_bucket,
-    )
+    def build(boto_session):
+        return _session_class(PipelineSession, offline_config)(
+            boto_session=boto_session,
+            sagemaker_client=session_cache.client(region, "sagemaker"),
+            default_bucket=default_bucket,
+        )
+
+    offline_key = json.dumps(offline_config, sort_keys=True) if offline_config else None
+    return session_cache.get(region, ("pipeline_session", default_bucket, offline_key), build)
 
 def get_pipeline_custom_tags(new_tags, region, sagemaker_project_arn=None):
     try:
@@ -133,6 +220,10 @@ def get_pipeline(
     experiment_name=None,
     feature_group_name=None,
     enable_feature_store=True,
+    output_format="csv",
+    training_instance_count=1,
+    step_cache=None,
+    offline_config=None,
 ):
     """Gets a SageMaker ML Pipeline instance working with on abalone data.
 
@@ -143,15 +234,72 @@ def get_pipeline(
         experiment_name: Name of the SageMaker Experiment (optional)
         feature_group_name: Name of the Feature Store Feature Group (optional)
         enable_feature_store: Whether to enable Feature Store integration
+        output_format: the format preprocess.py writes the splits in; one of
+            TRAINING_CONTENT_TYPES. Evaluation detects the format on its own.
+        training_instance_count: the number of training instances. With more
+            than one, every instance gets its own share of the train part-files
+            that the ProcessingInstanceCount preprocessing hosts write.
+        step_cache: optional step caching, see step_cache_config. Cached
+            processing steps run their script from a content-addressed S3
+            key so that unchanged code keeps the same cache key.
+        offline_config: optional offline config dict that stands in for the
+            role, default bucket and code upload AWS calls, so that the
+            definition can be generated without network access.
 
     Returns:
         an instance of a pipeline
     """
-    sagemaker_session = get_session(region, default_bucket)
+    # The SageMaker SDK takes seconds to import; only pay for it when building a pipeline.
+    import sagemaker
+
+    from sagemaker.estimator import Estimator
+    from sagemaker.inputs import TrainingInput
+    from sagemaker.model_metrics import (
+        MetricsSource,
+        ModelMetrics,
+    )
+    from sagemaker.processing import (
+        ProcessingInput,
+        ProcessingOutput,
+        ScriptProcessor,
+    )
+    from sagemaker.sklearn.processing import SKLearnProcessor
+    from sagemaker.workflow.conditions import ConditionLessThanOrEqualTo
+    from sagemaker.workflow.condition_step import (
+        ConditionStep,
+    )
+    from sagemaker.workflow.functions import (
+        JsonGet,
+    )
+    from sagemaker.workflow.parameters import (
+        ParameterInteger,
+        ParameterString,
+    )
+    from sagemaker.workflow.pipeline import Pipeline
+    from sagemaker.workflow.properties import PropertyFile
+    from sagemaker.workflow.steps import (
+        ProcessingStep,
+        TrainingStep,
+    )
+    from sagemaker.workflow.model_step import ModelStep
+    from sagemaker.model import Model
+
+    if output_format not in TRAINING_CONTENT_TYPES:
+        raise ValueError(
+            f"Unsupported output_format {output_format}, expected one of {list(TRAINING_CONTENT_TYPES)}"
+        )
+    training_content_type = TRAINING_CONTENT_TYPES[output_format]
+    if isinstance(step_cache, dict) and set(step_cache) - set(CACHEABLE_STEPS):
+        raise ValueError(
+            f"Unsupported step_cache steps {sorted(set(step_cache) - set(CACHEABLE_STEPS))}, "
+            f"expected some of {list(CACHEABLE_STEPS)}"
+        )
+
+    sagemaker_session = get_session(region, default_bucket, offline_config)
     if role is None:
         role = sagemaker.session.get_execution_role(sagemaker_session)
 
-    pipeline_session = get_pipeline_session(region, default_bucket)
+    pipeline_session = get_pipeline_session(region, default_bucket, offline_config)
 
     # Set up experiment name (default to pipeline name if not provided)
     if experiment_name is None:
@@ -178,6 +326,13 @@ def get_pipeline(
     enable_feature_store_param = ParameterString(
         name="EnableFeatureStore", default_value=str(enable_feature_store)
     )
+    processing_mode = ParameterString(name="ProcessingMode", default_value="in-memory")
+    split_seed = ParameterInteger(name="SplitSeed", default_value=42)
+    stratify_bins = ParameterInteger(name="StratifyBins", default_value=0)
+    feature_store_ingestion = ParameterString(name="FeatureStoreIngestion", default_value="full")
+    # comma-separated abalone input columns identifying a record, required by delta ingestion
+    record_id_columns = ParameterString(name="FeatureStoreRecordIdColumns", default_value="")
+    feature_store_target = ParameterString(name="FeatureStoreTarget", default_value="online")
 
     # processing step for feature engineering
     sklearn_processor = SKLearnProcessor(
@@ -188,24 +343,40 @@ def get_pipeline(
         sagemaker_session=pipeline_session,
         role=role,
     )
+    preprocess_code = os.path.join(BASE_DIR, "preprocess.py")
+    if step_cache_config(step_cache, "preprocess"):
+        preprocess_code = content_addressed_code(sagemaker_session, preprocess_code, base_job_prefix)
     step_args = sklearn_processor.run(
         outputs=[
             ProcessingOutput(output_name="train", source="/opt/ml/processing/train"),
             ProcessingOutput(output_name="validation", source="/opt/ml/processing/validation"),
             ProcessingOutput(output_name="test", source="/opt/ml/processing/test"),
             ProcessingOutput(output_name="features", source="/opt/ml/processing/features"),
+            ProcessingOutput(output_name="transformer", source="/opt/ml/processing/transformer"),
         ],
-        code=os.path.join(BASE_DIR, "preprocess.py"),
+        code=preprocess_code,
         arguments=[
             "--input-data", input_data,
             "--feature-group-name", feature_group_name_param,
             "--enable-feature-store", enable_feature_store_param,
             "--region", region,
+            "--processing-mode", processing_mode,
+            "--output-format", output_format,
+            "--seed", split_seed.to_string(),
+            "--stratify-bins", stratify_bins.to_string(),
+            "--stats-exchange-uri",
+            f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/preprocess-statistics",
+            "--feature-store-ingestion", feature_store_ingestion,
+            "--feature-store-target", feature_store_target,
+            "--record-id-columns", record_id_columns,
+            "--delta-index-uri",
+            f"s3://{sagemaker_session.default_bucket()}/{base_job_prefix}/feature-store-delta-index",
         ],
     )
     step_process = ProcessingStep(
         name="PreprocessAbaloneData",
         step_args=step_args,
+        cache_config=step_cache_config(step_cache, "preprocess"),
     )
 
     # training step for generating model artifacts
@@ -226,11 +397,13 @@ def get_pipeline(
     xgb_train = Estimator(
         image_uri=image_uri,
         instance_type=training_instance_type,
-        instance_count=1,
+        instance_count=training_instance_count,
         output_path=model_path,
         base_job_name=f"{base_job_prefix}/abalone-train",
         sagemaker_session=pipeline_session,
         role=role,
+        # The default profiler rule names carry a timestamp, which would change the cache key.
+        disable_profiler=step_cache_config(step_cache, "train") is not None,
     )
     xgb_train.set_hyperparameters(
         objective="reg:linear",
@@ -248,19 +421,21 @@ def get_pipeline(
                 s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
                     "train"
                 ].S3Output.S3Uri,
-                content_type="text/csv",
+                content_type=training_content_type,
+                distribution="ShardedByS3Key" if training_instance_count > 1 else "FullyReplicated",
             ),
             "validation": TrainingInput(
                 s3_data=step_process.properties.ProcessingOutputConfig.Outputs[
                     "validation"
                 ].S3Output.S3Uri,
-                content_type="text/csv",
+                content_type=training_content_type,
             ),
         },
     )
     step_train = TrainingStep(
         name="TrainAbaloneModel",
         step_args=step_args,
+        cache_config=step_cache_config(step_cache, "train"),
     )
 
     # processing step for evaluation
@@ -273,6 +448,9 @@ def get_pipeline(
         sagemaker_session=pipeline_session,
         role=role,
     )
+    evaluate_code = os.path.join(BASE_DIR, "evaluate.py")
+    if step_cache_config(step_cache, "evaluate"):
+        evaluate_code = content_addressed_code(sagemaker_session, evaluate_code, base_job_prefix)
     step_args = script_eval.run(
         inputs=[
             ProcessingInput(
@@ -289,7 +467,7 @@ def get_pipeline(
         outputs=[
             ProcessingOutput(output_name="evaluation", source="/opt/ml/processing/evaluation"),
         ],
-        code=os.path.join(BASE_DIR, "evaluate.py"),
+        code=evaluate_code,
     )
     evaluation_report = PropertyFile(
         name="AbaloneEvaluationReport",
@@ -300,6 +478,7 @@ def get_pipeline(
         name="EvaluateAbaloneModel",
         step_args=step_args,
         property_files=[evaluation_report],
+        cache_config=step_cache_config(step_cache, "evaluate"),
     )
 
     # register model step that will be conditionally executed
@@ -358,6 +537,12 @@ def get_pipeline(
             input_data,
             feature_group_name_param,
             enable_feature_store_param,
+            processing_mode,
+            split_seed,
+            stratify_bins,
+            feature_store_ingestion,
+            feature_store_target,
+            record_id_columns,
             num_round_param,
             max_depth_param,
             eta_param,
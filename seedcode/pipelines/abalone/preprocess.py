@@ -1,21 +1,27 @@
 """Feature engineers the abalone dataset and optionally writes to Feature Store."""
 import argparse
+import collections
+import functools
+import io
+import json
 import logging
+import multiprocessing
 import os
 import pathlib
+import queue
+import random
 import requests
 import tempfile
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
 from datetime import datetime
+from urllib.parse import urlparse
 
 import boto3
 import numpy as np
 import pandas as pd
-
-from sklearn.compose import ColumnTransformer
-from sklearn.impute import SimpleImputer
-from sklearn.pipeline import Pipeline
-from sklearn.preprocessing import StandardScaler, OneHotEncoder
+from botocore.config import Config
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -55,8 +61,1670 @@ def merge_two_dicts(x, y):
     return z
 
 
-def write_to_feature_store(df, feature_group_name, region, role):
-    """Write processed features to SageMaker Feature Store."""
+numeric_features = [c for c in feature_columns_names if c != "sex"]
+categorical_features = ["sex"]
+missing_category = "missing"
+split_fractions = (0.7, 0.15, 0.15)
+split_names = ("train", "validation", "test")
+
+# Name and FeatureTypeEnum value of every feature in the abalone feature group.
+feature_store_definitions = [
+    ("event_time", "String"),
+    ("record_id", "String"),
+    ("sex", "String"),
+    ("length", "Fractional"),
+    ("diameter", "Fractional"),
+    ("height", "Fractional"),
+    ("whole_weight", "Fractional"),
+    ("shucked_weight", "Fractional"),
+    ("viscera_weight", "Fractional"),
+    ("shell_weight", "Fractional"),
+    ("rings", "Integral"),
+]
+
+
+# Most (value, count) entries kept per numeric column by FeatureStatistics.
+max_value_counts = 4096
+
+
+def compact_value_counts(counts, max_entries=max_value_counts):
+    """Shrinks value counts to at most ``max_entries`` equal-rank centroids.
+
+    Values are sorted and cut into ``max_entries`` groups of about the same
+    total count; each group becomes one entry at its weighted mean value. The
+    rank of any value, and so the median, is off by at most
+    ``total / max_entries`` rows. Counts with fewer entries are returned as is.
+    """
+    if len(counts) <= max_entries:
+        return counts
+    values = np.fromiter(counts.keys(), dtype=np.float64, count=len(counts))
+    n = np.fromiter(counts.values(), dtype=np.float64, count=len(counts))
+    order = np.argsort(values)
+    values, n = values[order], n[order]
+    group = np.floor((np.cumsum(n) - n) * max_entries / n.sum()).astype(np.int64)
+    totals = np.bincount(group, weights=n)
+    sums = np.bincount(group, weights=values * n)
+    keep = totals > 0
+    return dict(zip((sums[keep] / totals[keep]).tolist(), totals[keep].astype(np.int64).tolist()))
+
+
+class FeatureStatistics(object):
+    """Mergeable sufficient statistics for the abalone feature transforms.
+
+    Numeric columns keep the observed count, mean and sum of squared deviations
+    (combined with the Chan et al. parallel update) plus value counts, so the
+    median does not need the rows themselves. The ``sex`` column keeps its
+    category vocabulary and the label its value counts, for stratified splits.
+
+    Value counts are exact up to ``max_value_counts`` distinct values per
+    column and compacted into that many equal-rank centroids beyond (see
+    compact_value_counts), so memory, the transformer artifact and the
+    statistics exchanged between hosts stay bounded by ``max_value_counts``
+    entries per column whatever the number of rows or chunks.
+    """
+
+    def __init__(self):
+        n = len(numeric_features)
+        self.n_rows = 0
+        self.count = np.zeros(n)
+        self.mean = np.zeros(n)
+        self.m2 = np.zeros(n)
+        self.value_counts = [{} for _ in numeric_features]
+        self.categories = set()
+        self.label_counts = {}
+
+    @classmethod
+    def from_frame(cls, df):
+        """Computes the statistics of a single DataFrame chunk."""
+        stats = cls()
+        X = df[numeric_features].to_numpy(dtype=np.float64)
+        missing = np.isnan(X)
+        stats.n_rows = len(X)
+        stats.count = len(X) - missing.sum(axis=0).astype(np.float64)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            stats.mean = np.nansum(X, axis=0) / stats.count
+            # Corrected two-pass variance, the same as StandardScaler uses.
+            temp = X - stats.mean
+            correction = np.nansum(temp, axis=0)
+            stats.m2 = np.nansum(temp ** 2, axis=0) - correction ** 2 / stats.count
+        empty = stats.count == 0
+        stats.mean[empty] = 0.0
+        stats.m2[empty] = 0.0
+        for i in range(X.shape[1]):
+            values, counts = np.unique(X[~missing[:, i], i], return_counts=True)
+            stats.value_counts[i] = compact_value_counts(dict(zip(values.tolist(), counts.tolist())))
+        sex = df["sex"].fillna(missing_category)
+        stats.categories = set(sex.unique().tolist())
+        labels = df[label_column].to_numpy(dtype=np.float64)
+        values, counts = np.unique(labels[~np.isnan(labels)], return_counts=True)
+        stats.label_counts = dict(zip(values.tolist(), counts.tolist()))
+        return stats
+
+    def update(self, df):
+        """Folds a DataFrame chunk into the running statistics."""
+        return self.merge(FeatureStatistics.from_frame(df))
+
+    def merge(self, other):
+        """Merges another set of statistics into this one in place."""
+        count = self.count + other.count
+        with np.errstate(invalid="ignore", divide="ignore"):
+            delta = other.mean - self.mean
+            mean = self.mean + delta * other.count / count
+            m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        # Take the other side verbatim where one side is empty so a single
+        # chunk reproduces the in-memory statistics exactly.
+        self.mean = np.where(self.count == 0, other.mean, np.where(other.count == 0, self.mean, mean))
+        self.m2 = np.where(self.count == 0, other.m2, np.where(other.count == 0, self.m2, m2))
+        self.count = count
+        self.n_rows += other.n_rows
+        for i, (mine, theirs) in enumerate(zip(self.value_counts, other.value_counts)):
+            for value, n in theirs.items():
+                mine[value] = mine.get(value, 0) + n
+            self.value_counts[i] = compact_value_counts(mine)
+        self.categories |= other.categories
+        for value, n in other.label_counts.items():
+            self.label_counts[value] = self.label_counts.get(value, 0) + n
+        return self
+
+    def to_dict(self):
+        """Returns a JSON-serializable representation of the statistics."""
+        return {
+            "n_rows": self.n_rows,
+            "count": self.count.tolist(),
+            "mean": self.mean.tolist(),
+            "m2": self.m2.tolist(),
+            "value_counts": [sorted(counts.items()) for counts in self.value_counts],
+            "categories": sorted(self.categories),
+            "label_counts": sorted(self.label_counts.items()),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        """Rebuilds statistics from the output of ``to_dict``."""
+        stats = cls()
+        stats.n_rows = d["n_rows"]
+        stats.count = np.array(d["count"], dtype=np.float64)
+        stats.mean = np.array(d["mean"], dtype=np.float64)
+        stats.m2 = np.array(d["m2"], dtype=np.float64)
+        stats.value_counts = [{float(v): int(n) for v, n in counts} for counts in d["value_counts"]]
+        stats.categories = set(d["categories"])
+        stats.label_counts = {float(v): int(n) for v, n in d.get("label_counts", [])}
+        return stats
+
+    def medians(self):
+        """Returns the per-column medians of the observed values.
+
+        They are exact while a column has at most ``max_value_counts``
+        distinct values, and within ``count / max_value_counts`` ranks beyond.
+        """
+        medians = np.empty(len(numeric_features))
+        for i, counts in enumerate(self.value_counts):
+            if not counts:
+                raise ValueError(f"Column {numeric_features[i]} has no observed values.")
+            values = np.array(sorted(counts))
+            cumulative = np.cumsum([counts[v] for v in values])
+            total = cumulative[-1]
+            low = values[np.searchsorted(cumulative, (total - 1) // 2, side="right")]
+            high = values[np.searchsorted(cumulative, total // 2, side="right")]
+            medians[i] = (low + high) / 2.0
+        return medians
+
+    def finalize(self):
+        """Returns the fitted (medians, means, scales, categories) parameters.
+
+        Means and scales describe the median-imputed columns, matching a
+        ``SimpleImputer(strategy="median")`` followed by ``StandardScaler``.
+        """
+        medians = self.medians()
+        n_missing = self.n_rows - self.count
+        delta = medians - self.mean
+        means = self.mean + delta * n_missing / self.n_rows
+        m2 = self.m2 + delta ** 2 * self.count * n_missing / self.n_rows
+        scales = np.sqrt(m2 / self.n_rows)
+        scales[scales < 10 * np.finfo(scales.dtype).eps] = 1.0
+        categories = np.array(sorted(self.categories), dtype=object)
+        return medians, means, scales, categories
+
+
+def merge_statistics(a, b):
+    """Returns the statistics of the union of the data behind ``a`` and ``b``.
+
+    Neither argument is modified. Counts, category vocabularies and value counts
+    (and so the medians, up to ``max_value_counts`` distinct values) combine
+    exactly; means and variances combine with the parallel update, exact up to
+    floating point rounding.
+    """
+    return FeatureStatistics.from_dict(a.to_dict()).merge(b)
+
+
+# Version of the transformer artifact layout written by save_transformer.
+transformer_format_version = 1
+
+
+def save_transformer(path, stats, params):
+    """Writes the fitted transformer as a small versioned JSON artifact.
+
+    The artifact holds the applied parameters, for inference, and the
+    sufficient statistics they were derived from, so later runs can merge new
+    data into them instead of refitting from scratch.
+    """
+    medians, means, scales, categories = params
+    artifact = {
+        "format_version": transformer_format_version,
+        "numeric_features": numeric_features,
+        "categorical_features": categorical_features,
+        "label_column": label_column,
+        "params": {
+            "medians": medians.tolist(),
+            "means": means.tolist(),
+            "scales": scales.tolist(),
+            "categories": list(categories),
+        },
+        "statistics": stats.to_dict(),
+    }
+    pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(artifact, f)
+
+
+def load_transformer(path):
+    """Reads an artifact written by ``save_transformer``, locally or from S3.
+
+    Returns:
+        A tuple of the ``FeatureStatistics`` and the fitted parameters.
+    """
+    with open_input(path) as f:
+        artifact = json.loads(f.read().decode("utf-8"))
+    if artifact["format_version"] != transformer_format_version:
+        raise ValueError(f"Unsupported transformer format version {artifact['format_version']}")
+    if artifact["numeric_features"] != numeric_features:
+        raise ValueError("The transformer was fitted on different feature columns.")
+    params = artifact["params"]
+    return FeatureStatistics.from_dict(artifact["statistics"]), (
+        np.array(params["medians"]),
+        np.array(params["means"]),
+        np.array(params["scales"]),
+        np.array(params["categories"], dtype=object),
+    )
+
+
+def fit_in_memory(df):
+    """Fits the transforms on a whole DataFrame exactly as scikit-learn would.
+
+    The medians are exact sample medians of the observed values, not the
+    bounded value counts of ``FeatureStatistics``; the means and scales are
+    reduced over the median-imputed matrix with the same axis-0 sums and
+    corrected two-pass variance as ``StandardScaler``, so the parameters, and
+    the output of ``transform_into``, are bit-identical to the
+    ``SimpleImputer``/``StandardScaler``/``OneHotEncoder`` pipeline.
+
+    Returns:
+        A tuple of the ``FeatureStatistics`` and the fitted parameters.
+
+    Raises:
+        ValueError: if a numeric column has no observed values.
+    """
+    stats = FeatureStatistics.from_frame(df)
+    X = df[numeric_features].to_numpy(dtype=np.float64, copy=True)
+    missing = np.isnan(X)
+    medians = np.empty(len(numeric_features))
+    for i, name in enumerate(numeric_features):
+        observed = X[~missing[:, i], i]
+        if not len(observed):
+            raise ValueError(f"Column {name} has no observed values.")
+        medians[i] = np.median(observed)
+    np.copyto(X, medians, where=missing)
+    n = np.float64(len(X))
+    means = X.sum(axis=0) / n
+    X -= means
+    correction = X.sum(axis=0)
+    X **= 2
+    scales = np.sqrt((X.sum(axis=0) - correction ** 2 / n) / n)
+    scales[scales < 10 * np.finfo(scales.dtype).eps] = 1.0
+    categories = np.array(sorted(stats.categories), dtype=object)
+    return stats, (medians, means, scales, categories)
+
+
+def transform_into(df, params, out=None, dtype=np.float64, include_label=True):
+    """Fused median-impute, standardize and one-hot kernel for the abalone columns.
+
+    Every numeric column is read once and written straight into its slot of
+    ``out``; missing values get the precomputed scaled median, and ``sex`` is
+    one-hot encoded by scattering ones at its category codes. No intermediate
+    feature matrix or sparse block is built. Unseen categories encode as all
+    zeros. Needs only NumPy and pandas, so inference code can reuse it with the
+    parameters from ``load_transformer``.
+
+    Args:
+        df: the DataFrame of features, and the label if ``include_label``.
+        params: the fitted (medians, means, scales, categories).
+        out: optional preallocated ``(len(df), width)`` array to write into.
+        dtype: the dtype of the allocated output when ``out`` is None. The
+            arithmetic always runs in float64; float32 output is rounded once.
+        include_label: whether to write the label into the first column.
+
+    Returns:
+        The output array: the label (optionally), the scaled numeric features
+        and the one-hot encoded ``sex`` columns.
+    """
+    medians, means, scales, categories = params
+    offset = 1 if include_label else 0
+    width = offset + len(numeric_features) + len(categories)
+    if out is None:
+        out = np.empty((len(df), width), dtype=dtype)
+    elif out.shape != (len(df), width):
+        raise ValueError(f"Expected an output of shape {(len(df), width)}, got {out.shape}")
+
+    if include_label:
+        out[:, 0] = df[label_column].to_numpy(dtype=np.float64)
+    buffer = None if out.dtype == np.float64 else np.empty(len(df), dtype=np.float64)
+    for j, column in enumerate(numeric_features):
+        x = df[column].to_numpy(dtype=np.float64)
+        target = out[:, offset + j] if buffer is None else buffer
+        np.subtract(x, means[j], out=target)
+        np.divide(target, scales[j], out=target)
+        missing = np.isnan(x)
+        if missing.any():
+            target[missing] = (medians[j] - means[j]) / scales[j]
+        if buffer is not None:
+            out[:, offset + j] = buffer
+
+    onehot = out[:, offset + len(numeric_features):]
+    onehot[...] = 0
+    codes = pd.Categorical(df["sex"].fillna(missing_category), categories=categories).codes
+    known = codes >= 0
+    onehot[np.flatnonzero(known), codes[known]] = 1
+    return out
+
+
+def transform_features(df, params):
+    """Applies the fitted transforms to features only, e.g. at inference time."""
+    return transform_into(df, params, include_label=False)
+
+
+def transform_chunk(df, params):
+    """Applies the fitted transforms to a chunk that includes the label.
+
+    Returns a dense array with the label in the first column, followed by the
+    scaled numeric features and the one-hot encoded ``sex`` columns.
+    """
+    return transform_into(df, params)
+
+
+class S3RangeReader(io.RawIOBase):
+    """Read-only file object over an S3 object fetched with ranged GETs.
+
+    Up to ``prefetch`` ranges of ``range_size`` bytes are requested ahead of the
+    reader on a thread pool, so the parser consumes the first bytes while later
+    ranges are still in flight and nothing is staged on local disk. Every range
+    is pinned to the ETag seen when the reader was opened. Reading begins at
+    byte ``start``.
+    """
+
+    def __init__(
+        self, client, bucket, key, range_size=8 * 1024 * 1024, prefetch=4, max_attempts=3, start=0
+    ):
+        super().__init__()
+        head = client.head_object(Bucket=bucket, Key=key)
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = head["ContentLength"]
+        self.etag = head["ETag"]
+        self.range_size = range_size
+        self.prefetch = prefetch
+        self.max_attempts = max_attempts
+        self._executor = ThreadPoolExecutor(max_workers=prefetch)
+        self._pending = collections.deque()
+        self._next_offset = start
+        self._buffer = memoryview(b"")
+
+    def readable(self):
+        return True
+
+    def _fetch(self, start, end):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                response = self.client.get_object(
+                    Bucket=self.bucket,
+                    Key=self.key,
+                    Range=f"bytes={start}-{end - 1}",
+                    IfMatch=self.etag,
+                )
+                return response["Body"].read()
+            except Exception as e:
+                if attempt == self.max_attempts or "PreconditionFailed" in str(e):
+                    raise
+                logger.warning("Retrying range %d-%d of %s: %s", start, end - 1, self.key, e)
+
+    def _schedule(self):
+        while len(self._pending) < self.prefetch and self._next_offset < self.size:
+            end = min(self._next_offset + self.range_size, self.size)
+            self._pending.append(self._executor.submit(self._fetch, self._next_offset, end))
+            self._next_offset = end
+
+    def readinto(self, b):
+        if not self._buffer:
+            self._schedule()
+            if not self._pending:
+                return 0
+            self._buffer = memoryview(self._pending.popleft().result())
+            self._schedule()
+        n = min(len(b), len(self._buffer))
+        b[:n] = self._buffer[:n]
+        self._buffer = self._buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pending.clear()
+            self._executor.shutdown(wait=True)
+        super().close()
+
+
+def parse_s3_uri(uri):
+    """Splits an ``s3://bucket/key`` URI into its bucket and key."""
+    parsed = urlparse(uri)
+    return parsed.netloc, parsed.path.lstrip("/")
+
+
+class LineAlignedRange(io.RawIOBase):
+    """Restricts a binary stream to the lines that start inside ``[start, end)``.
+
+    ``stream`` must be positioned at ``max(start - 1, 0)``. The partial line
+    straddling ``start`` is skipped and the line straddling ``end`` is read to
+    its end, so adjacent ranges cover every line exactly once.
+    """
+
+    def __init__(self, stream, start, end):
+        super().__init__()
+        self._stream = stream
+        self._remaining = end - start
+        self._pending = memoryview(b"")
+        self._last = b"\n"
+        self._done = False
+        if start > 0:
+            self._remaining -= len(self._stream.readline()) - 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self._pending and not self._done:
+            if self._remaining > 0:
+                data = self._stream.read(self._remaining)
+                self._remaining -= len(data)
+                if not data:
+                    self._done = True
+            else:
+                # Finish the line that started inside the range, if any.
+                data = b"" if self._last == b"\n" else self._stream.readline()
+                self._done = True
+            if data:
+                self._last = data[-1:]
+            self._pending = memoryview(data)
+        n = min(len(b), len(self._pending))
+        b[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._stream.close()
+        super().close()
+
+
+def s3_client(max_pool_connections=10):
+    """Builds an S3 client with room for ``max_pool_connections`` concurrent requests.
+
+    Clients are safe to share between threads, but creating them from boto3's
+    default session is not, so threads are handed a client built up front.
+    """
+    return boto3.client("s3", config=Config(max_pool_connections=max(10, max_pool_connections)))
+
+
+def open_input(input_data, range_size=8 * 1024 * 1024, prefetch=4, start=0, end=None, client=None):
+    """Opens the input as a binary stream.
+
+    S3 URIs are streamed with ``S3RangeReader``, anything else is treated as a
+    local path. When ``end`` is set only the lines starting in ``[start, end)``
+    are returned. ``client`` is the S3 client to use; one is created when
+    omitted.
+    """
+    offset = max(start - 1, 0) if end is not None else 0
+    if not input_data.startswith("s3://"):
+        stream = open(input_data, "rb")
+        stream.seek(offset)
+    else:
+        bucket, key = parse_s3_uri(input_data)
+        logger.info("Streaming data from bucket: %s, key: %s", bucket, key)
+        if client is None:
+            client = s3_client(prefetch)
+        reader = S3RangeReader(
+            client, bucket, key, range_size=range_size, prefetch=prefetch, start=offset
+        )
+        stream = io.BufferedReader(reader, buffer_size=range_size)
+    if end is None:
+        return stream
+    return io.BufferedReader(LineAlignedRange(stream, start, end), buffer_size=range_size)
+
+
+def read_input(input_data, chunk_size=None, **reader_options):
+    """Parses the headerless abalone CSV while it streams in.
+
+    Returns the whole DataFrame, or a generator of DataFrame chunks when
+    ``chunk_size`` is set.
+    """
+    if chunk_size is not None:
+        return _read_input_chunks(input_data, chunk_size, **reader_options)
+    with open_input(input_data, **reader_options) as f:
+        return pd.read_csv(f, **_csv_options())
+
+
+def _read_input_chunks(input_data, chunk_size, **reader_options):
+    with open_input(input_data, **reader_options) as f:
+        reader = pd.read_csv(f, chunksize=chunk_size, **_csv_options())
+        try:
+            for chunk in reader:
+                yield chunk
+        finally:
+            reader.close()
+
+
+def _csv_options():
+    return dict(
+        header=None,
+        names=feature_columns_names + [label_column],
+        dtype=merge_two_dicts(feature_columns_dtype, label_column_dtype),
+    )
+
+
+# A part file, or the [start, end) byte range of one when ``end`` is set.
+InputPart = collections.namedtuple("InputPart", ["uri", "size", "start", "end"])
+
+# This host's position among the instances of the processing job.
+Shard = collections.namedtuple("Shard", ["index", "count", "job_name"])
+single_host = Shard(0, 1, None)
+
+
+def list_input_parts(input_data):
+    """Resolves the input into the part files to read.
+
+    Accepts a single object or file, an S3 prefix or local directory holding
+    part-files, or a ``.manifest`` file in the SageMaker ``ManifestFile``
+    format (a JSON list whose first entry is ``{"prefix": ...}`` followed by
+    keys relative to it).
+
+    Returns:
+        A list of ``InputPart`` in key order; ``size`` is None when unknown.
+    """
+    if input_data.endswith(".manifest"):
+        with open_input(input_data) as f:
+            manifest = json.loads(f.read().decode("utf-8"))
+        prefix = manifest[0]["prefix"]
+        return [InputPart(prefix + key, None, 0, None) for key in manifest[1:]]
+
+    if not input_data.startswith("s3://"):
+        if os.path.isdir(input_data):
+            names = sorted(n for n in os.listdir(input_data) if not n.startswith((".", "_")))
+            paths = [os.path.join(input_data, n) for n in names]
+            return [InputPart(p, os.path.getsize(p), 0, None) for p in paths if os.path.isfile(p)]
+        return [InputPart(input_data, os.path.getsize(input_data), 0, None)]
+
+    bucket, key = parse_s3_uri(input_data)
+    client = boto3.client("s3")
+    paginator = client.get_paginator("list_objects_v2")
+    prefix = key if not key or key.endswith("/") else key + "/"
+    parts = []
+    for page in paginator.paginate(Bucket=bucket, Prefix=key):
+        for obj in page.get("Contents", []):
+            if obj["Key"] == key:
+                return [InputPart(input_data, obj["Size"], 0, None)]
+            name = obj["Key"][len(prefix):]
+            if obj["Key"].startswith(prefix) and obj["Size"] > 0 and not name.startswith((".", "_")):
+                parts.append(InputPart(f"s3://{bucket}/{obj['Key']}", obj["Size"], 0, None))
+    if not parts:
+        raise ValueError(f"No input objects found at {input_data}")
+    return parts
+
+
+def current_shard(config_dir="/opt/ml/config"):
+    """Reads this host's ``Shard`` from the processing job's resource config.
+
+    Hosts are ordered by name, so every instance derives the same numbering.
+    Outside of a processing job this returns ``single_host``.
+    """
+    try:
+        with open(f"{config_dir}/resourceconfig.json") as f:
+            resource_config = json.load(f)
+    except (IOError, ValueError):
+        return single_host
+    job_name = None
+    try:
+        with open(f"{config_dir}/processingjobconfig.json") as f:
+            job_name = json.load(f)["ProcessingJobName"]
+    except (IOError, ValueError, KeyError):
+        pass
+    hosts = sorted(resource_config["hosts"])
+    return Shard(hosts.index(resource_config["current_host"]), len(hosts), job_name)
+
+
+def shard_input_parts(parts, shard):
+    """Selects the slice of the input parts this host processes.
+
+    With at least as many parts as hosts, whole parts are dealt round robin.
+    Otherwise every part is cut into one line-aligned byte range per host.
+    """
+    if shard.count == 1:
+        return parts
+    if len(parts) >= shard.count:
+        return parts[shard.index::shard.count]
+    sliced = []
+    for part in parts:
+        size = part.size if part.size is not None else _input_size(part.uri)
+        start = size * shard.index // shard.count
+        end = size * (shard.index + 1) // shard.count
+        sliced.append(InputPart(part.uri, size, start, end))
+    return sliced
+
+
+def _input_size(uri, client=None):
+    if not uri.startswith("s3://"):
+        return os.path.getsize(uri)
+    bucket, key = parse_s3_uri(uri)
+    return (client or boto3.client("s3")).head_object(Bucket=bucket, Key=key)["ContentLength"]
+
+
+_END_OF_PART = object()
+
+
+def _put(q, item, stop):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def _read_part(part, chunk_size, reader_options, q, stop):
+    try:
+        start = time.time()
+        if part.end is not None:
+            size = part.end - part.start
+        else:
+            size = part.size if part.size is not None else _input_size(part.uri, reader_options.get("client"))
+        rows = 0
+        options = merge_two_dicts(reader_options, dict(start=part.start, end=part.end))
+        if chunk_size is None:
+            frames = [read_input(part.uri, **options)]
+        else:
+            frames = read_input(part.uri, chunk_size, **options)
+        for frame in frames:
+            rows += len(frame)
+            if not _put(q, frame, stop):
+                return
+        elapsed = max(time.time() - start, 1e-9)
+        logger.info(
+            "Read part %s: %d rows, %.1f MB in %.2fs (%.1f MB/s).",
+            part.uri, rows, size / 1e6, elapsed, size / 1e6 / elapsed,
+        )
+        _put(q, (_END_OF_PART, size), stop)
+    except Exception as e:  # pylint: disable=W0703
+        _put(q, e, stop)
+
+
+def iter_input_frames(parts, chunk_size=None, max_workers=4, **reader_options):
+    """Yields the DataFrames of all parts, in part order, as they are parsed.
+
+    Up to ``max_workers`` parts are downloaded and parsed concurrently on a
+    bounded thread pool. Each part hands its frames over through a small queue,
+    so at most ``max_workers * 2`` chunks are buffered ahead of the consumer.
+    Frames are re-indexed to stay unique across parts.
+
+    Args:
+        parts: the ``InputPart`` list from ``list_input_parts``.
+        chunk_size: rows per frame, or None to yield one frame per part.
+        max_workers: the number of parts fetched concurrently.
+        reader_options: keyword arguments for ``open_input``.
+    """
+    if "client" not in reader_options and any(part.uri.startswith("s3://") for part in parts):
+        # One client for all download threads, built before any of them starts.
+        reader_options = merge_two_dicts(
+            reader_options, dict(client=s3_client(max_workers * reader_options.get("prefetch", 4)))
+        )
+    stop = threading.Event()
+    remaining = iter(parts)
+    pending = collections.deque()
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def submit_next():
+        part = next(remaining, None)
+        if part is not None:
+            q = queue.Queue(maxsize=2)
+            executor.submit(_read_part, part, chunk_size, reader_options, q, stop)
+            pending.append(q)
+
+    start = time.time()
+    total_bytes = total_rows = 0
+    try:
+        for _ in range(max_workers):
+            submit_next()
+        while pending:
+            item = pending[0].get()
+            if isinstance(item, tuple) and item[0] is _END_OF_PART:
+                total_bytes += item[1]
+                pending.popleft()
+                submit_next()
+                continue
+            if isinstance(item, Exception):
+                raise item
+            item.index = pd.RangeIndex(total_rows, total_rows + len(item))
+            total_rows += len(item)
+            yield item
+    finally:
+        stop.set()
+        executor.shutdown(wait=True)
+    elapsed = max(time.time() - start, 1e-9)
+    logger.info(
+        "Read %d parts: %d rows, %.1f MB in %.2fs (%.1f MB/s).",
+        len(parts), total_rows, total_bytes / 1e6, elapsed, total_bytes / 1e6 / elapsed,
+    )
+
+
+def exchange_statistics(stats, shard, exchange_uri, timeout=3600, poll_interval=5):
+    """Merges the statistics of every host of a multi-instance processing job.
+
+    Each host uploads its partial statistics under ``exchange_uri``, namespaced
+    by the processing job name, waits until every host has done the same and
+    merges all of them in host order, so every host ends up with identical
+    fitted parameters.
+
+    Returns:
+        The merged ``FeatureStatistics``; ``stats`` itself on a single host.
+    """
+    if shard.count == 1:
+        return stats
+    if not exchange_uri:
+        raise ValueError("--stats-exchange-uri is required when running on more than one instance.")
+    bucket, prefix = parse_s3_uri(f"{exchange_uri.rstrip('/')}/{shard.job_name or 'default'}")
+    keys = [f"{prefix}/stats-{i:05d}.json" for i in range(shard.count)]
+    client = boto3.client("s3")
+    client.put_object(Bucket=bucket, Key=keys[shard.index], Body=json.dumps(stats.to_dict()))
+
+    start = time.time()
+    while True:
+        paginator = client.get_paginator("list_objects_v2")
+        present = {
+            obj["Key"]
+            for page in paginator.paginate(Bucket=bucket, Prefix=prefix + "/")
+            for obj in page.get("Contents", [])
+        }
+        if present.issuperset(keys):
+            break
+        if time.time() - start > timeout:
+            raise TimeoutError(f"Only {len(present)} of {shard.count} hosts published statistics.")
+        time.sleep(poll_interval)
+    logger.info("Collected statistics from %d hosts in %.1fs.", shard.count, time.time() - start)
+
+    merged = FeatureStatistics()
+    for key in keys:
+        body = client.get_object(Bucket=bucket, Key=key)["Body"].read()
+        merged.merge(FeatureStatistics.from_dict(json.loads(body)))
+    return merged
+
+
+def stratum_edges(label_counts, n_bins):
+    """Returns label bin edges that cut the labels into ``n_bins`` strata.
+
+    The edges are quantiles of the label distribution given as value counts,
+    so the in-memory and streaming modes bin identically. Ties can merge bins.
+    """
+    if n_bins <= 1 or not label_counts:
+        return np.array([])
+    values = np.array(sorted(label_counts))
+    cumulative = np.cumsum([label_counts[v] for v in values])
+    quantiles = np.arange(1, n_bins) / n_bins * cumulative[-1]
+    return np.unique(values[np.searchsorted(cumulative, quantiles, side="left")])
+
+
+def assign_strata(df, edges):
+    """Returns the stratum of every row, binning ``rings`` at ``edges``."""
+    return np.searchsorted(edges, df[label_column].to_numpy(dtype=np.float64), side="right")
+
+
+def split_indices(strata, seed=None):
+    """Splits row positions into train, validation and test index arrays.
+
+    Rows are shuffled by a seeded permutation, within each stratum when
+    ``strata`` has more than one value, and cut at the 70% and 85% marks. Only
+    the index arrays are permuted; the indices of each split come back sorted
+    so that gathering the rows walks the input front to back.
+    """
+    rng = np.random.RandomState(seed)
+    splits = [[] for _ in split_names]
+    for stratum in np.unique(strata):
+        index = rng.permutation(np.flatnonzero(strata == stratum))
+        cuts = (np.cumsum(split_fractions)[:-1] * len(index)).astype(int)
+        for split, part in zip(splits, np.split(index, cuts)):
+            split.append(part)
+    return [np.sort(np.concatenate(split)) for split in splits]
+
+
+class SplitAssigner(object):
+    """Deterministically deals streamed rows into train, validation and test.
+
+    Every stratum draws from its own sequence of seeded shuffles of a 20-slot
+    block holding 14 train, 3 validation and 3 test slots, so each stratum is
+    split 70/15/15 to within one block regardless of chunking.
+    """
+
+    block = np.repeat(np.arange(len(split_names)), (np.array(split_fractions) * 20).round().astype(int))
+
+    def __init__(self, seed=None):
+        self.rng = np.random.RandomState(seed)
+        self._slots = {}
+
+    def assign(self, strata):
+        """Returns the split id (0, 1 or 2) of every row given its stratum."""
+        assignment = np.empty(len(strata), dtype=np.intp)
+        for stratum in np.unique(strata):
+            rows = np.flatnonzero(strata == stratum)
+            slots = self._slots.get(stratum, self.block[:0])
+            while len(slots) < len(rows):
+                blocks = [self.rng.permutation(self.block) for _ in range(len(rows) // len(self.block) + 1)]
+                slots = np.concatenate([slots] + blocks)
+            assignment[rows] = slots[:len(rows)]
+            self._slots[stratum] = slots[len(rows):]
+        return assignment
+
+
+def output_stem(base_dir, name, shard=single_host):
+    """Returns the output path, without extension, of a split on this host.
+
+    Multi-instance jobs write one part-file per host, so that the outputs of
+    all hosts can share one S3 prefix and be consumed with ``ShardedByS3Key``.
+    """
+    if shard.count == 1:
+        return f"{base_dir}/{name}/{name}"
+    return f"{base_dir}/{name}/{name}-part-{shard.index:05d}"
+
+
+# File extension of each supported split output format.
+output_extensions = {
+    "csv": "csv",
+    "parquet": "parquet",
+    "arrow": "arrow",
+    "libsvm": "libsvm",
+    "recordio-protobuf": "pbr",
+}
+output_formats = tuple(output_extensions)
+write_buffer_size = 8 << 20
+
+
+recordio_magic = 0xCED7230A
+
+
+def _varint(n):
+    out = bytearray()
+    while True:
+        out.append((n & 0x7F) | (0x80 if n > 0x7F else 0))
+        n >>= 7
+        if not n:
+            return bytes(out)
+
+
+def _dense_tensor_prefix(field, n_values):
+    """Protobuf bytes of a Record map field up to its packed doubles.
+
+    The field holds one ``"values"`` entry whose Value is a Float64Tensor of
+    ``n_values`` doubles; only the doubles differ from row to row.
+    """
+    tensor_length = 8 * n_values
+    tensor = b"\x0a" + _varint(tensor_length)
+    value_length = len(tensor) + tensor_length
+    value = b"\x1a" + _varint(value_length)
+    entry_length = 8 + 1 + len(_varint(len(value) + value_length)) + len(value) + value_length
+    return (
+        bytes([field << 3 | 2]) + _varint(entry_length)
+        + b"\x0a\x06values\x12" + _varint(len(value) + value_length) + value + tensor
+    )
+
+
+def encode_recordio_protobuf(rows):
+    """Encodes rows of ``label, features...`` as RecordIO-wrapped protobuf Records.
+
+    Every row becomes one dense Record with a float64 ``values`` tensor for the
+    features and the label, byte for byte what the SageMaker SDK's
+    ``write_numpy_to_dense_tensor`` writes. Rows all have the same layout, so
+    the whole batch is assembled in one numpy buffer.
+    """
+    n, n_features = rows.shape[0], rows.shape[1] - 1
+    feature_prefix = _dense_tensor_prefix(1, n_features)
+    label_prefix = _dense_tensor_prefix(2, 1)
+    record_length = len(feature_prefix) + 8 * n_features + len(label_prefix) + 8
+    width = 8 + record_length + (-record_length % 4)
+    out = np.zeros((n, width), dtype=np.uint8)
+    out[:, :8] = np.frombuffer(np.array([recordio_magic, record_length], dtype="<u4").tobytes(), np.uint8)
+    offset = 8
+    for prefix, values in ((feature_prefix, rows[:, 1:]), (label_prefix, rows[:, :1])):
+        out[:, offset:offset + len(prefix)] = np.frombuffer(prefix, dtype=np.uint8)
+        offset += len(prefix)
+        size = 8 * values.shape[1]
+        out[:, offset:offset + size] = np.ascontiguousarray(values, dtype="<f8").view(np.uint8).reshape(n, size)
+        offset += size
+    return out.tobytes()
+
+
+def output_column_names(categories):
+    """Returns the typed column names of a transformed split."""
+    return [label_column] + numeric_features + [f"sex_{c}" for c in categories]
+
+
+class SplitWriter(object):
+    """Appends transformed rows to one split output file.
+
+    ``csv`` writes the headerless text the built-in XGBoost container expects.
+    ``parquet`` writes compressed, typed columns (snappy unless ``compression``
+    says otherwise). ``arrow`` writes an Arrow IPC file, uncompressed by default
+    so that readers can memory-map it without copying. ``libsvm`` writes sparse
+    0-based ``label index:value`` lines, skipping the zero one-hot entries, and
+    ``recordio-protobuf`` writes one dense SageMaker ``Record`` per row (see
+    encode_recordio_protobuf).
+
+    Text and binary outputs are written through a ``buffer_size`` byte buffer.
+    The time spent in ``write`` and ``close`` is accumulated in ``seconds`` and
+    the final file size is logged on close.
+    """
+
+    def __init__(self, path, output_format, column_names, compression=None, buffer_size=write_buffer_size):
+        if output_format not in output_formats:
+            raise ValueError(f"Unknown output format {output_format}, expected one of {output_formats}")
+        self.path = f"{path}.{output_extensions[output_format]}"
+        self.output_format = output_format
+        self.column_names = column_names
+        self.compression = compression
+        self.rows = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self._writer = None
+        if output_format == "csv":
+            self._file = open(self.path, "w", buffering=buffer_size)
+        elif output_format in ("libsvm", "recordio-protobuf"):
+            self._file = open(self.path, "wb", buffering=buffer_size)
+        else:
+            import pyarrow as pa
+
+            self._schema = pa.schema([(name, pa.float64()) for name in column_names])
+
+    def _table(self, rows):
+        import pyarrow as pa
+
+        return pa.Table.from_arrays(
+            [pa.array(rows[:, i]) for i in range(rows.shape[1])], schema=self._schema
+        )
+
+    def write(self, rows):
+        """Appends a 2D array of transformed rows."""
+        start = time.perf_counter()
+        self._write(rows)
+        self.seconds += time.perf_counter() - start
+
+    def _write(self, rows):
+        self.rows += len(rows)
+        if self.output_format == "csv":
+            pd.DataFrame(rows).to_csv(self._file, header=False, index=False)
+        elif self.output_format == "libsvm":
+            from sklearn.datasets import dump_svmlight_file
+
+            if len(rows):
+                dump_svmlight_file(rows[:, 1:], rows[:, 0], self._file, zero_based=True)
+        elif self.output_format == "recordio-protobuf":
+            self._file.write(encode_recordio_protobuf(rows))
+        else:
+            table = self._table(rows)
+            if self._writer is None:
+                if self.output_format == "parquet":
+                    import pyarrow.parquet as pq
+
+                    self._writer = pq.ParquetWriter(
+                        self.path, self._schema, compression=self.compression or "snappy"
+                    )
+                else:
+                    import pyarrow as pa
+
+                    options = pa.ipc.IpcWriteOptions(compression=self.compression)
+                    self._writer = pa.ipc.new_file(self.path, self._schema, options=options)
+            self._writer.write_table(table)
+
+    def close(self):
+        """Flushes and closes the output, writing an empty file if nothing was written."""
+        start = time.perf_counter()
+        if self.output_format in ("csv", "libsvm", "recordio-protobuf"):
+            self._file.close()
+        else:
+            if self._writer is None:
+                self._write(np.empty((0, len(self.column_names))))
+            self._writer.close()
+        self.seconds += time.perf_counter() - start
+        self.bytes = os.path.getsize(self.path)
+        log_output(self.path, self.rows, self.bytes, self.seconds)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def log_output(path, rows, n_bytes, seconds):
+    """Logs the size and write time of one output file."""
+    logger.info(
+        "Wrote %s: %d rows, %.1f MB in %.2fs (%.1f MB/s).",
+        path, rows, n_bytes / 1e6, seconds, n_bytes / 1e6 / max(seconds, 1e-9),
+    )
+
+
+def open_split_writers(
+    base_dir, output_format, column_names, compression=None, shard=single_host, buffer_size=write_buffer_size
+):
+    """Opens a ``SplitWriter`` for each of train, validation and test."""
+    return {
+        name: SplitWriter(
+            output_stem(base_dir, name, shard), output_format, column_names, compression, buffer_size
+        )
+        for name in split_names
+    }
+
+
+def write_split(path, output_format, column_names, compression, df, params, index=None, batch_size=100000,
+                buffer_size=write_buffer_size):
+    """Transforms rows of ``df`` in batches and writes them to one split file.
+
+    ``index`` selects the rows (all of them when None). Batches are transformed
+    into one reused buffer, so only the written file grows with the row count.
+
+    Returns:
+        A ``(rows, bytes, seconds)`` tuple for the written file.
+    """
+    index = np.arange(len(df)) if index is None else index
+    buffer = np.empty((min(batch_size, len(index)), len(column_names)))
+    with SplitWriter(path, output_format, column_names, compression, buffer_size) as writer:
+        for start in range(0, len(index), batch_size):
+            batch = index[start:start + batch_size]
+            writer.write(transform_into(df.take(batch), params, out=buffer[:len(batch)]))
+    return writer.rows, writer.bytes, writer.seconds
+
+
+def write_features_csv(path, df, buffer_size=write_buffer_size):
+    """Writes the untransformed rows with a header for Feature Store ingestion.
+
+    Returns:
+        A ``(rows, bytes, seconds)`` tuple for the written file.
+    """
+    start = time.perf_counter()
+    with open(path, "w", buffering=buffer_size) as f:
+        df.to_csv(f, header=True, index=False)
+    seconds = time.perf_counter() - start
+    n_bytes = os.path.getsize(path)
+    log_output(path, len(df), n_bytes, seconds)
+    return len(df), n_bytes, seconds
+
+
+write_executors = ("thread", "process")
+
+# The frame forked process writers inherit, so that only row positions are sent to them.
+_shared_frame = None
+
+
+def _write_shared_split(path, output_format, column_names, compression, params, index, batch_size, buffer_size):
+    return write_split(
+        path, output_format, column_names, compression, _shared_frame, params, index, batch_size, buffer_size
+    )
+
+
+def _write_shared_features(path, buffer_size):
+    return write_features_csv(path, _shared_frame, buffer_size)
+
+
+def write_outputs(base_dir, output_format, compression, df, params, indices, shard=single_host,
+                  batch_size=100000, executor="thread", buffer_size=write_buffer_size):
+    """Writes the three splits and ``features.csv`` concurrently.
+
+    Every output gets its own worker. ``thread`` workers share the frame and
+    overlap where pandas, NumPy and Arrow release the GIL. ``process`` workers
+    format text on separate cores; they are forked after the frame is set
+    aside, so they inherit it copy-on-write and receive only the row positions
+    of their split. Forking needs the ``fork`` start method and copies nothing
+    but the forking thread, so it is opt-in.
+
+    Args:
+        base_dir: the processing base directory holding the output folders.
+        output_format: one of ``output_formats`` for the split files.
+        compression: optional codec for the columnar formats.
+        df: the untransformed input frame.
+        params: the fitted transform parameters.
+        indices: the train, validation and test row positions.
+        shard: this host's ``Shard``.
+        batch_size: the number of rows transformed at a time.
+        executor: one of ``write_executors``.
+        buffer_size: the write buffer of every output file, in bytes.
+
+    Returns:
+        A dict with the ``(rows, bytes, seconds)`` of every output.
+    """
+    global _shared_frame
+
+    if executor not in write_executors:
+        raise ValueError(f"Unknown write executor {executor}, expected one of {write_executors}")
+    if executor == "process" and multiprocessing.get_start_method() != "fork":
+        raise ValueError("The process write executor needs the fork start method, use the thread executor")
+    column_names = output_column_names(params[3])
+    pathlib.Path(f"{base_dir}/features").mkdir(parents=True, exist_ok=True)
+    features_path = f"{output_stem(base_dir, 'features', shard)}.csv"
+    start = time.perf_counter()
+    if executor == "process":
+        _shared_frame = df
+    try:
+        if executor == "process":
+            workers = ProcessPoolExecutor(max_workers=len(split_names) + 1)
+            futures = {"features": workers.submit(_write_shared_features, features_path, buffer_size)}
+            for name, index in zip(split_names, indices):
+                futures[name] = workers.submit(
+                    _write_shared_split, output_stem(base_dir, name, shard), output_format, column_names,
+                    compression, params, index, batch_size, buffer_size,
+                )
+        else:
+            workers = ThreadPoolExecutor(max_workers=len(split_names) + 1)
+            futures = {"features": workers.submit(write_features_csv, features_path, df, buffer_size)}
+            for name, index in zip(split_names, indices):
+                futures[name] = workers.submit(
+                    write_split, output_stem(base_dir, name, shard), output_format, column_names,
+                    compression, df, params, index, batch_size, buffer_size,
+                )
+        with workers:
+            results = {name: future.result() for name, future in futures.items()}
+    finally:
+        _shared_frame = None
+    total = sum(n_bytes for _, n_bytes, _ in results.values())
+    seconds = time.perf_counter() - start
+    logger.info(
+        "Wrote %d outputs, %.1f MB in %.2fs with %s workers (%.1f MB/s).",
+        len(results), total / 1e6, seconds, executor, total / 1e6 / max(seconds, 1e-9),
+    )
+    return results
+
+
+def preprocess_streaming(
+    input_data,
+    base_dir,
+    chunk_size,
+    seed=None,
+    max_workers=4,
+    reader_options=None,
+    output_format="csv",
+    compression=None,
+    shard=single_host,
+    exchange_uri=None,
+    base_statistics=None,
+    stratify_bins=0,
+):
+    """Transforms the input in two passes with memory bounded by the chunk size.
+
+    The first pass accumulates the imputation and scaling statistics. The second
+    pass streams the input again, transforms every chunk, deals each row to
+    train, validation or test with ``SplitAssigner`` and appends it straight to
+    the outputs. On a multi-instance job every host streams only
+    its own slice and the first-pass statistics are merged across hosts.
+
+    Args:
+        input_data: the S3 URI, prefix, manifest or local path of the input.
+        base_dir: the processing base directory holding the output folders.
+        chunk_size: the number of rows read per chunk.
+        seed: optional seed for the row-to-split assignment.
+        max_workers: the number of input parts fetched concurrently.
+        reader_options: optional keyword arguments for ``open_input``.
+        output_format: one of ``output_formats`` for the split files.
+        compression: optional codec for the columnar formats.
+        shard: this host's ``Shard``.
+        exchange_uri: S3 prefix used to merge statistics across hosts.
+        base_statistics: optional ``FeatureStatistics`` of earlier data to fit on
+            together with this input.
+        stratify_bins: the number of ``rings`` quantile bins to stratify the
+            split on; 0 or 1 disables stratification.
+
+    Returns:
+        A dict with the number of rows written per split.
+    """
+    reader_options = reader_options or {}
+    parts = shard_input_parts(list_input_parts(input_data), shard)
+    logger.info(
+        "Pass 1: accumulating statistics over %d parts in chunks of %d rows (host %d of %d).",
+        len(parts), chunk_size, shard.index + 1, shard.count,
+    )
+    stats = FeatureStatistics()
+    for chunk in iter_input_frames(parts, chunk_size, max_workers, **reader_options):
+        stats.update(chunk)
+    stats = exchange_statistics(stats, shard, exchange_uri)
+    if base_statistics is not None:
+        stats = merge_statistics(base_statistics, stats)
+    params = stats.finalize()
+    logger.info("Fitted statistics over %d rows.", stats.n_rows)
+    save_transformer(f"{base_dir}/transformer/transformer.json", stats, params)
+
+    logger.info("Pass 2: transforming and writing splits.")
+    assigner = SplitAssigner(None if seed is None else [seed, shard.index])
+    edges = stratum_edges(stats.label_counts, stratify_bins)
+    pathlib.Path(f"{base_dir}/features").mkdir(parents=True, exist_ok=True)
+    outputs = open_split_writers(
+        base_dir, output_format, output_column_names(params[3]), compression, shard
+    )
+    features_path = f"{output_stem(base_dir, 'features', shard)}.csv"
+    # One worker per output; waiting on the previous chunk's writes before
+    # submitting the next keeps every file in order while the next chunk is
+    # read and transformed.
+    workers = ThreadPoolExecutor(max_workers=len(outputs) + 1)
+    pending = []
+    features_written = [0, 0.0]
+
+    def write_features(chunk, header):
+        start = time.perf_counter()
+        chunk.to_csv(features, header=header, index=False)
+        features_written[0] += len(chunk)
+        features_written[1] += time.perf_counter() - start
+
+    try:
+        with open(features_path, "w", buffering=write_buffer_size) as features:
+            for i, chunk in enumerate(
+                iter_input_frames(parts, chunk_size, max_workers, **reader_options)
+            ):
+                X = transform_chunk(chunk, params)
+                assignment = assigner.assign(assign_strata(chunk, edges))
+                for future in pending:
+                    future.result()
+                pending = [
+                    workers.submit(outputs[name].write, X[assignment == split])
+                    for split, name in enumerate(split_names)
+                ]
+                pending.append(workers.submit(write_features, chunk, i == 0))
+            for future in pending:
+                future.result()
+    finally:
+        wait(pending)
+        workers.shutdown()
+        for writer in outputs.values():
+            writer.close()
+    log_output(features_path, features_written[0], os.path.getsize(features_path), features_written[1])
+    rows_written = {name: writer.rows for name, writer in outputs.items()}
+    logger.info("Wrote %s rows.", rows_written)
+    return rows_written
+
+
+throttling_error_codes = frozenset(
+    [
+        "ThrottlingException",
+        "ThrottledException",
+        "TooManyRequestsException",
+        "ProvisionedThroughputExceededException",
+        "RequestLimitExceeded",
+        "SlowDown",
+    ]
+)
+retryable_error_codes = throttling_error_codes | {"InternalFailure", "ServiceUnavailable", "InternalServerError"}
+
+
+def error_code(error):
+    """Returns the AWS error code of a botocore ``ClientError``, else the class name."""
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code") or type(error).__name__
+
+
+class AdaptiveConcurrency(object):
+    """Caps the number of in-flight calls, adapting the cap to throttling.
+
+    The cap starts at ``max_limit``, halves on throttling and grows back by
+    one after ``increase_every`` consecutive successes (additive increase,
+    multiplicative decrease). Use it as a context manager around each call;
+    entering returns a ticket to pass to ``on_throttle``. A burst of throttled
+    calls halves the cap once: throttles of calls issued before the last
+    decrease are ignored, as that decrease already accounted for them.
+    """
+
+    def __init__(self, max_limit, min_limit=1, increase_every=20):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.increase_every = increase_every
+        self.limit = max_limit
+        self._in_flight = 0
+        self._successes = 0
+        self._decreases = 0
+        self._condition = threading.Condition()
+
+    def __enter__(self):
+        with self._condition:
+            while self._in_flight >= self.limit:
+                self._condition.wait()
+            self._in_flight += 1
+            return self._decreases
+
+    def __exit__(self, *exc):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self._successes += 1
+            if self._successes >= self.increase_every and self.limit < self.max_limit:
+                self.limit += 1
+                self._successes = 0
+                self._condition.notify()
+
+    def on_throttle(self, ticket=None):
+        """Halves the cap, unless the throttled call was issued before the last decrease.
+
+        Returns:
+            The cap after the throttle.
+        """
+        with self._condition:
+            if ticket is None or ticket == self._decreases:
+                self.limit = max(self.min_limit, self.limit // 2)
+                self._decreases += 1
+            self._successes = 0
+            return self.limit
+
+
+class IngestionReport(object):
+    """Counts of a Feature Store ingestion, mergeable across workers and processes."""
+
+    max_failed_ids = 100
+
+    def __init__(self):
+        self.ingested = 0
+        self.failed = 0
+        self.retries = 0
+        self.throttled = 0
+        self.seconds = 0.0
+        self.errors = collections.Counter()
+        self.failed_record_ids = []
+        self.min_concurrency = None
+        self._lock = threading.Lock()
+
+    def record_success(self):
+        with self._lock:
+            self.ingested += 1
+
+    def record_retry(self, code, throttled):
+        with self._lock:
+            self.retries += 1
+            self.throttled += int(throttled)
+            self.errors[code] += 1
+
+    def record_concurrency(self, limit):
+        with self._lock:
+            self.min_concurrency = limit if self.min_concurrency is None else min(self.min_concurrency, limit)
+
+    def record_failure(self, record_id, code):
+        with self._lock:
+            self.failed += 1
+            self.errors[code] += 1
+            if len(self.failed_record_ids) < self.max_failed_ids:
+                self.failed_record_ids.append(record_id)
+
+    def merge(self, other):
+        """Adds the counts of another report; seconds is the longest of the two."""
+        self.ingested += other.ingested
+        self.failed += other.failed
+        self.retries += other.retries
+        self.throttled += other.throttled
+        self.seconds = max(self.seconds, other.seconds)
+        self.errors.update(other.errors)
+        self.failed_record_ids = (self.failed_record_ids + other.failed_record_ids)[: self.max_failed_ids]
+        if other.min_concurrency is not None:
+            self.min_concurrency = min(self.min_concurrency or other.min_concurrency, other.min_concurrency)
+        return self
+
+    @property
+    def records_per_second(self):
+        return self.ingested / self.seconds if self.seconds else 0.0
+
+    def to_dict(self):
+        return {
+            "ingested": self.ingested,
+            "failed": self.failed,
+            "retries": self.retries,
+            "throttled": self.throttled,
+            "seconds": self.seconds,
+            "records_per_second": round(self.records_per_second, 1),
+            "min_concurrency": self.min_concurrency,
+            "errors": dict(self.errors),
+            "failed_record_ids": self.failed_record_ids,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        report = cls()
+        for name in ("ingested", "failed", "retries", "throttled", "seconds", "min_concurrency"):
+            setattr(report, name, d[name])
+        report.errors.update(d["errors"])
+        report.failed_record_ids = list(d["failed_record_ids"])
+        return report
+
+    def __getstate__(self):
+        return self.to_dict()
+
+    def __setstate__(self, state):
+        self.__dict__.update(IngestionReport.from_dict(state).__dict__)
+
+
+def iter_feature_records(frames, record_id_column="record_id"):
+    """Yields ``(record_id, Record)`` pairs in the PutRecord wire format.
+
+    Columns are converted to strings once per frame rather than per value, and
+    missing values are left out of the record as Feature Store expects.
+    """
+    for frame in frames:
+        names = list(frame.columns)
+        values = [frame[name].astype(str).to_numpy() for name in names]
+        present = [frame[name].notna().to_numpy() for name in names]
+        record_ids = values[names.index(record_id_column)]
+        for i in range(len(frame)):
+            yield record_ids[i], [
+                {"FeatureName": name, "ValueAsString": column[i]}
+                for name, column, mask in zip(names, values, present)
+                if mask[i]
+            ]
+
+
+class FeatureStoreIngester(object):
+    """Puts records into a feature group with bounded, adaptive concurrency.
+
+    ``max_workers`` threads take records from a bounded queue, so the caller
+    blocks (backpressure) rather than buffering the input when the service
+    slows down. Calls are gated by ``AdaptiveConcurrency``: throttling halves
+    the number of in-flight calls and sustained success grows it back. Each
+    record is retried up to ``max_attempts`` times with full-jitter exponential
+    backoff on throttling and transient errors; anything else fails the record
+    immediately. Failures are counted in the ``IngestionReport``, never raised.
+
+    Args:
+        client: a ``sagemaker-featurestore-runtime`` client, or any object
+            with a compatible ``put_record``.
+        feature_group_name: the feature group to write to.
+        max_workers: the number of ingestion threads and the concurrency cap.
+        max_attempts: the number of calls per record before it is reported failed.
+        base_delay: the backoff of the first retry, in seconds.
+        max_delay: the upper bound of any single backoff, in seconds.
+        sleep: the function used to wait between retries.
+        target_stores: the ``TargetStores`` of every PutRecord call, e.g.
+            ``["OnlineStore"]``; None writes to every store of the group.
+    """
+
+    def __init__(
+        self,
+        client,
+        feature_group_name,
+        max_workers=8,
+        max_attempts=6,
+        base_delay=0.05,
+        max_delay=5.0,
+        sleep=time.sleep,
+        target_stores=None,
+    ):
+        self.client = client
+        self.feature_group_name = feature_group_name
+        self.put_options = {"TargetStores": list(target_stores)} if target_stores else {}
+        self.max_workers = max_workers
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.sleep = sleep
+        self.concurrency = AdaptiveConcurrency(max_workers)
+
+    def _backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _put(self, record_id, record, report):
+        for attempt in range(self.max_attempts):
+            try:
+                with self.concurrency as ticket:
+                    self.client.put_record(
+                        FeatureGroupName=self.feature_group_name, Record=record, **self.put_options
+                    )
+            except Exception as e:
+                code = error_code(e)
+                throttled = code in throttling_error_codes
+                if throttled:
+                    report.record_concurrency(self.concurrency.on_throttle(ticket))
+                if code not in retryable_error_codes or attempt == self.max_attempts - 1:
+                    logger.debug("Giving up on record %s: %s", record_id, e)
+                    report.record_failure(record_id, code)
+                    return
+                report.record_retry(code, throttled)
+                self.sleep(self._backoff(attempt))
+            else:
+                self.concurrency.on_success()
+                report.record_success()
+                return
+
+    def _work(self, records, report):
+        while True:
+            item = records.get()
+            if item is None:
+                return
+            self._put(item[0], item[1], report)
+
+    def ingest(self, frames):
+        """Ingests the rows of every frame in ``frames``.
+
+        Returns:
+            The ``IngestionReport`` of this call.
+        """
+        report = IngestionReport()
+        report.record_concurrency(self.concurrency.limit)
+        records = queue.Queue(maxsize=self.max_workers * 64)
+        start = time.perf_counter()
+        workers = [
+            threading.Thread(target=self._work, args=(records, report), daemon=True)
+            for _ in range(self.max_workers)
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for item in iter_feature_records(frames):
+                records.put(item)
+        finally:
+            for _ in workers:
+                records.put(None)
+            for worker in workers:
+                worker.join()
+        report.seconds = time.perf_counter() - start
+        return report
+
+
+def featurestore_runtime_client(region, max_workers=8):
+    """Creates a featurestore-runtime client that leaves retries to the ingester."""
+    return boto3.Session(region_name=region).client(
+        "sagemaker-featurestore-runtime",
+        config=Config(retries={"max_attempts": 1}, max_pool_connections=max_workers),
+    )
+
+
+def _ingest_in_process(frame, client_factory, feature_group_name, ingester_options):
+    ingester = FeatureStoreIngester(client_factory(), feature_group_name, **ingester_options)
+    return ingester.ingest([frame])
+
+
+def iter_frame_batches(frames, batch_size):
+    """Re-slices an iterable of frames into frames of at most ``batch_size`` rows."""
+    for frame in frames:
+        for start in range(0, len(frame), batch_size):
+            yield frame.iloc[start:start + batch_size]
+
+
+def ingest_feature_frames(
+    frames, feature_group_name, client_factory, max_processes=1, batch_size=10000, **ingester_options
+):
+    """Ingests frames with a ``FeatureStoreIngester`` in one or more processes.
+
+    With ``max_processes`` above one the rows are cut into batches of
+    ``batch_size`` and at most two batches per process are queued at a time,
+    every process running its own ingester and client.
+
+    Args:
+        frames: an iterable of DataFrames in the feature group's schema.
+        feature_group_name: the feature group to write to.
+        client_factory: a picklable callable returning a featurestore-runtime client.
+        max_processes: the number of ingestion processes.
+        batch_size: the number of rows handed to a process at a time.
+        **ingester_options: keyword arguments for ``FeatureStoreIngester``.
+
+    Returns:
+        The merged ``IngestionReport``.
+    """
+    start = time.perf_counter()
+    if max_processes <= 1:
+        report = FeatureStoreIngester(client_factory(), feature_group_name, **ingester_options).ingest(frames)
+    else:
+        report = IngestionReport()
+        with ProcessPoolExecutor(max_workers=max_processes) as pool:
+            pending = collections.deque()
+            for batch in iter_frame_batches(frames, batch_size):
+                if len(pending) >= 2 * max_processes:
+                    report.merge(pending.popleft().result())
+                pending.append(
+                    pool.submit(_ingest_in_process, batch, client_factory, feature_group_name, ingester_options)
+                )
+            while pending:
+                report.merge(pending.popleft().result())
+    report.seconds = time.perf_counter() - start
+    logger.info(
+        "Feature Store ingestion: %d records in %.1fs (%.0f records/s), %d failed, %d retries (%d throttled).",
+        report.ingested, report.seconds, report.records_per_second, report.failed, report.retries,
+        report.throttled,
+    )
+    if report.failed:
+        logger.warning("Failed records (errors %s), first ids: %s", dict(report.errors), report.failed_record_ids)
+    return report
+
+
+def wait_for_feature_group(
+    client, feature_group_name, timeout=600, initial_delay=1.0, max_delay=30.0, sleep=time.sleep
+):
+    """Polls DescribeFeatureGroup until the feature group is created.
+
+    Polls back off exponentially from ``initial_delay`` up to ``max_delay``
+    seconds, and the time waited is logged.
+
+    Args:
+        client: a SageMaker client.
+        feature_group_name: the feature group to wait for.
+        timeout: the longest total time to sleep between polls, in seconds.
+        initial_delay: the delay before the second poll, in seconds.
+        max_delay: the upper bound of any single delay, in seconds.
+        sleep: the function used to wait between polls.
+
+    Returns:
+        The DescribeFeatureGroup response of the created feature group.
+
+    Raises:
+        RuntimeError: if the feature group failed to create or is being deleted.
+        TimeoutError: if the feature group is still creating after ``timeout``.
+    """
+    start = time.perf_counter()
+    delay = initial_delay
+    slept = 0.0
+    while True:
+        description = client.describe_feature_group(FeatureGroupName=feature_group_name)
+        status = description["FeatureGroupStatus"]
+        if status == "Created":
+            logger.info(
+                "Feature group %s is ready after waiting %.1fs.",
+                feature_group_name, time.perf_counter() - start,
+            )
+            return description
+        if status != "Creating":
+            raise RuntimeError(
+                f"Feature group {feature_group_name} is {status}: {description.get('FailureReason', '')}"
+            )
+        if slept + delay > timeout:
+            raise TimeoutError(f"Feature group {feature_group_name} still creating after {slept:.0f}s")
+        logger.info("Feature group %s is %s, checking again in %.1fs.", feature_group_name, status, delay)
+        sleep(delay)
+        slept += delay
+        delay = min(max_delay, delay * 2)
+
+
+def ensure_feature_group(feature_group_name, region, role, timeout=600):
+    """Creates the abalone feature group unless it exists and waits until it is ready.
+
+    Returns:
+        The DescribeFeatureGroup response once the feature group can be
+        ingested into, None otherwise.
+    """
     try:
         import sagemaker
         from sagemaker.feature_store.feature_group import FeatureGroup
@@ -65,25 +1733,14 @@ def write_to_feature_store(df, feature_group_name, region, role):
             FeatureTypeEnum,
         )
         
-        logger.info(f"Writing features to Feature Store: {feature_group_name}")
-        
         # Create boto3 session
         boto_session = boto3.Session(region_name=region)
         sagemaker_session = sagemaker.Session(boto_session=boto_session)
         
         # Define feature definitions
         feature_definitions = [
-            FeatureDefinition(feature_name="event_time", feature_type=FeatureTypeEnum.STRING),
-            FeatureDefinition(feature_name="record_id", feature_type=FeatureTypeEnum.STRING),
-            FeatureDefinition(feature_name="sex", feature_type=FeatureTypeEnum.STRING),
-            FeatureDefinition(feature_name="length", feature_type=FeatureTypeEnum.FRACTIONAL),
-            FeatureDefinition(feature_name="diameter", feature_type=FeatureTypeEnum.FRACTIONAL),
-            FeatureDefinition(feature_name="height", feature_type=FeatureTypeEnum.FRACTIONAL),
-            FeatureDefinition(feature_name="whole_weight", feature_type=FeatureTypeEnum.FRACTIONAL),
-            FeatureDefinition(feature_name="shucked_weight", feature_type=FeatureTypeEnum.FRACTIONAL),
-            FeatureDefinition(feature_name="viscera_weight", feature_type=FeatureTypeEnum.FRACTIONAL),
-            FeatureDefinition(feature_name="shell_weight", feature_type=FeatureTypeEnum.FRACTIONAL),
-            FeatureDefinition(feature_name="rings", feature_type=FeatureTypeEnum.INTEGRAL),
+            FeatureDefinition(feature_name=name, feature_type=FeatureTypeEnum(feature_type))
+            for name, feature_type in feature_store_definitions
         ]
         
         # Create or get feature group
@@ -93,28 +1750,6 @@ def write_to_feature_store(df, feature_group_name, region, role):
             feature_definitions=feature_definitions,
         )
         
-        # Prepare data for Feature Store
-        # Add event_time and record_id columns
-        current_time_sec = int(round(time.time()))
-        df_fs = df.copy()
-        df_fs["event_time"] = pd.Series([current_time_sec] * len(df_fs), dtype=str)
-        df_fs["record_id"] = df_fs.index.astype(str)
-        
-        # Ensure all columns are present
-        required_cols = ["event_time", "record_id", "sex", "length", "diameter", "height",
-                        "whole_weight", "shucked_weight", "viscera_weight", "shell_weight", "rings"]
-        for col in required_cols:
-            if col not in df_fs.columns:
-                if col == "rings":
-                    # If rings is not in df_fs, we need to add it from the original data
-                    logger.warning(f"Column {col} not found, skipping Feature Store write")
-                    return
-                else:
-                    df_fs[col] = 0.0
-        
-        # Select only required columns in correct order
-        df_fs = df_fs[required_cols]
-        
         # Try to create feature group (will fail if it already exists, which is fine)
         try:
             feature_group.create(
@@ -125,136 +1760,617 @@ def write_to_feature_store(df, feature_group_name, region, role):
                 enable_online_store=True,
             )
             logger.info(f"Created new feature group: {feature_group_name}")
-            # Wait for feature group to be ready
-            time.sleep(10)
         except Exception as e:
             if "ResourceInUse" in str(e) or "already exists" in str(e).lower():
                 logger.info(f"Feature group {feature_group_name} already exists, using existing one")
             else:
                 logger.warning(f"Could not create feature group: {e}")
-                return
-        
-        # Ingest data to Feature Store
-        feature_group.ingest(data_frame=df_fs, max_workers=3, wait=True)
-        logger.info(f"Successfully ingested {len(df_fs)} records to Feature Store")
-        
+                return None
+
+        # Wait for feature group to be ready; an existing one may still be creating
+        return wait_for_feature_group(sagemaker_session.sagemaker_client, feature_group_name, timeout)
+
     except ImportError:
         logger.warning("SageMaker Feature Store SDK not available, skipping Feature Store write")
     except Exception as e:
-        logger.warning(f"Failed to write to Feature Store: {e}")
-        logger.warning("Continuing without Feature Store...")
+        logger.warning(f"Feature group {feature_group_name} is not usable: {e}")
+    return None
 
 
-if __name__ == "__main__":
-    logger.debug("Starting preprocessing.")
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input-data", type=str, required=True)
-    parser.add_argument("--feature-group-name", type=str, default=None)
-    parser.add_argument("--enable-feature-store", type=str, default="False")
-    parser.add_argument("--region", type=str, default=None)
-    args = parser.parse_args()
-
-    base_dir = "/opt/ml/processing"
-    pathlib.Path(f"{base_dir}/data").mkdir(parents=True, exist_ok=True)
-    input_data = args.input_data
-    bucket = input_data.split("/")[2]
-    key = "/".join(input_data.split("/")[3:])
-
-    logger.info("Downloading data from bucket: %s, key: %s", bucket, key)
-    fn = f"{base_dir}/data/abalone-dataset.csv"
-    s3 = boto3.resource("s3")
-    s3.Bucket(bucket).download_file(key, fn)
-
-    logger.debug("Reading downloaded data.")
-    df = pd.read_csv(
-        fn,
-        header=None,
-        names=feature_columns_names + [label_column],
-        dtype=merge_two_dicts(feature_columns_dtype, label_column_dtype),
-    )
-    os.unlink(fn)
-
-    logger.debug("Defining transformers.")
-    numeric_features = list(feature_columns_names)
-    numeric_features.remove("sex")
-    numeric_transformer = Pipeline(
-        steps=[
-            ("imputer", SimpleImputer(strategy="median")),
-            ("scaler", StandardScaler()),
-        ]
-    )
+def start_feature_group_setup(feature_group_name, region, role, timeout=600):
+    """Runs ``ensure_feature_group`` on a background thread.
 
-    categorical_features = ["sex"]
-    categorical_transformer = Pipeline(
-        steps=[
-            (
-                "imputer",
-                SimpleImputer(strategy="constant", fill_value="missing"),
-            ),
-            ("onehot", OneHotEncoder(handle_unknown="ignore")),
-        ]
-    )
+    The control-plane calls then overlap with writing the splits instead of
+    delaying them.
+
+    Returns:
+        A future resolving to the result of ``ensure_feature_group``.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(ensure_feature_group, feature_group_name, region, role, timeout)
+    executor.shutdown(wait=False)
+    return future
+
+
+class RecordKeys(object):
+    """Derives stable record keys and content hashes for Feature Store rows.
+
+    The key hashes the ``record_id_columns``, so a row whose other columns
+    changed keeps its record id and replaces the previous version online, and
+    the content hash covers every feature and the label. Keys depend only on
+    the data, never on row positions, which keeps re-runs idempotent.
+
+    Input read by this script only has the abalone columns, so from the
+    command line the id columns must be among them; a row whose id columns
+    change becomes a new record and the old one stays online.
+
+    Raises:
+        ValueError: if no ``record_id_columns`` are given.
+    """
+
+    def __init__(self, record_id_columns):
+        self.record_id_columns = list(record_id_columns or [])
+        if not self.record_id_columns:
+            raise ValueError("Stable record keys need record id columns")
+
+    def __call__(self, df):
+        """Returns ``(keys, contents)`` uint64 arrays for the rows of ``df``."""
+        contents = pd.util.hash_pandas_object(
+            df[feature_columns_names + [label_column]], index=False
+        ).to_numpy()
+        keys = pd.util.hash_pandas_object(df[self.record_id_columns], index=False).to_numpy()
+        return keys, contents
+
+
+class DeltaIndex(object):
+    """The content hash of every ingested record, keyed by its record key.
+
+    Both columns are uint64, so the index costs 16 bytes per record. It is
+    kept sorted by key to look up whole chunks with one ``searchsorted``.
+    """
+
+    def __init__(self, keys=None, contents=None):
+        keys = np.array([], dtype=np.uint64) if keys is None else np.asarray(keys, dtype=np.uint64)
+        contents = np.array([], dtype=np.uint64) if contents is None else np.asarray(contents, dtype=np.uint64)
+        order = np.argsort(keys, kind="stable")
+        self.keys = keys[order]
+        self.contents = contents[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def changed(self, keys, contents):
+        """Returns a mask of the records that are new or whose content changed."""
+        if not len(self.keys):
+            return np.ones(len(keys), dtype=bool)
+        position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return (self.keys[position] != keys) | (self.contents[position] != contents)
+
+    def update(self, keys, contents):
+        """Returns a new index holding these records on top of the current ones."""
+        keys = np.concatenate([np.asarray(keys, dtype=np.uint64), self.keys])
+        contents = np.concatenate([np.asarray(contents, dtype=np.uint64), self.contents])
+        keys, first = np.unique(keys, return_index=True)
+        return DeltaIndex(keys, contents[first])
+
+    def save(self, uri):
+        """Writes the index as ``.npz`` to an S3 URI or a local path."""
+        buffer = io.BytesIO()
+        np.savez(buffer, keys=self.keys, contents=self.contents)
+        if uri.startswith("s3://"):
+            bucket, key = parse_s3_uri(uri)
+            boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=buffer.getvalue())
+        else:
+            pathlib.Path(uri).parent.mkdir(parents=True, exist_ok=True)
+            with open(uri, "wb") as f:
+                f.write(buffer.getvalue())
+
+    @classmethod
+    def load(cls, uri):
+        """Reads an index saved by ``save``; a missing index is empty."""
+        try:
+            if uri.startswith("s3://"):
+                bucket, key = parse_s3_uri(uri)
+                body = boto3.client("s3").get_object(Bucket=bucket, Key=key)["Body"].read()
+            else:
+                with open(uri, "rb") as f:
+                    body = f.read()
+        except Exception as e:
+            if isinstance(e, FileNotFoundError) or error_code(e) in ("NoSuchKey", "404"):
+                logger.info("No delta index at %s, ingesting every record.", uri)
+                return cls()
+            raise
+        arrays = np.load(io.BytesIO(body))
+        return cls(arrays["keys"], arrays["contents"])
+
+
+def delta_index_location(delta_index_uri, feature_group_name, shard=single_host):
+    """Returns the delta index file of a feature group on this host.
+
+    Multi-instance jobs keep one index per host. A host that sees records
+    another host indexed on an earlier run ingests them again, which is safe
+    because record ids are stable.
+    """
+    name = "index" if shard.count == 1 else f"index-part-{shard.index:05d}"
+    return f"{delta_index_uri.rstrip('/')}/{feature_group_name}/{name}.npz"
 
-    preprocess = ColumnTransformer(
-        transformers=[
-            ("num", numeric_transformer, numeric_features),
-            ("cat", categorical_transformer, categorical_features),
+
+offline_store_metadata_columns = ("write_time", "api_invocation_time", "is_deleted")
+
+
+def offline_store_schema():
+    """Returns the Arrow schema of offline-store files of the abalone feature group.
+
+    It maps ``feature_store_definitions`` the way Feature Store does (String to
+    string, Fractional to double, Integral to bigint) and appends the metadata
+    columns Feature Store adds to every offline record.
+    """
+    import pyarrow as pa
+
+    types = {"String": pa.string(), "Fractional": pa.float64(), "Integral": pa.int64()}
+    return pa.schema(
+        [(name, types[feature_type]) for name, feature_type in feature_store_definitions]
+        + [
+            ("write_time", pa.timestamp("ms")),
+            ("api_invocation_time", pa.timestamp("ms")),
+            ("is_deleted", pa.bool_()),
         ]
     )
 
-    logger.info("Applying transforms.")
-    y = df.pop("rings")
-    X_pre = preprocess.fit_transform(df)
-    y_pre = y.to_numpy().reshape(len(y), 1)
 
-    X = np.concatenate((y_pre, X_pre), axis=1)
+class OfflineStoreWriter(object):
+    """Writes feature records straight into a feature group's offline store.
+
+    Files land under the resolved offline-store URI (``.../data``) in the
+    layout Feature Store itself uses, partitioned by event time as
+    ``year=YYYY/month=MM/day=DD/hour=HH/<timestamp>_<id>.parquet``, one file per
+    written frame and partition, with the schema of ``offline_store_schema``.
+    This is orders of magnitude faster than PutRecord for backfills; it needs a
+    Glue-format offline store (not Iceberg), and new partitions may need to be
+    registered before the Glue table sees them.
+
+    Args:
+        resolved_uri: ``ResolvedOutputS3Uri`` of the feature group, or a local
+            directory.
+        compression: the Parquet codec.
+    """
+
+    def __init__(self, resolved_uri, compression="snappy"):
+        import pyarrow as pa
+
+        self.resolved_uri = resolved_uri.rstrip("/")
+        self.compression = compression
+        self.schema = offline_store_schema()
+        self.rows = 0
+        self.files = []
+        self._pa = pa
+        self._run_id = os.urandom(4).hex()
+
+    def _put(self, path, body):
+        if path.startswith("s3://"):
+            bucket, key = parse_s3_uri(path)
+            boto3.client("s3").put_object(Bucket=bucket, Key=key, Body=body)
+        else:
+            pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+            with open(path, "wb") as f:
+                f.write(body)
+
+    def write(self, df):
+        """Writes the rows of a frame in the feature group schema."""
+        import pyarrow.parquet as pq
+
+        pa = self._pa
+        now = pd.Timestamp.now(tz="UTC").tz_localize(None).floor("ms")
+        event_times = pd.to_datetime(df["event_time"].astype(np.int64), unit="s")
+        for hour, rows in df.groupby(event_times.dt.floor("h").to_numpy(), sort=True):
+            columns = [
+                pa.array(rows[field.name], type=field.type, from_pandas=True)
+                for field in self.schema
+                if field.name not in offline_store_metadata_columns
+            ]
+            columns += [
+                pa.array(np.full(len(rows), now.to_datetime64()), type=pa.timestamp("ms")),
+                pa.array(np.full(len(rows), now.to_datetime64()), type=pa.timestamp("ms")),
+                pa.array(np.zeros(len(rows), dtype=bool)),
+            ]
+            buffer = pa.BufferOutputStream()
+            pq.write_table(pa.Table.from_arrays(columns, schema=self.schema), buffer, compression=self.compression)
+            hour = pd.Timestamp(hour)
+            path = (
+                f"{self.resolved_uri}/year={hour.year:04d}/month={hour.month:02d}/day={hour.day:02d}"
+                f"/hour={hour.hour:02d}/{now.strftime('%Y%m%dT%H%M%SZ')}_{self._run_id}-{len(self.files):05d}.parquet"
+            )
+            self._put(path, buffer.getvalue().to_pybytes())
+            self.files.append(path)
+            self.rows += len(rows)
+
+
+def latest_per_record(df):
+    """Keeps only the newest row of every record id, by event time.
+
+    Ties keep the last row. Record ids must come from ``record_id_columns``
+    for rows of one record to share an id. Rows of the same record in
+    different frames are each put, in frame order.
+    """
+    event_times = df["event_time"].astype(np.int64)
+    order = np.argsort(event_times.to_numpy(), kind="stable")
+    latest = ~df["record_id"].iloc[order].duplicated(keep="last").to_numpy()
+    return df.iloc[np.sort(order[latest])]
+
+
+def index_record_ids(index, prefix=""):
+    """Returns ``prefix`` followed by each index label, as an object array.
+
+    The ids are formatted one Python string per row. ``np.char.add`` and
+    ``Index.astype(str)`` were both slower on a million ids, as they build an
+    intermediate array before the same per-row strings.
+    """
+    return np.array([f"{prefix}{label}" for label in index.tolist()], dtype=object)
+
+
+def feature_store_frame(df, event_time, record_ids):
+    """Returns the rows of ``df`` in the feature group schema without copying them.
+
+    The feature columns are shared with ``df``. ``event_time`` is one string
+    referenced by every row, so the new columns cost a pointer per row, and
+    features missing from ``df`` other than the label are zero-filled.
+
+    Raises:
+        ValueError: if ``df`` has no label column.
+    """
+    n_rows = len(df)
+    columns = {}
+    for name, _ in feature_store_definitions:
+        if name == "event_time":
+            columns[name] = np.full(n_rows, str(event_time), dtype=object)
+        elif name == "record_id":
+            columns[name] = record_ids
+        elif name in df.columns:
+            columns[name] = df[name].to_numpy(copy=False)
+        elif name == label_column:
+            raise ValueError(f"Column {name} not found, skipping Feature Store write")
+        else:
+            columns[name] = np.zeros(n_rows)
+    return pd.DataFrame(columns, index=df.index, copy=False)
+
+
+def write_to_feature_store(
+    df,
+    feature_group_name,
+    region,
+    role,
+    record_id_prefix="",
+    max_workers=8,
+    max_processes=1,
+    report_path=None,
+    feature_group_ready=None,
+    delta_index_uri=None,
+    record_id_columns=None,
+    local_index_path=None,
+    offline_snapshot=False,
+):
+    """Write processed features to SageMaker Feature Store.
+
+    ``df`` may also be an iterable of DataFrame chunks, which are ingested one
+    after another so the full frame never has to be held in memory.
+    ``record_id_prefix`` keeps record ids unique across processing hosts.
+    Records are put by ``ingest_feature_frames`` with ``max_workers`` threads in
+    each of ``max_processes`` processes; the resulting ``IngestionReport`` is
+    returned and, given ``report_path``, saved as JSON. ``feature_group_ready``
+    is an optional future from ``start_feature_group_setup``; without it the
+    feature group is created and waited for here.
+
+    With ``record_id_columns`` record ids are derived by ``RecordKeys`` instead
+    of the row index, so they stay stable across runs. With ``delta_index_uri``
+    only rows that are new or changed since the ``DeltaIndex`` stored there are
+    ingested; the index is advanced, and copied to ``local_index_path``, only
+    if every record was ingested. Delta ingestion needs ``record_id_columns``,
+    as a changed row must overwrite the record it replaces.
+
+    With ``offline_snapshot`` every row is written straight to the offline
+    store by ``OfflineStoreWriter`` and only the latest row per record id of
+    each frame is put, with ``TargetStores=["OnlineStore"]``, into the online
+    store. It needs ``record_id_columns`` to tell rows of one record apart.
+
+    Raises:
+        ValueError: if ``delta_index_uri`` or ``offline_snapshot`` is given
+            without ``record_id_columns``.
+    """
+    if delta_index_uri and not record_id_columns:
+        raise ValueError("Delta ingestion needs record_id_columns")
+    if offline_snapshot and not record_id_columns:
+        raise ValueError("Offline snapshots need record_id_columns")
+    try:
+        ready = (
+            ensure_feature_group(feature_group_name, region, role)
+            if feature_group_ready is None
+            else feature_group_ready.result()
+        )
+        if not ready:
+            return
+
+        logger.info(f"Writing features to Feature Store: {feature_group_name}")
+        offline_writer = None
+        if offline_snapshot:
+            offline_config = ready.get("OfflineStoreConfig") if isinstance(ready, dict) else None
+            if offline_config:
+                offline_writer = OfflineStoreWriter(offline_config["S3StorageConfig"]["ResolvedOutputS3Uri"])
+            else:
+                logger.warning("Feature group %s has no offline store, ingesting online only.", feature_group_name)
+        frames = [df] if isinstance(df, pd.DataFrame) else df
+        current_time_sec = int(round(time.time()))
+
+        record_keys = RecordKeys(record_id_columns) if record_id_columns else None
+        if delta_index_uri:
+            delta_index = DeltaIndex.load(delta_index_uri)
+            logger.info("Loaded delta index of %d records from %s.", len(delta_index), delta_index_uri)
+        seen = []
+
+        def prepared_frames():
+            for frame in frames:
+                if record_keys is not None:
+                    keys, contents = record_keys(frame)
+                    if delta_index_uri:
+                        seen.append((keys, contents))
+                        changed = delta_index.changed(keys, contents)
+                        frame, keys = frame[changed], keys[changed]
+                    record_ids = keys.astype(str)
+                else:
+                    record_ids = index_record_ids(frame.index, record_id_prefix)
+                df_fs = feature_store_frame(frame, current_time_sec, record_ids)
+                if offline_writer is not None:
+                    offline_writer.write(df_fs)
+                    df_fs = latest_per_record(df_fs)
+                yield df_fs
+
+        report = ingest_feature_frames(
+            prepared_frames(),
+            feature_group_name,
+            functools.partial(featurestore_runtime_client, region, max_workers),
+            max_processes=max_processes,
+            max_workers=max_workers,
+            target_stores=["OnlineStore"] if offline_writer is not None else None,
+        )
+        if offline_writer is not None:
+            logger.info(
+                "Wrote %d records to %d offline store files under %s.",
+                offline_writer.rows, len(offline_writer.files), offline_writer.resolved_uri,
+            )
+        if delta_index_uri:
+            n_seen = sum(len(keys) for keys, _ in seen)
+            logger.info(
+                "Delta ingestion: %d of %d records were new or changed.", report.ingested + report.failed, n_seen
+            )
+            if report.failed:
+                logger.warning(
+                    "Not advancing the delta index at %s, %d records failed.", delta_index_uri, report.failed
+                )
+            elif seen:
+                keys, contents = (np.concatenate(arrays) for arrays in zip(*seen))
+                delta_index = delta_index.update(keys, contents)
+                delta_index.save(delta_index_uri)
+                if local_index_path:
+                    delta_index.save(local_index_path)
+        if report_path:
+            with open(report_path, "w") as f:
+                json.dump(report.to_dict(), f, indent=2)
+        return report
+
+    except ImportError:
+        logger.warning("SageMaker Feature Store SDK not available, skipping Feature Store write")
+    except Exception as e:
+        logger.warning(f"Failed to write to Feature Store: {e}")
+        logger.warning("Continuing without Feature Store...")
+
+
+def preprocess_in_memory(
+    input_data,
+    base_dir,
+    max_workers=4,
+    reader_options=None,
+    output_format="csv",
+    compression=None,
+    shard=single_host,
+    exchange_uri=None,
+    base_statistics=None,
+    seed=None,
+    stratify_bins=0,
+    batch_size=100000,
+    write_executor="thread",
+):
+    """Transforms the whole input at once with the fused ``transform_into`` kernel.
+
+    Rows are split by a seeded permutation of their indices and every split is
+    gathered and transformed in batches straight into its writer, so neither a
+    shuffled copy nor the full transformed matrix is ever materialized.
+
+    On a multi-instance job every host loads only its own slice, and the
+    transforms are fitted on statistics merged across hosts instead; the same
+    goes for incremental refits on top of ``base_statistics``.
+
+    Args:
+        input_data: the S3 URI, prefix, manifest or local path of the input.
+        base_dir: the processing base directory holding the output folders.
+        max_workers: the number of input parts fetched concurrently.
+        reader_options: optional keyword arguments for ``open_input``.
+        output_format: one of ``output_formats`` for the split files.
+        compression: optional codec for the columnar formats.
+        shard: this host's ``Shard``.
+        exchange_uri: S3 prefix used to merge statistics across hosts.
+        base_statistics: optional ``FeatureStatistics`` of earlier data to fit on
+            together with this input.
+        seed: optional seed for the split permutation.
+        stratify_bins: the number of ``rings`` quantile bins to stratify the
+            split on; 0 or 1 disables stratification.
+        batch_size: the number of rows gathered and transformed at a time.
+        write_executor: one of ``write_executors``; the splits and
+            ``features.csv`` are written concurrently by ``write_outputs``.
+
+    Returns:
+        The original DataFrame (features and label) for Feature Store ingestion.
+    """
+    logger.debug("Reading input data.")
+    parts = shard_input_parts(list_input_parts(input_data), shard)
+    frames = list(iter_input_frames(parts, max_workers=max_workers, **(reader_options or {})))
+    df = frames[0] if len(frames) == 1 else pd.concat(frames)
+    del frames
+
+    logger.info("Applying transforms.")
+    if shard.count > 1 or base_statistics is not None:
+        stats = exchange_statistics(FeatureStatistics.from_frame(df), shard, exchange_uri)
+        if base_statistics is not None:
+            stats = merge_statistics(base_statistics, stats)
+        params = stats.finalize()
+    else:
+        stats, params = fit_in_memory(df)
+    save_transformer(f"{base_dir}/transformer/transformer.json", stats, params)
 
     logger.info(
         "Splitting %d rows of data into train, validation, test datasets.",
-        len(X),
+        len(df),
     )
-    np.random.shuffle(X)
-    train, validation, test = np.split(
-        X, [int(0.7 * len(X)), int(0.85 * len(X))]
+    edges = stratum_edges(stats.label_counts, stratify_bins)
+    indices = split_indices(assign_strata(df, edges), None if seed is None else [seed, shard.index])
+
+    logger.info("Writing out %s datasets and features to %s.", output_format, base_dir)
+    write_outputs(
+        base_dir, output_format, compression, df, params, indices, shard, batch_size, write_executor
     )
+    logger.info("Saved features for Feature Store ingestion.")
+    return df
+
 
-    logger.info("Writing out datasets to %s.", base_dir)
-    pd.DataFrame(train).to_csv(
-        f"{base_dir}/train/train.csv", header=False, index=False
+def main(argv=None):
+    """Runs preprocessing, and optionally Feature Store ingestion, from command line arguments."""
+    logger.debug("Starting preprocessing.")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-data", type=str, required=True)
+    parser.add_argument("--feature-group-name", type=str, default=None)
+    parser.add_argument("--enable-feature-store", type=str, default="False")
+    parser.add_argument("--region", type=str, default=None)
+    parser.add_argument(
+        "--processing-mode", type=str, default="in-memory", choices=["in-memory", "streaming"]
     )
-    pd.DataFrame(validation).to_csv(
-        f"{base_dir}/validation/validation.csv", header=False, index=False
+    parser.add_argument("--chunk-size", type=int, default=100000)
+    parser.add_argument("--s3-range-size-mb", type=int, default=8)
+    parser.add_argument("--s3-prefetch", type=int, default=4)
+    parser.add_argument("--download-workers", type=int, default=4)
+    parser.add_argument("--output-format", type=str, default="csv", choices=output_formats)
+    parser.add_argument("--output-compression", type=str, default=None)
+    parser.add_argument("--stats-exchange-uri", type=str, default=None)
+    parser.add_argument("--base-transformer", type=str, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--stratify-bins", type=int, default=0)
+    parser.add_argument("--write-executor", type=str, default="thread", choices=write_executors)
+    parser.add_argument("--feature-store-workers", type=int, default=8)
+    parser.add_argument("--feature-store-processes", type=int, default=1)
+    parser.add_argument("--feature-group-timeout", type=int, default=600)
+    parser.add_argument(
+        "--feature-store-ingestion", type=str, default="full", choices=["full", "delta"]
     )
-    pd.DataFrame(test).to_csv(
-        f"{base_dir}/test/test.csv", header=False, index=False
+    parser.add_argument("--delta-index-uri", type=str, default=None)
+    parser.add_argument("--record-id-columns", type=str, default=None)
+    parser.add_argument(
+        "--feature-store-target", type=str, default="online", choices=["online", "offline-snapshot"]
     )
-    
-    # Write features for Feature Store (original data before preprocessing)
-    # Save original dataframe for Feature Store ingestion
-    features_dir = f"{base_dir}/features"
-    pathlib.Path(features_dir).mkdir(parents=True, exist_ok=True)
-    
-    # Reconstruct original dataframe with features and label
-    original_df = df.copy()
-    original_df["rings"] = y
-    original_df.to_csv(
-        f"{features_dir}/features.csv", header=True, index=False
+    args = parser.parse_args(argv)
+
+    # PROCESSING_BASE_DIR stands in for /opt/ml/processing when run outside a container
+    base_dir = os.environ.get("PROCESSING_BASE_DIR", "/opt/ml/processing")
+    shard = current_shard()
+    base_statistics = None
+    if args.base_transformer:
+        base_statistics, _ = load_transformer(args.base_transformer)
+    reader_options = dict(
+        range_size=args.s3_range_size_mb * 1024 * 1024,
+        prefetch=args.s3_prefetch,
     )
-    logger.info("Saved features for Feature Store ingestion.")
+
+    delta_index_uri = None
+    if args.feature_store_ingestion == "delta":
+        if not args.delta_index_uri:
+            parser.error("--delta-index-uri is required with --feature-store-ingestion delta")
+        if not args.record_id_columns:
+            parser.error("--record-id-columns is required with --feature-store-ingestion delta")
+        delta_index_uri = delta_index_location(args.delta_index_uri, args.feature_group_name, shard)
+    input_columns = feature_columns_names + [label_column]
+    record_id_columns = args.record_id_columns.split(",") if args.record_id_columns else None
+    unknown_columns = [name for name in record_id_columns or [] if name not in input_columns]
+    if unknown_columns:
+        parser.error(f"--record-id-columns {unknown_columns} are not input columns, expected some of {input_columns}")
+    if args.feature_store_target == "offline-snapshot" and not args.record_id_columns:
+        parser.error("--record-id-columns is required with --feature-store-target offline-snapshot")
+
+    # Create the feature group in the background while the splits are written
+    feature_group_ready = None
+    region = args.region or os.environ.get("AWS_DEFAULT_REGION", "us-east-1")
+    # Get IAM role from environment (set by SageMaker)
+    role = os.environ.get("SAGEMAKER_ROLE_ARN") or os.environ.get("TRAINING_JOB_ROLE_ARN")
+    if args.enable_feature_store.lower() == "true" and args.feature_group_name and role:
+        feature_group_ready = start_feature_group_setup(
+            args.feature_group_name, region, role, args.feature_group_timeout
+        )
+
+    if args.processing_mode == "streaming":
+        preprocess_streaming(
+            args.input_data,
+            base_dir,
+            args.chunk_size,
+            max_workers=args.download_workers,
+            reader_options=reader_options,
+            output_format=args.output_format,
+            compression=args.output_compression,
+            shard=shard,
+            exchange_uri=args.stats_exchange_uri,
+            base_statistics=base_statistics,
+            seed=args.seed,
+            stratify_bins=args.stratify_bins,
+        )
+        original_df = pd.read_csv(
+            f"{output_stem(base_dir, 'features', shard)}.csv",
+            dtype=merge_two_dicts(feature_columns_dtype, label_column_dtype),
+            chunksize=args.chunk_size,
+        )
+    else:
+        original_df = preprocess_in_memory(
+            args.input_data,
+            base_dir,
+            max_workers=args.download_workers,
+            reader_options=reader_options,
+            output_format=args.output_format,
+            compression=args.output_compression,
+            shard=shard,
+            exchange_uri=args.stats_exchange_uri,
+            base_statistics=base_statistics,
+            seed=args.seed,
+            stratify_bins=args.stratify_bins,
+            write_executor=args.write_executor,
+        )
     
     # Write to Feature Store if enabled
     if args.enable_feature_store.lower() == "true" and args.feature_group_name:
         try:
-            # Get IAM role from environment (set by SageMaker)
-            role = os.environ.get("SAGEMAKER_ROLE_ARN") or os.environ.get("TRAINING_JOB_ROLE_ARN")
             if not role:
                 logger.warning("IAM role not found in environment, skipping Feature Store write")
             else:
                 write_to_feature_store(
                     original_df,
                     args.feature_group_name,
-                    args.region or os.environ.get("AWS_DEFAULT_REGION", "us-east-1"),
-                    role
+                    region,
+                    role,
+                    record_id_prefix=f"{shard.index}-" if shard.count > 1 else "",
+                    max_workers=args.feature_store_workers,
+                    max_processes=args.feature_store_processes,
+                    report_path=f"{output_stem(base_dir, 'features', shard)}-ingestion-report.json",
+                    feature_group_ready=feature_group_ready,
+                    delta_index_uri=delta_index_uri,
+                    record_id_columns=record_id_columns,
+                    local_index_path=f"{output_stem(base_dir, 'features', shard)}-delta-index.npz",
+                    offline_snapshot=args.feature_store_target == "offline-snapshot",
                 )
         except Exception as e:
             logger.warning(f"Feature Store ingestion failed: {e}, continuing...")
+
+
+if __name__ == "__main__":
+    main()
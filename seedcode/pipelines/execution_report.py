@@ -0,0 +1,309 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""A CLI to report where the time of a pipeline execution went."""
+from __future__ import absolute_import
+
+import argparse
+import datetime
+import json
+import re
+import sys
+import traceback
+
+from pipelines._utils import list_execution_steps
+
+# Describe call, and its creation / start / end time fields, of each job type a step can run.
+JOB_TIMES = {
+    "ProcessingJob": ("describe_processing_job", "ProcessingJobName", "ProcessingStartTime", "ProcessingEndTime"),
+    "TrainingJob": ("describe_training_job", "TrainingJobName", "TrainingStartTime", "TrainingEndTime"),
+    "TransformJob": ("describe_transform_job", "TransformJobName", "TransformStartTime", "TransformEndTime"),
+}
+
+
+def fetch_execution(sagemaker_client, execution_arn):
+    """Fetches everything the report needs about an execution.
+
+    Args:
+        sagemaker_client: A boto3 SageMaker client.
+        execution_arn: The pipeline execution ARN.
+
+    Returns:
+        A JSON-serializable dict of the raw responses, as taken by build_report.
+    """
+    steps = list_execution_steps(sagemaker_client, execution_arn)
+    jobs = {}
+    for step in steps:
+        for job_type, job in step.get("Metadata", {}).items():
+            if job_type in JOB_TIMES and "Arn" in job:
+                describe, name_field = JOB_TIMES[job_type][:2]
+                response = getattr(sagemaker_client, describe)(**{name_field: job["Arn"].split("/")[-1]})
+                jobs[job["Arn"]] = {
+                    key: response.get(key) for key in ("CreationTime",) + JOB_TIMES[job_type][2:]
+                }
+    responses = {
+        "execution": sagemaker_client.describe_pipeline_execution(PipelineExecutionArn=execution_arn),
+        "steps": steps,
+        "definition": sagemaker_client.describe_pipeline_definition_for_execution(
+            PipelineExecutionArn=execution_arn
+        )["PipelineDefinition"],
+        "jobs": jobs,
+    }
+    return json.loads(json.dumps(responses, default=_isoformat))
+
+
+def _isoformat(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def _timestamp(value):
+    """Returns seconds since the epoch of a datetime or an ISO 8601 string, None for None."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        # strptime, as datetime.fromisoformat needs Python 3.7; %z on 3.6 takes no colon in the offset
+        text = re.sub(r"([+-]\d\d):(\d\d)$", r"\1\2", value.replace("Z", "+00:00"))
+        fmt = "%Y-%m-%dT%H:%M:%S" + (".%f" if "." in text else "") + ("%z" if re.search(r"[+-]\d{4}$", text) else "")
+        value = datetime.datetime.strptime(text, fmt)
+    return value.timestamp()
+
+
+def _references(value):
+    """Yields the step names referenced by {"Get": "Steps.<name>..."} expressions."""
+    if isinstance(value, dict):
+        get = value.get("Get")
+        if isinstance(get, str) and get.startswith("Steps."):
+            yield get.split(".")[1]
+        for item in value.values():
+            yield from _references(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from _references(item)
+
+
+def step_dependencies(definition):
+    """Gets the upstream steps of every step of a pipeline definition.
+
+    A step depends on the steps in its DependsOn list, on the steps whose
+    properties it reads and, for the branches of a ConditionStep, on the
+    condition itself.
+
+    Args:
+        definition: The pipeline definition JSON string or dict.
+
+    Returns:
+        A dict of step name to the set of its upstream step names.
+    """
+    if isinstance(definition, str):
+        definition = json.loads(definition)
+    dependencies = {}
+
+    def visit(steps):
+        for step in steps:
+            name = step["Name"]
+            upstream = set(step.get("DependsOn", [])) | set(_references(step.get("Arguments", {})))
+            dependencies.setdefault(name, set()).update(upstream - {name})
+            if step.get("Type") == "Condition":
+                branches = step["Arguments"].get("IfSteps", []) + step["Arguments"].get("ElseSteps", [])
+                visit(branches)
+                for branch in branches:
+                    dependencies[branch["Name"]].add(name)
+
+    visit(definition.get("Steps", []))
+    return dependencies
+
+
+def step_timings(step, jobs):
+    """Splits the wall time of one executed step into phases.
+
+    ``queue`` runs from the step start to the creation of its job, ``startup``
+    from the job creation to the job start (instance provisioning and image
+    pull), ``run`` from the job start to its end and ``teardown`` from the job
+    end to the step end (output upload and status propagation). Steps without
+    a job count all their time as ``run``.
+
+    Returns:
+        A dict with the step name, type, status, start and end times and the
+        seconds of every phase.
+    """
+    start, end = _timestamp(step.get("StartTime")), _timestamp(step.get("EndTime"))
+    timing = {
+        "name": step["StepName"],
+        "type": next(iter(step.get("Metadata", {})), None),
+        "status": step["StepStatus"],
+        "start": start,
+        "end": end,
+        "queue_seconds": 0.0,
+        "startup_seconds": 0.0,
+        "run_seconds": 0.0,
+        "teardown_seconds": 0.0,
+        "total_seconds": end - start if start is not None and end is not None else None,
+    }
+    job_times = None
+    for job_type, job in step.get("Metadata", {}).items():
+        if job_type in JOB_TIMES and job.get("Arn") in jobs:
+            job = jobs[job["Arn"]]
+            job_times = [_timestamp(job.get(key)) for key in ("CreationTime",) + JOB_TIMES[job_type][2:]]
+    if start is None or end is None:
+        return timing
+    if job_times is None or None in job_times:
+        timing["run_seconds"] = end - start
+        return timing
+    created, job_start, job_end = job_times
+    timing.update(
+        queue_seconds=max(0.0, created - start),
+        startup_seconds=max(0.0, job_start - created),
+        run_seconds=max(0.0, job_end - job_start),
+        teardown_seconds=max(0.0, end - job_end),
+    )
+    return timing
+
+
+def critical_path(timings, dependencies):
+    """Finds the chain of steps that determined the execution's end time.
+
+    Starting from the step that finished last, it repeatedly moves to the
+    upstream step that finished last, i.e. the one the step waited for.
+
+    Returns:
+        The step names of the critical path, first step first.
+    """
+    finished = {t["name"]: t for t in timings if t["end"] is not None}
+    if not finished:
+        return []
+    path = [max(finished.values(), key=lambda t: t["end"])["name"]]
+    while True:
+        upstream = [finished[name] for name in dependencies.get(path[-1], ()) if name in finished]
+        if not upstream:
+            return path[::-1]
+        path.append(max(upstream, key=lambda t: t["end"])["name"])
+
+
+def build_report(responses):
+    """Builds the timing report of an execution from its raw responses.
+
+    Args:
+        responses: The dict returned by fetch_execution, or the same
+            responses saved to and loaded from JSON.
+
+    Returns:
+        A JSON-serializable report dict.
+    """
+    execution = responses["execution"]
+    timings = sorted(
+        (step_timings(step, responses.get("jobs", {})) for step in responses["steps"]),
+        key=lambda t: (t["start"] is None, t["start"]),
+    )
+    path = critical_path(timings, step_dependencies(responses["definition"]))
+    by_name = {t["name"]: t for t in timings}
+    starts = [t["start"] for t in timings if t["start"] is not None]
+    ends = [t["end"] for t in timings if t["end"] is not None]
+    return {
+        "execution_arn": execution.get("PipelineExecutionArn"),
+        "status": execution.get("PipelineExecutionStatus"),
+        "total_seconds": max(ends) - min(starts) if starts and ends else None,
+        "steps": timings,
+        "critical_path": path,
+        "critical_path_seconds": {
+            phase: sum(by_name[name][f"{phase}_seconds"] for name in path)
+            for phase in ("queue", "startup", "run", "teardown")
+        },
+    }
+
+
+def format_report(report):
+    """Formats a report as a plain-text table."""
+
+    def seconds(value):
+        return "-" if value is None else f"{value:.0f}s"
+
+    lines = [
+        f"Execution {report['execution_arn']}: {report['status']} in {seconds(report['total_seconds'])}",
+        f"{'step':<32} {'status':<10} {'queue':>7} {'startup':>8} {'run':>7} {'teardown':>9} {'total':>7}",
+    ]
+    for t in report["steps"]:
+        marker = "*" if t["name"] in report["critical_path"] else " "
+        lines.append(
+            f"{marker}{t['name']:<31} {t['status']:<10} {seconds(t['queue_seconds']):>7} "
+            f"{seconds(t['startup_seconds']):>8} {seconds(t['run_seconds']):>7} "
+            f"{seconds(t['teardown_seconds']):>9} {seconds(t['total_seconds']):>7}"
+        )
+    phases = ", ".join(f"{phase} {seconds(value)}" for phase, value in report["critical_path_seconds"].items())
+    lines.append(f"Critical path (*): {' -> '.join(report['critical_path'])} ({phases})")
+    return "\n".join(lines)
+
+
+def main():  # pragma: no cover
+    """The main harness that reports the step timings of a pipeline execution."""
+    parser = argparse.ArgumentParser("Reports queue, start-up, run and teardown time per pipeline step.")
+    parser.add_argument(
+        "-e",
+        "--execution-arn",
+        dest="execution_arn",
+        default=None,
+        help="The pipeline execution ARN to fetch from SageMaker.",
+    )
+    parser.add_argument(
+        "--from-file",
+        dest="from_file",
+        default=None,
+        help="Build the report from responses saved with --save-responses instead of calling SageMaker.",
+    )
+    parser.add_argument(
+        "--save-responses",
+        dest="save_responses",
+        default=None,
+        help="Save the fetched SageMaker responses to this JSON file.",
+    )
+    parser.add_argument(
+        "--json",
+        dest="json_file",
+        default=None,
+        help="Write the report as JSON to this file ('-' for stdout).",
+    )
+    parser.add_argument("--region", dest="region", default=None, help="The AWS region of the execution.")
+    args = parser.parse_args()
+
+    if (args.execution_arn is None) == (args.from_file is None):
+        parser.print_help()
+        sys.exit(2)
+
+    try:
+        if args.from_file:
+            with open(args.from_file) as f:
+                responses = json.load(f)
+        else:
+            import boto3
+
+            region = args.region or args.execution_arn.split(":")[3]
+            responses = fetch_execution(boto3.client("sagemaker", region_name=region), args.execution_arn)
+            if args.save_responses:
+                with open(args.save_responses, "w") as f:
+                    json.dump(responses, f, indent=2)
+        report = build_report(responses)
+        if args.json_file == "-":
+            print(json.dumps(report, indent=2, sort_keys=True))
+            return
+        if args.json_file:
+            with open(args.json_file, "w") as f:
+                json.dump(report, f, indent=2, sort_keys=True)
+        print(format_report(report))
+    except Exception as e:  # pylint: disable=W0703
+        print(f"Exception: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
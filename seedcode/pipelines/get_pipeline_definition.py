@@ -14,10 +14,18 @@
 from __future__ import absolute_import
 
 import argparse
+import os
 import sys
 import traceback
 
-from pipelines._utils import get_pipeline_driver
+from pipelines._utils import (
+    DefinitionCache,
+    caller_identity,
+    convert_struct,
+    definition_cache_key,
+    get_pipeline_driver,
+    with_step_cache,
+)
 
 
 def main():  # pragma: no cover
@@ -49,15 +57,80 @@ def main():  # pragma: no cover
         default=None,
         help="Dict string of keyword arguments for the pipeline generation (if supported)",
     )
+    parser.add_argument(
+        "--step-cache",
+        dest="step_cache",
+        default=None,
+        help="Enable step caching: an ISO 8601 expiry for every cacheable step (e.g. P30D) or "
+        "comma-separated step=expiry pairs (e.g. preprocess=P30D,train=P7D). Sets the step_cache kwarg.",
+    )
+    parser.add_argument(
+        "--offline-config",
+        dest="offline_config",
+        default=os.environ.get("PIPELINE_OFFLINE_CONFIG"),
+        help="JSON file with the role and default_bucket (and optionally account_id) to use instead "
+        "of AWS lookups, so the definition is generated without network access.",
+    )
+    parser.add_argument(
+        "--no-cache",
+        dest="no_cache",
+        action="store_true",
+        help="Always rebuild the definition instead of reading or writing the definition cache. "
+        "Without --offline-config the cache is keyed on the STS caller identity and skipped if it cannot be fetched.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        dest="cache_dir",
+        default=None,
+        help="The definition cache directory (default: $PIPELINE_DEFINITION_CACHE_DIR or "
+        "~/.cache/sagemaker-pipelines/definitions).",
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        dest="cache_max_entries",
+        type=int,
+        default=100,
+        help="Evict the least recently used definitions beyond this many.",
+    )
+    parser.add_argument(
+        "--cache-max-age",
+        dest="cache_max_age",
+        type=float,
+        default=None,
+        help="Evict definitions older than this many seconds.",
+    )
+    parser.add_argument(
+        "--clear-cache",
+        dest="clear_cache",
+        action="store_true",
+        help="Remove every cached definition first.",
+    )
     args = parser.parse_args()
+    args.kwargs = with_step_cache(args.kwargs, args.step_cache)
+
+    cache = DefinitionCache(args.cache_dir, args.cache_max_entries, args.cache_max_age)
+    if args.clear_cache:
+        print(f"Removed {cache.clear()} cached definitions from {cache.cache_dir}.", file=sys.stderr)
+        if args.module_name is None:
+            sys.exit(0)
 
     if args.module_name is None:
         parser.print_help()
         sys.exit(2)
 
     try:
-        pipeline = get_pipeline_driver(args.module_name, args.kwargs)
-        content = pipeline.definition()
+        content = key = None
+        if not args.no_cache:
+            # The default role and bucket depend on the AWS identity, unless the offline config fixes them
+            identity = None if args.offline_config else caller_identity(convert_struct(args.kwargs).get("region"))
+            if identity or args.offline_config:
+                key = definition_cache_key(args.module_name, args.kwargs, args.offline_config, identity)
+                content = cache.get(key)
+        if content is None:
+            pipeline = get_pipeline_driver(args.module_name, args.kwargs, args.offline_config)
+            content = pipeline.definition()
+            if key:
+                cache.put(key, content)
         if args.file_name:
             with open(args.file_name, "w") as f:
                 f.write(content)
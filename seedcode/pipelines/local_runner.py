@@ -0,0 +1,424 @@
+# Copyright 2020 Amazon.com, Inc. or its affiliates. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"). You
+# may not use this file except in compliance with the License. A copy of
+# the License is located at
+#
+#     http://aws.amazon.com/apache2.0/
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF
+# ANY KIND, either express or implied. See the License for the specific
+# language governing permissions and limitations under the License.
+"""A CLI to run a pipeline definition on the local machine, without AWS."""
+from __future__ import absolute_import
+
+import argparse
+import importlib
+import json
+import operator
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import traceback
+
+from pipelines._utils import convert_struct, get_pipeline_driver
+from pipelines.execution_report import step_dependencies
+
+# Stands in for the role, bucket and account lookups when building the definition.
+LOCAL_OFFLINE_CONFIG = {
+    "role": "arn:aws:iam::000000000000:role/local-runner",
+    "default_bucket": "local-runner",
+    "account_id": "000000000000",
+}
+PROCESSING_DIR = "/opt/ml/processing"
+
+_comparisons = {
+    "Equals": operator.eq,
+    "GreaterThan": operator.gt,
+    "GreaterThanOrEqualTo": operator.ge,
+    "LessThan": operator.lt,
+    "LessThanOrEqualTo": operator.le,
+}
+
+
+def _json_path(document, path):
+    for key in path.split("."):
+        document = document[int(key) if isinstance(document, list) else key]
+    return document
+
+
+class LocalExecution(object):
+    """Runs the steps of a pipeline definition in dependency order on this machine.
+
+    Every S3 location a step reads or writes is a local path under
+    ``work_dir``: processing steps run their script as a subprocess with
+    ``PROCESSING_BASE_DIR`` pointing at their own copy of /opt/ml/processing,
+    training steps train with the local XGBoost package, and condition steps
+    are evaluated here. Other step types, such as model registration, are
+    skipped.
+
+    Args:
+        definition: The pipeline definition JSON string or dict.
+        code_dir: The directory holding the processing scripts.
+        work_dir: The directory the steps read and write under.
+        parameters: Optional dict of pipeline parameter values that override
+            the defaults.
+        printer: The function progress lines are passed to.
+    """
+
+    def __init__(self, definition, code_dir, work_dir, parameters=None, printer=print):
+        if isinstance(definition, str):
+            definition = json.loads(definition)
+        self.definition = definition
+        self.code_dir = code_dir
+        self.work_dir = work_dir
+        self.parameters = {p["Name"]: p.get("DefaultValue") for p in definition.get("Parameters", [])}
+        self.parameters.update(parameters or {})
+        self.printer = printer
+        self.properties = {}
+        self.property_files = {}
+        self.results = {}
+
+    def resolve(self, value):
+        """Resolves the Get, Std:Join and Std:JsonGet expressions in ``value``."""
+        if isinstance(value, list):
+            return [self.resolve(item) for item in value]
+        if not isinstance(value, dict):
+            return value
+        if "Get" in value:
+            name = value["Get"]
+            if name.startswith("Parameters."):
+                return self.parameters[name[len("Parameters."):]]
+            if name.startswith("Execution."):
+                return f"local-{name[len('Execution.'):]}"
+            if name not in self.properties:
+                raise KeyError(f"{name} is not available locally")
+            return self.properties[name]
+        if "Std:Join" in value:
+            join = value["Std:Join"]
+            return join["On"].join(str(self.resolve(item)) for item in join["Values"])
+        if "Std:JsonGet" in value:
+            json_get = value["Std:JsonGet"]
+            with open(self.property_files[json_get["PropertyFile"]["Get"]]) as f:
+                return _json_path(json.load(f), json_get["Path"])
+        return {key: self.resolve(item) for key, item in value.items()}
+
+    def evaluate(self, condition):
+        """Evaluates one condition of a ConditionStep."""
+        kind = condition["Type"]
+        if kind == "Not":
+            return not self.evaluate(condition["Expression"])
+        if kind == "Or":
+            return any(self.evaluate(c) for c in condition["Conditions"])
+        if kind == "In":
+            return self.resolve(condition["QueryValue"]) in self.resolve(condition["Values"])
+        return _comparisons[kind](self.resolve(condition["LeftValue"]), self.resolve(condition["RightValue"]))
+
+    def _local(self, step_dir, path):
+        return os.path.join(step_dir, os.path.relpath(path, PROCESSING_DIR))
+
+    def run_processing(self, step, step_dir):
+        args = self.resolve(step["Arguments"])
+        base_dir = os.path.join(step_dir, "processing")
+        for processing_input in args.get("ProcessingInputs", []):
+            source = processing_input["S3Input"]["S3Uri"]
+            destination = self._local(base_dir, processing_input["S3Input"]["LocalPath"])
+            os.makedirs(destination, exist_ok=True)
+            if processing_input["InputName"] == "code":
+                source = os.path.join(self.code_dir, source.rsplit("/", 1)[-1])
+            if os.path.isdir(source):
+                _copy_tree(source, destination)
+            else:
+                shutil.copy(source, destination)
+        for output in args.get("ProcessingOutputConfig", {}).get("Outputs", []):
+            local_path = self._local(base_dir, output["S3Output"]["LocalPath"])
+            os.makedirs(local_path, exist_ok=True)
+            self.properties[
+                f"Steps.{step['Name']}.ProcessingOutputConfig.Outputs['{output['OutputName']}'].S3Output.S3Uri"
+            ] = local_path
+
+        app = args["AppSpecification"]
+        command = [sys.executable if part.startswith("python") else part for part in app["ContainerEntrypoint"][:1]]
+        command += [
+            self._local(base_dir, part) if part.startswith(PROCESSING_DIR) else part
+            for part in app["ContainerEntrypoint"][1:] + app.get("ContainerArguments", [])
+        ]
+        env = dict(os.environ, PROCESSING_BASE_DIR=base_dir, **args.get("Environment", {}))
+        with open(os.path.join(step_dir, "output.log"), "w") as log:
+            completed = subprocess.run(command, cwd=step_dir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if completed.returncode != 0:
+            with open(os.path.join(step_dir, "output.log")) as log:
+                tail = "".join(log.readlines()[-20:])
+            raise RuntimeError(f"{command[1]} exited with {completed.returncode}:\n{tail}")
+
+        outputs = {o["OutputName"]: o for o in args.get("ProcessingOutputConfig", {}).get("Outputs", [])}
+        for property_file in step.get("PropertyFiles", []):
+            output = outputs[property_file["OutputName"]]
+            self.property_files[f"Steps.{step['Name']}.PropertyFiles.{property_file['PropertyFileName']}"] = (
+                os.path.join(self._local(base_dir, output["S3Output"]["LocalPath"]), property_file["FilePath"])
+            )
+
+    def run_training(self, step, step_dir):
+        import xgboost
+
+        args = self.resolve(step["Arguments"])
+        channels = {
+            channel["ChannelName"]: read_channel(channel["DataSource"]["S3DataSource"]["S3Uri"])
+            for channel in args.get("InputDataConfig", [])
+        }
+        hyperparameters = {key: _number(value) for key, value in args.get("HyperParameters", {}).items()}
+        num_round = hyperparameters.pop("num_round", 10)
+        hyperparameters.pop("silent", None)
+        # The 1.0-1 container still accepts the deprecated objective name.
+        if hyperparameters.get("objective") == "reg:linear":
+            hyperparameters["objective"] = "reg:squarederror"
+        dtrain = xgboost.DMatrix(channels["train"][1], label=channels["train"][0])
+        evals = [(dtrain, "train")]
+        if "validation" in channels:
+            evals.append(
+                (xgboost.DMatrix(channels["validation"][1], label=channels["validation"][0]), "validation")
+            )
+        booster = xgboost.train(hyperparameters, dtrain, num_boost_round=num_round, evals=evals, verbose_eval=False)
+
+        model_dir = os.path.join(step_dir, "model")
+        os.makedirs(model_dir, exist_ok=True)
+        with open(os.path.join(model_dir, "xgboost-model"), "wb") as f:
+            pickle.dump(booster, f)
+        model_path = os.path.join(step_dir, "model.tar.gz")
+        with tarfile.open(model_path, "w:gz") as tar:
+            tar.add(os.path.join(model_dir, "xgboost-model"), arcname="xgboost-model")
+        self.properties[f"Steps.{step['Name']}.ModelArtifacts.S3ModelArtifacts"] = model_path
+
+    def run_fail(self, step, step_dir):
+        """Fails the execution with the step's ErrorMessage, as a FailStep does on SageMaker."""
+        message = self.resolve(step.get("Arguments", {}).get("ErrorMessage", ""))
+        raise RuntimeError(message or f"Fail step {step['Name']} was reached")
+
+    def run(self):
+        """Runs every step whose dependencies ran, stopping at the first failure.
+
+        Returns:
+            A dict of step name to a dict with its ``status`` (Succeeded,
+            Failed, Skipped or NotRun) and ``seconds``.
+        """
+        steps = {}
+
+        def collect(items):
+            for step in items:
+                steps[step["Name"]] = step
+                if step.get("Type") == "Condition":
+                    collect(step["Arguments"].get("IfSteps", []) + step["Arguments"].get("ElseSteps", []))
+
+        collect(self.definition.get("Steps", []))
+        dependencies = step_dependencies(self.definition)
+        not_taken = set()
+        done = set()
+        while len(done) < len(steps):
+            ready = [n for n in steps if n not in done and dependencies.get(n, set()) <= done]
+            if not ready:
+                raise ValueError(f"Cyclic step dependencies among {sorted(set(steps) - done)}")
+            for name in ready:
+                done.add(name)
+                self.results[name] = self._run_step(steps[name], dependencies.get(name, set()), not_taken)
+                if self.results[name]["status"] == "Failed":
+                    for other in steps:
+                        self.results.setdefault(other, {"status": "NotRun", "seconds": 0.0})
+                    return self.results
+        return self.results
+
+    def _run_step(self, step, upstream, not_taken):
+        name = step["Name"]
+        if name in not_taken or any(self.results[u]["status"] != "Succeeded" for u in upstream):
+            not_taken.add(name)
+            return {"status": "NotRun", "seconds": 0.0}
+        runner = {"Processing": self.run_processing, "Training": self.run_training, "Fail": self.run_fail}.get(
+            step["Type"]
+        )
+        if step["Type"] != "Condition" and runner is None:
+            self.printer(f"{name}: Skipped ({step['Type']} steps do not run locally)")
+            return {"status": "Skipped", "seconds": 0.0}
+
+        step_dir = os.path.join(self.work_dir, name)
+        os.makedirs(step_dir, exist_ok=True)
+        self.printer(f"{name}: Executing")
+        start = time.perf_counter()
+        result = {"status": "Succeeded"}
+        try:
+            if runner is not None:
+                runner(step, step_dir)
+            else:
+                outcome = all(self.evaluate(c) for c in step["Arguments"]["Conditions"])
+                result["outcome"] = outcome
+                self.properties[f"Steps.{name}.Outcome"] = outcome
+                branch = "ElseSteps" if outcome else "IfSteps"
+                not_taken.update(s["Name"] for s in step["Arguments"].get(branch, []))
+        except Exception as e:  # pylint: disable=W0703
+            result.update(status="Failed", failure_reason=str(e))
+        result["seconds"] = time.perf_counter() - start
+        detail = f", outcome {result['outcome']}" if "outcome" in result else ""
+        self.printer(f"{name}: {result['status']} after {result['seconds']:.1f}s{detail}")
+        if result["status"] == "Failed":
+            self.printer(result["failure_reason"])
+        return result
+
+
+def _number(value):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            pass
+    return value
+
+
+def _copy_tree(source, destination):
+    """Copies a directory into a possibly existing one (copytree's dirs_exist_ok needs Python 3.8)."""
+    for root, _, names in os.walk(source):
+        target = os.path.join(destination, os.path.relpath(root, source))
+        os.makedirs(target, exist_ok=True)
+        for name in names:
+            shutil.copy2(os.path.join(root, name), os.path.join(target, name))
+
+
+def read_channel(channel_dir):
+    """Reads the label and features of every data file in a training channel.
+
+    Supports the csv, libsvm, parquet, arrow and RecordIO-protobuf (``.pbr``)
+    outputs of preprocessing, with the label in the first column.
+
+    Returns:
+        A tuple of the label vector and the feature matrix.
+    """
+    import numpy as np
+
+    labels, features = [], []
+    for name in sorted(os.listdir(channel_dir)):
+        path = os.path.join(channel_dir, name)
+        if name.startswith((".", "_")) or not os.path.isfile(path):
+            continue
+        if ".libsvm" in name:
+            from sklearn.datasets import load_svmlight_file
+
+            X, y = load_svmlight_file(path, zero_based=True)
+            labels.append(y)
+            features.append(X.toarray())
+            continue
+        if name.endswith(".pbr"):
+            from pipelines.abalone.evaluate import read_recordio_protobuf
+
+            y, X = read_recordio_protobuf(path)
+            labels.append(y)
+            features.append(X)
+            continue
+        if name.endswith(".parquet"):
+            import pyarrow.parquet as pq
+
+            data = np.column_stack([c.to_numpy() for c in pq.read_table(path).combine_chunks().columns])
+        elif name.endswith(".arrow"):
+            import pyarrow as pa
+
+            table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all().combine_chunks()
+            data = np.column_stack([c.to_numpy() for c in table.columns])
+        elif ".csv" in name:
+            import pandas as pd
+
+            data = pd.read_csv(path, header=None).to_numpy()
+        else:
+            raise ValueError(f"Unsupported training input {path}")
+        labels.append(data[:, 0])
+        features.append(data[:, 1:])
+    if not labels:
+        raise FileNotFoundError(f"No training data found in {channel_dir}")
+    return np.concatenate(labels), np.concatenate(features)
+
+
+def run_locally(module_name, passed_args=None, parameters=None, work_dir=None, printer=print):
+    """Builds a pipeline offline and runs it on this machine.
+
+    Args:
+        module_name: The module name of the pipeline; its directory holds the scripts.
+        passed_args: Optional kwargs dict string for get_pipeline.
+        parameters: Optional dict of pipeline parameter overrides, e.g. a
+            local ``InputDataUrl``. Feature Store ingestion is disabled unless
+            ``EnableFeatureStore`` is given.
+        work_dir: The directory steps read and write under; a new temporary
+            directory by default.
+        printer: The function progress lines are passed to.
+
+    Returns:
+        The finished LocalExecution.
+    """
+    pipeline = get_pipeline_driver(module_name, passed_args, dict(LOCAL_OFFLINE_CONFIG))
+    code_dir = os.path.dirname(importlib.import_module(module_name).__file__)
+    parameters = dict({"EnableFeatureStore": "False"}, **(parameters or {}))
+    work_dir = work_dir or tempfile.mkdtemp(prefix="pipeline-local-")
+    execution = LocalExecution(pipeline.definition(), code_dir, work_dir, parameters, printer)
+    printer(f"Running {pipeline.name} locally in {work_dir}")
+    execution.run()
+    return execution
+
+
+def main():  # pragma: no cover
+    """The main harness that runs a pipeline on the local machine."""
+    parser = argparse.ArgumentParser("Runs the pipeline steps locally, with processing paths in a work directory.")
+    parser.add_argument(
+        "-n",
+        "--module-name",
+        dest="module_name",
+        type=str,
+        help="The module name of the pipeline to import.",
+    )
+    parser.add_argument(
+        "-kwargs",
+        "--kwargs",
+        dest="kwargs",
+        default=None,
+        help="Dict string of keyword arguments for the pipeline generation (if supported)",
+    )
+    parser.add_argument(
+        "--input-data",
+        dest="input_data",
+        default=None,
+        help="Local file or directory to use as the InputDataUrl parameter.",
+    )
+    parser.add_argument(
+        "--parameters",
+        dest="parameters",
+        default=None,
+        help="Dict string of pipeline parameter values, e.g. \"{'NumRound': 20}\".",
+    )
+    parser.add_argument(
+        "--work-dir",
+        dest="work_dir",
+        default=None,
+        help="The directory the steps read and write under (default: a new temporary directory).",
+    )
+    args = parser.parse_args()
+
+    if args.module_name is None:
+        parser.print_help()
+        sys.exit(2)
+    parameters = convert_struct(args.parameters)
+    if args.input_data:
+        parameters["InputDataUrl"] = os.path.abspath(args.input_data)
+
+    try:
+        execution = run_locally(args.module_name, args.kwargs, parameters, args.work_dir)
+        failed = [name for name, result in execution.results.items() if result["status"] == "Failed"]
+        if failed:
+            raise RuntimeError(f"Local execution failed at step {failed[0]}")
+        print("\n#####Local execution completed.")
+    except Exception as e:  # pylint: disable=W0703
+        print(f"Exception: {e}")
+        traceback.print_exc()
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,11 +14,27 @@
 from __future__ import absolute_import
 
 import argparse
+import functools
 import json
 import sys
 import traceback
 
-from pipelines._utils import get_pipeline_driver, convert_struct, get_pipeline_custom_tags
+from pipelines._utils import (
+    convert_struct,
+    definition_digest,
+    deployed_definition,
+    execution_metric,
+    format_sweep_results,
+    get_pipeline_custom_tags,
+    get_pipeline_driver,
+    load_sweep_spec,
+    pin_definition,
+    run_sweep,
+    s3_code_digest,
+    sweep_variants,
+    watch_execution,
+    with_step_cache,
+)
 
 
 def main():  # pragma: no cover
@@ -44,6 +60,13 @@ def main():  # pragma: no cover
         default=None,
         help="Dict string of keyword arguments for the pipeline generation (if supported)",
     )
+    parser.add_argument(
+        "--step-cache",
+        dest="step_cache",
+        default=None,
+        help="Enable step caching: an ISO 8601 expiry for every cacheable step (e.g. P30D) or "
+        "comma-separated step=expiry pairs (e.g. preprocess=P30D,train=P7D). Sets the step_cache kwarg.",
+    )
     parser.add_argument(
         "-role-arn",
         "--role-arn",
@@ -66,41 +89,131 @@ def main():  # pragma: no cover
         default=None,
         help="""List of dict strings of '[{"Key": "string", "Value": "string"}, ..]'""",
     )
+    parser.add_argument(
+        "--skip-unchanged",
+        dest="skip_unchanged",
+        action="store_true",
+        help="Skip the upsert when the canonical definition, including the uploaded code, matches the "
+        "deployed one. Tag and description changes alone are then not applied.",
+    )
+    parser.add_argument(
+        "--skip-run-if-unchanged",
+        dest="skip_run_if_unchanged",
+        action="store_true",
+        help="Like --skip-unchanged, and also do not start an execution.",
+    )
+    parser.add_argument(
+        "--poll-min-delay",
+        dest="poll_min_delay",
+        type=float,
+        default=2.0,
+        help="Seconds between execution polls while steps are changing.",
+    )
+    parser.add_argument(
+        "--poll-max-delay",
+        dest="poll_max_delay",
+        type=float,
+        default=60.0,
+        help="Longest number of seconds between execution polls while nothing changes.",
+    )
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        type=float,
+        default=7200.0,
+        help="Seconds after which to stop waiting for the execution.",
+    )
+    parser.add_argument(
+        "--sweep",
+        dest="sweep",
+        default=None,
+        help="JSON file with a grid or random search over pipeline parameters such as NumRound, MaxDepth "
+        "and Eta. Starts one execution per variant and ranks them by the evaluation MSE.",
+    )
+    parser.add_argument(
+        "--max-concurrent-executions",
+        dest="max_concurrent_executions",
+        type=int,
+        default=4,
+        help="The most sweep executions to run at a time. It is lowered when the account quota is reached.",
+    )
     args = parser.parse_args()
 
     if args.module_name is None or args.role_arn is None:
         parser.print_help()
         sys.exit(2)
     tags = convert_struct(args.tags)
+    args.kwargs = with_step_cache(args.kwargs, args.step_cache)
 
     try:
         pipeline = get_pipeline_driver(args.module_name, args.kwargs)
         print("###### Creating/updating a SageMaker Pipeline with the following definition:")
-        parsed = json.loads(pipeline.definition())
+        definition = pin_definition(pipeline)
+        parsed = json.loads(definition)
         print(json.dumps(parsed, indent=2, sort_keys=True))
 
-        all_tags = get_pipeline_custom_tags(args.module_name, args.kwargs, tags)
-
-        upsert_response = pipeline.upsert(
-            role_arn=args.role_arn, description=args.description, tags=all_tags
-        )
-        print("\n###### Created/Updated SageMaker Pipeline: Response received:")
-        print(upsert_response)
+        unchanged = False
+        if args.skip_unchanged or args.skip_run_if_unchanged:
+            session = pipeline.sagemaker_session
+            deployed = deployed_definition(session.sagemaker_client, pipeline.name)
+            if deployed is not None:
+                code_digest = s3_code_digest(session.boto_session.client("s3"))
+                local_digest = definition_digest(definition, code_digest)
+                deployed_digest = definition_digest(deployed, code_digest)
+                print(f"\n###### Definition digest: local {local_digest}, deployed {deployed_digest}")
+                unchanged = local_digest == deployed_digest
+
+        if unchanged:
+            print("\n###### Definition unchanged, skipping the upsert.")
+            if args.skip_run_if_unchanged:
+                print("###### Skipping the execution as well.")
+                return
+        else:
+            all_tags = get_pipeline_custom_tags(args.module_name, args.kwargs, tags)
+
+            upsert_response = pipeline.upsert(
+                role_arn=args.role_arn, description=args.description, tags=all_tags
+            )
+            print("\n###### Created/Updated SageMaker Pipeline: Response received:")
+            print(upsert_response)
+
+        if args.sweep:
+            variants = sweep_variants(load_sweep_spec(args.sweep))
+            print(f"\n###### Starting a sweep of {len(variants)} executions")
+            session = pipeline.sagemaker_session
+            results = run_sweep(
+                session.sagemaker_client,
+                pipeline.name,
+                variants,
+                max_concurrent=args.max_concurrent_executions,
+                collect=functools.partial(
+                    execution_metric, session.sagemaker_client, session.boto_session.client("s3")
+                ),
+                min_delay=args.poll_min_delay,
+                max_delay=args.poll_max_delay,
+                timeout=args.timeout,
+            )
+            print("\n###### Sweep results:")
+            print(format_sweep_results(results))
+            if not any(r["status"] == "Succeeded" for r in results):
+                raise RuntimeError("No sweep execution succeeded")
+            return
 
         execution = pipeline.start()
         print(f"\n###### Execution started with PipelineExecutionArn: {execution.arn}")
 
         print("Waiting for the execution to finish...")
-
-        # Setting the attempts and delay (in seconds) will modify the overall time the pipeline waits. 
-        # If the execution is taking a longer time, update these parameters to a larger value.
-        # Eg: The total wait time is calculated as 60 * 120 = 7200 seconds (2 hours)
-        execution.wait(max_attempts=120, delay=60)
-        
-        print("\n#####Execution completed. Execution step details:")
-
-        print(execution.list_steps())
-        # Todo print the status?
+        result = watch_execution(
+            pipeline.sagemaker_session.sagemaker_client,
+            execution.arn,
+            min_delay=args.poll_min_delay,
+            max_delay=args.poll_max_delay,
+            timeout=args.timeout,
+        )
+        if result["status"] != "Succeeded":
+            detail = f" at step {result['failed_step']}" if result["failed_step"] else ""
+            raise RuntimeError(f"Pipeline execution ended with status {result['status']}{detail}")
+        print("\n#####Execution completed.")
     except Exception as e:  # pylint: disable=W0703
         print(f"Exception: {e}")
         traceback.print_exc()
@@ -19,11 +19,15 @@ extras = {
         "coverage",
         "flake8",
         "mock",
+        "moto",
+        "pyarrow",
         "pydocstyle",
         "pytest",
         "pytest-cov",
         "sagemaker",
+        "scikit-learn",
         "tox",
+        "xgboost",
     ]
 }
 setuptools.setup(
@@ -45,6 +49,8 @@ setuptools.setup(
         "console_scripts": [
             "get-pipeline-definition=pipelines.get_pipeline_definition:main",
             "run-pipeline=pipelines.run_pipeline:main",
+            "execution-report=pipelines.execution_report:main",
+            "run-pipeline-locally=pipelines.local_runner:main",
         ]
     },
     classifiers=[
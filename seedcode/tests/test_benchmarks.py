@@ -0,0 +1,163 @@
+"""Local benchmarks for the abalone preprocessing and training-input paths.
+
+They run on a small synthetic dataset by default so they double as smoke
+tests. Set ABALONE_BENCHMARK_ROWS to benchmark at scale and run pytest with
+``-s`` to see the timing tables, e.g.::
+
+    ABALONE_BENCHMARK_ROWS=5000000 pytest -s tests/test_benchmarks.py
+"""
+import os
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pipelines.abalone import evaluate, preprocess
+from test_preprocess import make_abalone_frame, write_abalone_csv
+
+BENCHMARK_ROWS = int(os.environ.get("ABALONE_BENCHMARK_ROWS", "20000"))
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def report(title, rows):
+    print(f"\n{title}")
+    for row in rows:
+        print("  " + "  ".join(f"{cell:>14}" for cell in row))
+
+
+def load_dmatrix(path, output_format):
+    """Loads a split into a DMatrix the way the XGBoost training container does."""
+    import xgboost
+
+    if output_format == "csv":
+        return xgboost.DMatrix(f"{path}?format=csv&label_column=0")
+    if output_format == "libsvm":
+        return xgboost.DMatrix(f"{path}?format=libsvm")
+    if output_format in ("parquet", "arrow"):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if output_format == "parquet":
+            table = pq.read_table(path, memory_map=True)
+        else:
+            table = pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
+        columns = [column.to_numpy() for column in table.columns]
+        return xgboost.DMatrix(np.column_stack(columns[1:]), label=columns[0])
+    label, features = evaluate.read_recordio_protobuf(path)
+    return xgboost.DMatrix(features, label=label)
+
+
+def test_training_input_load_time_per_format(tmp_path):
+    pytest.importorskip("xgboost")
+    pytest.importorskip("pyarrow")
+    df = make_abalone_frame(BENCHMARK_ROWS)
+    fn = write_abalone_csv(tmp_path / "input.csv", df)
+
+    rows = [("format", "write s", "size MB", "load s")]
+    labels = {}
+    for output_format in preprocess.output_formats:
+        base_dir = tmp_path / output_format
+        for name in preprocess.split_names:
+            (base_dir / name).mkdir(parents=True)
+        _, write_seconds = timed(
+            preprocess.preprocess_streaming,
+            fn,
+            str(base_dir),
+            chunk_size=100000,
+            seed=0,
+            output_format=output_format,
+        )
+        path = base_dir / "train" / f"train.{preprocess.output_extensions[output_format]}"
+        dmatrix, load_seconds = timed(load_dmatrix, str(path), output_format)
+        labels[output_format] = dmatrix.get_label()
+        rows.append(
+            (
+                output_format,
+                f"{write_seconds:.3f}",
+                f"{path.stat().st_size / 1e6:.1f}",
+                f"{load_seconds:.3f}",
+            )
+        )
+    report(f"Training input load time, {BENCHMARK_ROWS} rows", rows)
+
+    for output_format, label in labels.items():
+        np.testing.assert_allclose(label, labels["csv"], err_msg=output_format)
+
+
+def test_transform_kernel_against_sklearn():
+    """Compares the fused kernel with the scikit-learn ColumnTransformer.
+
+    ABALONE_KERNEL_BENCHMARK_ROWS takes a comma-separated list of row counts,
+    e.g. ``1000000,10000000,100000000`` (the largest needs tens of GB of RAM).
+    """
+    from test_preprocess import sklearn_transform
+
+    sizes = [int(n) for n in os.environ.get("ABALONE_KERNEL_BENCHMARK_ROWS", str(BENCHMARK_ROWS)).split(",")]
+    rows = [("rows", "sklearn s", "fit s", "kernel f64 s", "kernel f32 s")]
+    for n_rows in sizes:
+        df = make_abalone_frame(n_rows, missing_rate=0.01)
+        expected, sklearn_seconds = timed(sklearn_transform, df)
+        (_, params), fit_seconds = timed(preprocess.fit_in_memory, df)
+        out = np.empty(expected.shape)
+        _, kernel_seconds = timed(preprocess.transform_into, df, params, out=out)
+        _, kernel32_seconds = timed(preprocess.transform_into, df, params, dtype=np.float32)
+        np.testing.assert_array_equal(out, expected)
+        del expected
+        rows.append(
+            (
+                n_rows,
+                f"{sklearn_seconds:.3f}",
+                f"{fit_seconds:.3f}",
+                f"{kernel_seconds:.3f}",
+                f"{kernel32_seconds:.3f}",
+            )
+        )
+    report("Abalone transform: sklearn ColumnTransformer vs fused kernel", rows)
+
+
+def copying_feature_store_frame(df, event_time, prefix=""):
+    """The Feature Store frame preparation that ``feature_store_frame`` replaced."""
+    df_fs = df.copy()
+    df_fs["event_time"] = pd.Series([event_time] * len(df_fs), dtype=str, index=df_fs.index)
+    df_fs["record_id"] = prefix + df_fs.index.astype(str)
+    return df_fs[[name for name, _ in preprocess.feature_store_definitions]]
+
+
+def peak_memory(fn, *args):
+    tracemalloc.start()
+    try:
+        result = fn(*args)
+        return result, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_feature_store_frame_preparation_time_and_memory():
+    df = make_abalone_frame(BENCHMARK_ROWS)
+    event_time = 1700000000
+
+    def shared():
+        return preprocess.feature_store_frame(df, event_time, preprocess.index_record_ids(df.index, "0-"))
+
+    expected, copying_seconds = timed(copying_feature_store_frame, df, event_time, "0-")
+    prepared, shared_seconds = timed(shared)
+    _, copying_peak = peak_memory(copying_feature_store_frame, df, event_time, "0-")
+    _, shared_peak = peak_memory(shared)
+    report(
+        f"Feature Store frame preparation, {BENCHMARK_ROWS} rows",
+        [
+            ("method", "seconds", "peak MB"),
+            ("copying", f"{copying_seconds:.3f}", f"{copying_peak / 1e6:.1f}"),
+            ("shared", f"{shared_seconds:.3f}", f"{shared_peak / 1e6:.1f}"),
+        ],
+    )
+
+    pd.testing.assert_frame_equal(prepared, expected, check_dtype=False)
+    assert shared_peak < copying_peak
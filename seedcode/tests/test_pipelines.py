@@ -1,6 +1,527 @@
+import datetime
+import json
+import os
+import sys
+
 import pytest
 
 
 @pytest.mark.xfail
 def test_that_you_wrote_tests():
     assert False, "No tests written"
+
+
+def test_session_cache_reuses_sessions_per_region_until_ttl(monkeypatch):
+    from pipelines.abalone import pipeline
+
+    now = [1000.0]
+    monkeypatch.setattr(pipeline.time, "monotonic", lambda: now[0])
+    cache = pipeline.SessionCache(ttl=60)
+    monkeypatch.setattr(pipeline, "session_cache", cache)
+
+    client = pipeline.get_sagemaker_client("us-east-1")
+    session = pipeline.get_session("us-east-1", "bucket")
+    assert pipeline.get_sagemaker_client("us-east-1") is client
+    assert pipeline.get_session("us-east-1", "bucket") is session
+    assert session.sagemaker_client is client
+    assert pipeline.get_pipeline_session("us-east-1", "bucket").boto_session is session.boto_session
+    assert pipeline.get_sagemaker_client("eu-west-1") is not client
+    assert pipeline.get_session("us-east-1", "other-bucket") is not session
+
+    now[0] += 61
+    assert pipeline.get_sagemaker_client("us-east-1") is not client
+    assert pipeline.get_session("us-east-1", "bucket").boto_session is not session.boto_session
+
+
+def import_times(*args):
+    """Runs Python with ``-X importtime`` and returns the cumulative microseconds per module."""
+    import subprocess
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + list(args),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+    times = {}
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+            _, cumulative, module = line[len("import time:"):].split("|")
+            times[module.strip()] = int(cumulative)
+    return times
+
+
+# Budget for importing the pipeline modules, in milliseconds; importing the SageMaker SDK takes seconds.
+IMPORT_BUDGET_MS = int(os.environ.get("PIPELINE_IMPORT_BUDGET_MS", "300"))
+
+needs_importtime = pytest.mark.skipif(sys.version_info < (3, 7), reason="-X importtime needs Python 3.7")
+
+
+@needs_importtime
+@pytest.mark.parametrize("module", ["pipelines.run_pipeline", "pipelines.get_pipeline_definition"])
+def test_cli_help_never_imports_sagemaker(module):
+    times = import_times("-m", module, "--help")
+    assert not [name for name in times if name.split(".")[0] in ("sagemaker", "boto3", "botocore")]
+
+
+@needs_importtime
+def test_pipeline_module_import_time_is_within_budget():
+    times = import_times("-c", "import pipelines.abalone.pipeline, pipelines._utils")
+    assert "sagemaker" not in times
+    assert times["pipelines.abalone.pipeline"] / 1000 < IMPORT_BUDGET_MS
+
+
+def test_definition_cache_key_tracks_sources_and_kwargs(tmp_path, monkeypatch):
+    from pipelines._utils import definition_cache_key
+
+    package = tmp_path / "cached_pipeline"
+    package.mkdir()
+    (package / "__init__.py").write_text("")
+    (package / "pipeline.py").write_text("def get_pipeline(**kwargs):\n    pass\n")
+    (package / "preprocess.py").write_text("x = 1\n")
+    monkeypatch.syspath_prepend(str(tmp_path))
+
+    key = definition_cache_key("cached_pipeline.pipeline", "{'region': 'us-east-1', 'role': 'r'}")
+    assert key == definition_cache_key("cached_pipeline.pipeline", "{'role': 'r', 'region': 'us-east-1'}")
+    assert key != definition_cache_key("cached_pipeline.pipeline", "{'region': 'eu-west-1', 'role': 'r'}")
+    assert key != definition_cache_key(
+        "cached_pipeline.pipeline", "{'region': 'us-east-1', 'role': 'r'}", identity="arn:aws:sts::222222222222:x"
+    )
+    (package / "preprocess.py").write_text("x = 2\n")
+    assert key != definition_cache_key("cached_pipeline.pipeline", "{'region': 'us-east-1', 'role': 'r'}")
+
+
+def test_pinned_definition_is_built_once():
+    from pipelines._utils import pin_definition
+
+    class Pipeline(object):
+        builds = 0
+
+        def definition(self):
+            self.builds += 1
+            return f'{{"build": {self.builds}}}'
+
+    pipeline = Pipeline()
+
+    assert pin_definition(pipeline) == '{"build": 1}'
+    assert pipeline.definition() == '{"build": 1}' and pipeline.builds == 1
+
+
+def test_definition_cache_evicts_least_recently_used(tmp_path):
+    from pipelines._utils import DefinitionCache
+
+    cache = DefinitionCache(str(tmp_path), max_entries=2)
+    for i, key in enumerate(["a", "b"]):
+        cache.put(key, f'{{"n": {i}}}')
+        os.utime(tmp_path / f"{key}.json", (i, i))
+    assert cache.get("a") == '{"n": 0}'
+    cache.put("c", '{"n": 2}')
+
+    assert cache.get("b") is None
+    assert cache.get("a") == '{"n": 0}' and cache.get("c") == '{"n": 2}'
+    assert DefinitionCache(str(tmp_path), max_age_seconds=0).get("a") is None
+    assert cache.clear() == 2 and cache.get("a") is None
+
+
+def test_offline_definition_needs_no_network(monkeypatch):
+    import json
+    import socket
+
+    from pipelines._utils import get_pipeline_driver
+
+    def no_network(*args, **kwargs):
+        raise AssertionError("network access in offline mode")
+
+    monkeypatch.setattr(socket.socket, "connect", no_network)
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "offline")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "offline")
+    config = os.path.join(os.path.dirname(__file__), os.pardir, "offline-config.json")
+
+    pipeline = get_pipeline_driver("pipelines.abalone.pipeline", "{'region': 'us-east-1'}", config)
+    definition = json.loads(pipeline.definition())
+
+    steps = {step["Name"]: step for step in definition["Steps"]}
+    processing = steps["PreprocessAbaloneData"]["Arguments"]
+    assert processing["RoleArn"] == "arn:aws:iam::123456789012:role/service-role/AmazonSageMaker-ExecutionRole"
+    code = [i for i in processing["ProcessingInputs"] if i["InputName"] == "code"][0]
+    assert code["S3Input"]["S3Uri"].startswith("s3://sagemaker-us-east-1-123456789012/")
+
+
+def test_step_cache_settings_in_definition(monkeypatch):
+    from pipelines._utils import get_pipeline_driver, with_step_cache
+
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "offline")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "offline")
+    config = os.path.join(os.path.dirname(__file__), os.pardir, "offline-config.json")
+    kwargs = with_step_cache("{'region': 'us-east-1'}", "preprocess=P30D,train=P7D")
+
+    def steps():
+        definition = json.loads(get_pipeline_driver("pipelines.abalone.pipeline", kwargs, config).definition())
+        return {step["Name"]: step for step in definition["Steps"]}
+
+    first, second = steps(), steps()
+    assert first["PreprocessAbaloneData"]["CacheConfig"] == {"Enabled": True, "ExpireAfter": "P30D"}
+    assert first["TrainAbaloneModel"]["CacheConfig"] == {"Enabled": True, "ExpireAfter": "P7D"}
+    assert "CacheConfig" not in first["EvaluateAbaloneModel"]
+    assert "ProfilerRuleConfigurations" not in first["TrainAbaloneModel"]["Arguments"]
+
+    def code_uri(steps, name):
+        inputs = steps[name]["Arguments"]["ProcessingInputs"]
+        return [i for i in inputs if i["InputName"] == "code"][0]["S3Input"]["S3Uri"]
+
+    assert "/Abalone/code/" in code_uri(first, "PreprocessAbaloneData")
+    assert code_uri(first, "PreprocessAbaloneData") == code_uri(second, "PreprocessAbaloneData")
+    assert "/input/code/" in code_uri(first, "EvaluateAbaloneModel")
+
+    everything = json.loads(
+        get_pipeline_driver(
+            "pipelines.abalone.pipeline", with_step_cache("{'region': 'us-east-1'}", "PT12H"), config
+        ).definition()
+    )
+    assert {step["Name"]: step.get("CacheConfig") for step in everything["Steps"]} == {
+        "PreprocessAbaloneData": {"Enabled": True, "ExpireAfter": "PT12H"},
+        "TrainAbaloneModel": {"Enabled": True, "ExpireAfter": "PT12H"},
+        "EvaluateAbaloneModel": {"Enabled": True, "ExpireAfter": "PT12H"},
+        "CheckMSEAbaloneEvaluation": None,
+    }
+    with pytest.raises(ValueError, match="register"):
+        get_pipeline_driver("pipelines.abalone.pipeline", with_step_cache(kwargs, "register=P1D"), config)
+
+
+def test_canonical_definition_ignores_timestamps_but_not_code():
+    from pipelines._utils import definition_digest
+
+    def definition(timestamp, code_key):
+        return (
+            '{"Version": "2020-12-01", "Steps": [{"Name": "Preprocess", "Arguments": {'
+            f'"Code": "s3://bucket/Abalone/preprocess-{timestamp}/input/code/{code_key}", '
+            f'"Output": "s3://bucket/Abalone/preprocess-{timestamp}/output/train"'
+            "}}]}"
+        )
+
+    contents = {"a.py": "same", "b.py": "same", "c.py": "changed"}
+
+    def code_digest(uri):
+        return contents[uri.rsplit("/", 1)[1]]
+
+    first = definition("2023-01-02-03-04-05-678", "a.py")
+    assert definition_digest(first) == definition_digest(definition("2024-11-12-13-14-15-016", "a.py"))
+    assert definition_digest(first, code_digest) == definition_digest(
+        definition("2024-11-12-13-14-15-016", "b.py"), code_digest
+    )
+    assert definition_digest(first, code_digest) != definition_digest(
+        definition("2023-01-02-03-04-05-678", "c.py"), code_digest
+    )
+
+
+class ScriptedExecution(object):
+    """A SageMaker client replaying one (status, steps) snapshot per poll."""
+
+    def __init__(self, snapshots):
+        self.snapshots = snapshots
+        self.polls = 0
+
+    def describe_pipeline_execution(self, PipelineExecutionArn):
+        self.polls += 1
+        return {"PipelineExecutionStatus": self.snapshots[min(self.polls, len(self.snapshots)) - 1][0]}
+
+    def list_pipeline_execution_steps(self, PipelineExecutionArn, SortOrder, NextToken=None):
+        steps = self.snapshots[min(self.polls, len(self.snapshots)) - 1][1]
+        return {"PipelineExecutionSteps": [{"StepName": n, "StepStatus": s} for n, s in steps]}
+
+
+def test_watcher_polls_fast_on_changes_and_backs_off_when_idle():
+    from pipelines._utils import watch_execution
+
+    client = ScriptedExecution(
+        [
+            ("Executing", [("Preprocess", "Executing")]),
+            ("Executing", [("Preprocess", "Executing")]),
+            ("Executing", [("Preprocess", "Executing")]),
+            ("Executing", [("Preprocess", "Succeeded"), ("Train", "Executing")]),
+            ("Succeeded", [("Preprocess", "Succeeded"), ("Train", "Succeeded")]),
+        ]
+    )
+    delays, lines = [], []
+
+    result = watch_execution(client, "arn", min_delay=2, max_delay=5, sleep=delays.append, printer=lines.append)
+
+    assert result["status"] == "Succeeded"
+    assert delays == [2, 3.0, 4.5, 2]
+    assert [line.split("] ")[1] for line in lines] == [
+        "Preprocess: Pending -> Executing",
+        "Preprocess: Executing -> Succeeded",
+        "Train: Pending -> Executing",
+        "Train: Executing -> Succeeded",
+        "Execution Succeeded.",
+    ]
+
+
+def test_watcher_stops_at_the_first_failed_step():
+    from pipelines._utils import watch_execution
+
+    client = ScriptedExecution(
+        [
+            ("Executing", [("Preprocess", "Executing")]),
+            ("Executing", [("Preprocess", "Failed"), ("Other", "Executing")]),
+            ("Failed", [("Preprocess", "Failed"), ("Other", "Failed")]),
+        ]
+    )
+
+    result = watch_execution(client, "arn", sleep=lambda seconds: None, printer=lambda line: None)
+
+    assert result["status"] == "StepFailed" and result["failed_step"] == "Preprocess"
+    assert client.polls == 2
+
+
+def saved_execution_responses():
+    """Responses as saved by ``execution-report --save-responses``: Preprocess feeds Train and Evaluate."""
+    definition = {
+        "Steps": [
+            {"Name": "Preprocess", "Type": "Processing", "Arguments": {}},
+            {
+                "Name": "Train",
+                "Type": "Training",
+                "Arguments": {"InputDataConfig": [{"Uri": {"Get": "Steps.Preprocess.ProcessingOutputConfig"}}]},
+            },
+            {"Name": "Lint", "Type": "Processing", "Arguments": {}, "DependsOn": ["Preprocess"]},
+            {
+                "Name": "Evaluate",
+                "Type": "Processing",
+                "Arguments": {"ModelArtifacts": {"Get": "Steps.Train.ModelArtifacts.S3ModelArtifacts"}},
+            },
+            {
+                "Name": "CheckMSE",
+                "Type": "Condition",
+                "Arguments": {
+                    "Conditions": [{"LeftValue": {"Std:JsonGet": {"PropertyFile": {"Get": "Steps.Evaluate.X"}}}}],
+                    "IfSteps": [{"Name": "Register", "Type": "RegisterModel", "Arguments": {}}],
+                    "ElseSteps": [],
+                },
+            },
+        ]
+    }
+
+    def t(seconds):
+        return f"2026-10-15T12:{seconds // 60:02d}:{seconds % 60:02d}+00:00"
+
+    def step(name, start, end, job_type=None):
+        metadata = {job_type: {"Arn": f"arn:aws:sagemaker:us-east-1:1:{job_type.lower()}/{name}"}} if job_type else {}
+        return {
+            "StepName": name,
+            "StepStatus": "Succeeded",
+            "StartTime": t(start),
+            "EndTime": t(end),
+            "Metadata": metadata,
+        }
+
+    def job(name, job_type, created, started, ended):
+        prefix = job_type.replace("Job", "")
+        return f"arn:aws:sagemaker:us-east-1:1:{job_type.lower()}/{name}", {
+            "CreationTime": t(created),
+            f"{prefix}StartTime": t(started),
+            f"{prefix}EndTime": t(ended),
+        }
+
+    return {
+        "execution": {"PipelineExecutionArn": "arn:exec", "PipelineExecutionStatus": "Succeeded"},
+        "definition": json.dumps(definition),
+        "steps": [
+            step("Preprocess", 0, 300, "ProcessingJob"),
+            step("Lint", 305, 400, "ProcessingJob"),
+            step("Train", 310, 900, "TrainingJob"),
+            step("Evaluate", 905, 1200, "ProcessingJob"),
+            step("CheckMSE", 1201, 1202),
+            step("Register", 1203, 1205),
+        ],
+        "jobs": dict(
+            [
+                job("Preprocess", "ProcessingJob", 2, 120, 280),
+                job("Lint", "ProcessingJob", 306, 380, 395),
+                job("Train", "TrainingJob", 312, 400, 880),
+                job("Evaluate", "ProcessingJob", 906, 1000, 1190),
+            ]
+        ),
+    }
+
+
+@pytest.mark.parametrize(
+    "value", ["2026-10-15T12:00:05+00:00", "2026-10-15T14:00:05.000000+02:00", "2026-10-15T12:00:05Z"]
+)
+def test_execution_report_parses_iso_timestamps_without_fromisoformat(value):
+    from pipelines.execution_report import _timestamp
+
+    assert _timestamp(value) == datetime.datetime(2026, 10, 15, 12, 0, 5, tzinfo=datetime.timezone.utc).timestamp()
+
+
+def test_execution_report_from_saved_responses():
+    from pipelines.execution_report import build_report, format_report
+
+    report = build_report(json.loads(json.dumps(saved_execution_responses())))
+
+    steps = {step["name"]: step for step in report["steps"]}
+    assert [step["name"] for step in report["steps"]][:3] == ["Preprocess", "Lint", "Train"]
+    assert (steps["Train"]["queue_seconds"], steps["Train"]["startup_seconds"]) == (2, 88)
+    assert (steps["Train"]["run_seconds"], steps["Train"]["teardown_seconds"]) == (480, 20)
+    assert steps["Register"]["run_seconds"] == 2 and steps["Register"]["type"] is None
+    assert report["total_seconds"] == 1205
+    assert report["critical_path"] == ["Preprocess", "Train", "Evaluate", "CheckMSE", "Register"]
+    assert report["critical_path_seconds"] == {"queue": 5, "startup": 300, "run": 833, "teardown": 50}
+    assert "*Train" in format_report(report) and " Lint" in format_report(report)
+
+
+def test_sweep_variants_grid_and_random():
+    from pipelines._utils import sweep_variants
+
+    grid = sweep_variants({"strategy": "grid", "parameters": {"NumRound": [50, 100], "Eta": [0.1, 0.2]}})
+    assert grid == [
+        {"Eta": "0.1", "NumRound": "50"},
+        {"Eta": "0.1", "NumRound": "100"},
+        {"Eta": "0.2", "NumRound": "50"},
+        {"Eta": "0.2", "NumRound": "100"},
+    ]
+
+    spec = {
+        "strategy": "random",
+        "executions": 20,
+        "seed": 3,
+        "parameters": {"MaxDepth": {"min": 3, "max": 8}, "Eta": {"min": 0.05, "max": 0.3}, "NumRound": [50]},
+    }
+    variants = sweep_variants(spec)
+    assert variants == sweep_variants(spec) and len(variants) == 20
+    assert all(3 <= int(v["MaxDepth"]) <= 8 and 0.05 <= float(v["Eta"]) <= 0.3 for v in variants)
+    assert {v["NumRound"] for v in variants} == {"50"}
+
+
+class SweepSageMaker(object):
+    """A SageMaker client whose executions take ``polls`` describe calls to finish."""
+
+    def __init__(self, polls=2, quota=None, fail=()):
+        self.polls, self.quota, self.fail = polls, quota, fail
+        self.executions, self.max_running = {}, 0
+
+    def running(self):
+        return sum(1 for remaining, _ in self.executions.values() if remaining > 0)
+
+    def start_pipeline_execution(self, PipelineName, PipelineParameters):
+        from botocore.exceptions import ClientError
+
+        if self.quota is not None and self.running() >= self.quota:
+            raise ClientError({"Error": {"Code": "ResourceLimitExceeded"}}, "StartPipelineExecution")
+        arn = f"arn:exec/{len(self.executions)}"
+        self.executions[arn] = [self.polls, {p["Name"]: p["Value"] for p in PipelineParameters}]
+        self.max_running = max(self.max_running, self.running())
+        return {"PipelineExecutionArn": arn}
+
+    def describe_pipeline_execution(self, PipelineExecutionArn):
+        execution = self.executions[PipelineExecutionArn]
+        execution[0] -= 1
+        if execution[0] > 0:
+            return {"PipelineExecutionStatus": "Executing"}
+        return {"PipelineExecutionStatus": "Failed" if PipelineExecutionArn in self.fail else "Succeeded"}
+
+
+def test_sweep_caps_concurrency_backs_off_on_quota_and_ranks_results():
+    from pipelines._utils import format_sweep_results, run_sweep
+
+    client = SweepSageMaker(polls=2, quota=2, fail=("arn:exec/1",))
+    variants = [{"MaxDepth": str(depth)} for depth in range(3, 8)]
+    lines = []
+
+    results = run_sweep(
+        client,
+        "abalone",
+        variants,
+        max_concurrent=3,
+        collect=lambda arn: 1.0 / int(client.executions[arn][1]["MaxDepth"]),
+        sleep=lambda seconds: None,
+        printer=lines.append,
+    )
+
+    assert client.max_running == 2
+    assert any("running at most 2" in line for line in lines)
+    assert [r["parameters"] for r in results] == variants
+    assert [r["status"] for r in results] == ["Succeeded", "Failed", "Succeeded", "Succeeded", "Succeeded"]
+    table = format_sweep_results(results).splitlines()
+    assert table[0].split()[:4] == ["rank", "mse", "status", "MaxDepth"]
+    assert [row.split()[3] for row in table[1:]] == ["7", "6", "5", "3", "4"]
+    assert table[-1].startswith("-")
+
+
+@pytest.mark.parametrize("output_format", ["csv", "recordio-protobuf"])
+def test_local_runner_runs_the_abalone_pipeline_without_aws(tmp_path, monkeypatch, output_format):
+    pytest.importorskip("xgboost")
+    from pipelines.local_runner import run_locally
+    from test_preprocess import make_abalone_frame, write_abalone_csv
+
+    monkeypatch.delenv("AWS_ACCESS_KEY_ID", raising=False)
+    monkeypatch.delenv("AWS_SECRET_ACCESS_KEY", raising=False)
+    input_data = write_abalone_csv(tmp_path / "abalone.csv", make_abalone_frame(2000))
+
+    execution = run_locally(
+        "pipelines.abalone.pipeline",
+        repr({"region": "us-east-1", "output_format": output_format}),
+        {"InputDataUrl": input_data, "NumRound": 10},
+        str(tmp_path / "work"),
+        printer=lambda line: None,
+    )
+
+    statuses = {name: result["status"] for name, result in execution.results.items()}
+    registered = execution.results["CheckMSEAbaloneEvaluation"]["outcome"]
+    assert statuses == {
+        "PreprocessAbaloneData": "Succeeded",
+        "TrainAbaloneModel": "Succeeded",
+        "EvaluateAbaloneModel": "Succeeded",
+        "CheckMSEAbaloneEvaluation": "Succeeded",
+        "RegisterAbaloneModel-RegisterModel": "Skipped" if registered else "NotRun",
+    }
+    with open(tmp_path / "work" / "EvaluateAbaloneModel" / "processing" / "evaluation" / "evaluation.json") as f:
+        mse = json.load(f)["regression_metrics"]["mse"]["value"]
+    assert execution.results["CheckMSEAbaloneEvaluation"]["outcome"] == (mse <= 6.0)
+
+
+def test_local_condition_picks_a_branch(tmp_path):
+    from pipelines.local_runner import LocalExecution
+
+    definition = {
+        "Parameters": [{"Name": "Threshold", "Type": "Float", "DefaultValue": 6.0}],
+        "Steps": [
+            {
+                "Name": "Check",
+                "Type": "Condition",
+                "Arguments": {
+                    "Conditions": [
+                        {
+                            "Type": "Not",
+                            "Expression": {
+                                "Type": "GreaterThan",
+                                "LeftValue": 5.0,
+                                "RightValue": {"Get": "Parameters.Threshold"},
+                            },
+                        }
+                    ],
+                    "IfSteps": [{"Name": "Register", "Type": "RegisterModel", "Arguments": {}}],
+                    "ElseSteps": [
+                        {
+                            "Name": "Fail",
+                            "Type": "Fail",
+                            "Arguments": {
+                                "ErrorMessage": {"Std:Join": {"On": " ", "Values": ["MSE above", 5.0]}}
+                            },
+                        }
+                    ],
+                },
+            }
+        ],
+    }
+
+    def run(parameters):
+        return LocalExecution(definition, str(tmp_path), str(tmp_path), parameters, lambda line: None).run()
+
+    def statuses(parameters):
+        return {name: result["status"] for name, result in run(parameters).items()}
+
+    assert statuses(None) == {"Check": "Succeeded", "Register": "Skipped", "Fail": "NotRun"}
+    assert statuses({"Threshold": 4.0}) == {"Check": "Succeeded", "Register": "NotRun", "Fail": "Failed"}
+    assert run({"Threshold": 4.0})["Fail"]["failure_reason"] == "MSE above 5.0"
@@ -0,0 +1,698 @@
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from sklearn.compose import ColumnTransformer
+from sklearn.impute import SimpleImputer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+from pipelines.abalone import evaluate, preprocess
+
+
+def make_abalone_frame(n_rows, seed=0, missing_rate=0.0):
+    """Builds a synthetic abalone-like frame with 3-decimal measurements."""
+    rng = np.random.RandomState(seed)
+    df = pd.DataFrame({"sex": rng.choice(["M", "F", "I"], size=n_rows)})
+    for column in preprocess.numeric_features:
+        df[column] = np.round(rng.gamma(2.0, 0.2, size=n_rows), 3)
+    df["rings"] = rng.randint(1, 30, size=n_rows).astype(np.float64)
+    if missing_rate:
+        for column in preprocess.numeric_features[:3]:
+            df.loc[rng.random_sample(n_rows) < missing_rate, column] = np.nan
+    return df
+
+
+def write_abalone_csv(path, df):
+    df.to_csv(path, header=False, index=False)
+    return str(path)
+
+
+def sklearn_transform(df):
+    preprocess_ = ColumnTransformer(
+        transformers=[
+            (
+                "num",
+                Pipeline([("imputer", SimpleImputer(strategy="median")), ("scaler", StandardScaler())]),
+                preprocess.numeric_features,
+            ),
+            (
+                "cat",
+                Pipeline(
+                    [
+                        ("imputer", SimpleImputer(strategy="constant", fill_value="missing")),
+                        ("onehot", OneHotEncoder(handle_unknown="ignore")),
+                    ]
+                ),
+                preprocess.categorical_features,
+            ),
+        ]
+    )
+    X = preprocess_.fit_transform(df.drop(columns="rings"))
+    return np.concatenate((df[["rings"]].to_numpy(), X), axis=1)
+
+
+@pytest.fixture
+def base_dir(tmp_path):
+    for name in preprocess.split_names:
+        (tmp_path / name).mkdir()
+    return tmp_path
+
+
+def test_single_chunk_statistics_match_sklearn():
+    df = make_abalone_frame(2001)
+    expected = sklearn_transform(df)
+
+    params = preprocess.FeatureStatistics.from_frame(df).finalize()
+
+    np.testing.assert_array_equal(preprocess.transform_chunk(df, params), expected)
+
+
+def test_chunked_statistics_match_sklearn_with_missing_values():
+    df = make_abalone_frame(5000, missing_rate=0.05)
+    expected = sklearn_transform(df)
+
+    stats = preprocess.FeatureStatistics()
+    for start in range(0, len(df), 777):
+        stats.update(df.iloc[start:start + 777])
+    params = stats.finalize()
+
+    np.testing.assert_array_equal(params[0], df[preprocess.numeric_features].median().to_numpy())
+    np.testing.assert_allclose(preprocess.transform_chunk(df, params), expected, rtol=1e-12, atol=1e-12)
+
+
+def test_value_counts_stay_bounded_for_continuous_features():
+    rng = np.random.RandomState(0)
+    df = make_abalone_frame(60000)
+    for column in preprocess.numeric_features:
+        df[column] = rng.gamma(2.0, 0.2, size=len(df))
+
+    stats = preprocess.FeatureStatistics()
+    for start in range(0, len(df), 7000):
+        stats.update(df.iloc[start:start + 7000])
+
+    assert all(len(counts) <= preprocess.max_value_counts for counts in stats.value_counts)
+    assert all(sum(counts.values()) == len(df) for counts in stats.value_counts)
+    medians = stats.medians()
+    for i, column in enumerate(preprocess.numeric_features):
+        rank = (df[column] < medians[i]).sum()
+        assert abs(rank - len(df) / 2) <= 2 * len(df) / preprocess.max_value_counts
+
+
+def test_streaming_writes_every_row_once(base_dir):
+    df = make_abalone_frame(3000)
+    fn = write_abalone_csv(base_dir / "input.csv", df)
+
+    rows = preprocess.preprocess_streaming(fn, str(base_dir), chunk_size=500, seed=7)
+
+    splits = [
+        pd.read_csv(base_dir / name / f"{name}.csv", header=None).to_numpy()
+        for name in preprocess.split_names
+    ]
+    assert sum(rows.values()) == len(df)
+    assert [len(split) for split in splits] == [rows[name] for name in preprocess.split_names]
+    assert 0.6 < rows["train"] / len(df) < 0.8
+    written = np.concatenate(splits)
+    expected = sklearn_transform(df)
+    np.testing.assert_allclose(
+        written[np.lexsort(written.T)], expected[np.lexsort(expected.T)], rtol=1e-9, atol=1e-12
+    )
+    features = pd.read_csv(base_dir / "features" / "features.csv")
+    assert len(features) == len(df)
+
+
+@pytest.fixture
+def s3_bucket(monkeypatch):
+    moto = pytest.importorskip("moto")
+    import boto3
+
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with moto.mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket="abalone")
+        yield client
+
+
+def test_s3_range_reader_streams_whole_object(s3_bucket):
+    body = b"".join(b"line %d\n" % i for i in range(5000))
+    s3_bucket.put_object(Bucket="abalone", Key="data/input.csv", Body=body)
+
+    reader = preprocess.S3RangeReader(s3_bucket, "abalone", "data/input.csv", range_size=1000, prefetch=3)
+    with reader:
+        assert reader.read() == body
+
+
+def test_in_memory_preprocess_reads_from_s3(s3_bucket, base_dir):
+    df = make_abalone_frame(500)
+    s3_bucket.put_object(Bucket="abalone", Key="data/input.csv", Body=df.to_csv(header=False, index=False))
+
+    original_df = preprocess.preprocess_in_memory(
+        "s3://abalone/data/input.csv", str(base_dir), reader_options=dict(range_size=4096, prefetch=2)
+    )
+
+    pd.testing.assert_frame_equal(original_df[df.columns], df)
+
+
+def test_streaming_reads_every_part_under_a_prefix(s3_bucket, base_dir):
+    df = make_abalone_frame(1200)
+    for i, start in enumerate(range(0, len(df), 250)):
+        part = df.iloc[start:start + 250].to_csv(header=False, index=False)
+        s3_bucket.put_object(Bucket="abalone", Key=f"parts/part-{i:05d}.csv", Body=part)
+    s3_bucket.put_object(Bucket="abalone", Key="parts/_SUCCESS", Body=b"")
+
+    parts = preprocess.list_input_parts("s3://abalone/parts")
+    rows = preprocess.preprocess_streaming(
+        "s3://abalone/parts/", str(base_dir), chunk_size=100, seed=1, max_workers=3
+    )
+
+    assert [p.uri for p in parts] == [f"s3://abalone/parts/part-{i:05d}.csv" for i in range(5)]
+    assert sum(rows.values()) == len(df)
+    features = pd.read_csv(base_dir / "features" / "features.csv")
+    pd.testing.assert_frame_equal(features[df.columns], df)
+
+
+def test_download_threads_share_one_s3_client(s3_bucket, monkeypatch):
+    df = make_abalone_frame(400)
+    for i in range(4):
+        part = df.iloc[i * 100:(i + 1) * 100].to_csv(header=False, index=False)
+        s3_bucket.put_object(Bucket="abalone", Key=f"parts/part-{i:05d}.csv", Body=part)
+    parts = [preprocess.InputPart(p.uri, None, 0, None) for p in preprocess.list_input_parts("s3://abalone/parts")]
+    created = []
+    client = preprocess.boto3.client
+
+    def counting_client(*args, **kwargs):
+        created.append(args)
+        return client(*args, **kwargs)
+
+    monkeypatch.setattr(preprocess.boto3, "client", counting_client)
+
+    frames = list(preprocess.iter_input_frames(parts, chunk_size=30, max_workers=3))
+
+    assert sum(len(frame) for frame in frames) == len(df)
+    assert created == [("s3",)]
+
+
+def test_manifest_lists_parts_relative_to_its_prefix(tmp_path):
+    df = make_abalone_frame(90)
+    for i in range(3):
+        write_abalone_csv(tmp_path / f"part-{i}.csv", df.iloc[i * 30:(i + 1) * 30])
+    manifest = tmp_path / "input.manifest"
+    manifest.write_text('[{"prefix": "%s/"}, "part-0.csv", "part-2.csv"]' % tmp_path)
+
+    parts = preprocess.list_input_parts(str(manifest))
+    frames = list(preprocess.iter_input_frames(parts, chunk_size=20, max_workers=2))
+
+    assert [p.uri for p in parts] == [f"{tmp_path}/part-0.csv", f"{tmp_path}/part-2.csv"]
+    combined = pd.concat(frames)
+    assert list(combined.index) == list(range(60))
+    np.testing.assert_array_equal(combined["length"], pd.concat([df.iloc[:30], df.iloc[60:]])["length"])
+
+
+@pytest.mark.parametrize("n_features", [1, 10, 20])
+def test_recordio_protobuf_matches_the_sagemaker_sdk(tmp_path, n_features):
+    import io
+
+    common = pytest.importorskip("sagemaker.amazon.common")
+    rows = np.random.RandomState(n_features).normal(size=(50, n_features + 1))
+    expected = io.BytesIO()
+    common.write_numpy_to_dense_tensor(expected, rows[:, 1:], rows[:, 0])
+
+    encoded = preprocess.encode_recordio_protobuf(rows)
+
+    assert encoded == expected.getvalue()
+    (tmp_path / "test.pbr").write_bytes(encoded)
+    y, X = evaluate.read_split_file(tmp_path / "test.pbr")
+    np.testing.assert_array_equal(y, rows[:, 0])
+    np.testing.assert_array_equal(X, rows[:, 1:])
+
+
+@pytest.mark.parametrize("output_format", preprocess.output_formats)
+def test_evaluate_reads_every_output_format(base_dir, output_format):
+    if output_format in ("parquet", "arrow"):
+        pytest.importorskip("pyarrow")
+    df = make_abalone_frame(400)
+    fn = write_abalone_csv(base_dir / "input.csv", df)
+
+    preprocess.preprocess_streaming(fn, str(base_dir), chunk_size=150, seed=3, output_format=output_format)
+    y_test, X_test = evaluate.read_test_data(base_dir / "test")
+    X_test = X_test.toarray() if hasattr(X_test, "toarray") else X_test
+
+    csv_dir = base_dir / "csv"
+    for name in preprocess.split_names:
+        (csv_dir / name).mkdir(parents=True)
+    preprocess.preprocess_streaming(fn, str(csv_dir), chunk_size=150, seed=3)
+    expected = pd.read_csv(csv_dir / "test" / "test.csv", header=None).to_numpy()
+    np.testing.assert_allclose(y_test, expected[:, 0])
+    np.testing.assert_allclose(X_test, expected[:, 1:], rtol=1e-12)
+    assert X_test.shape[1] == len(preprocess.numeric_features) + 3
+
+
+def test_line_aligned_ranges_cover_every_line_once(tmp_path):
+    path = tmp_path / "lines.csv"
+    lines = [b"%d,%s" % (i, b"x" * (i % 13)) for i in range(500)]
+    path.write_bytes(b"\n".join(lines) + b"\n")
+    size = path.stat().st_size
+
+    for n in (1, 2, 3, 7, 64):
+        pieces = []
+        for i in range(n):
+            with preprocess.open_input(str(path), start=size * i // n, end=size * (i + 1) // n) as f:
+                pieces.append(f.read())
+        assert b"".join(pieces) == path.read_bytes()
+
+
+def test_sharded_hosts_merge_statistics_and_write_part_files(s3_bucket, base_dir):
+    from concurrent.futures import ThreadPoolExecutor
+
+    df = make_abalone_frame(2000, missing_rate=0.02)
+    s3_bucket.put_object(Bucket="abalone", Key="data/input.csv", Body=df.to_csv(header=False, index=False))
+
+    def run_host(index):
+        shard = preprocess.Shard(index, 3, "job-1")
+        return preprocess.preprocess_streaming(
+            "s3://abalone/data/input.csv",
+            str(base_dir),
+            chunk_size=300,
+            seed=5,
+            shard=shard,
+            exchange_uri="s3://abalone/exchange",
+        )
+
+    with ThreadPoolExecutor(3) as executor:
+        rows = list(executor.map(run_host, range(3)))
+
+    assert sum(sum(r.values()) for r in rows) == len(df)
+    train = sorted(p.name for p in (base_dir / "train").iterdir())
+    assert train == [f"train-part-{i:05d}.csv" for i in range(3)]
+    written = np.concatenate(
+        [pd.read_csv(p, header=None).to_numpy() for name in preprocess.split_names
+         for p in (base_dir / name).iterdir()]
+    )
+    expected = sklearn_transform(df)
+    np.testing.assert_allclose(
+        written[np.lexsort(written.T)], expected[np.lexsort(expected.T)], rtol=1e-9, atol=1e-12
+    )
+    y_test, X_test = evaluate.read_test_data(base_dir / "test")
+    assert len(y_test) == sum(r["test"] for r in rows)
+
+
+def test_merged_statistics_equal_statistics_of_the_union():
+    df = make_abalone_frame(3000, missing_rate=0.03)
+    a = preprocess.FeatureStatistics.from_frame(df.iloc[:1234])
+    b = preprocess.FeatureStatistics.from_frame(df.iloc[1234:])
+    whole = preprocess.FeatureStatistics.from_frame(df)
+
+    merged = preprocess.merge_statistics(a, b)
+
+    assert a.n_rows == 1234 and merged.n_rows == len(df)
+    assert merged.value_counts == whole.value_counts
+    assert merged.categories == whole.categories
+    np.testing.assert_array_equal(merged.count, whole.count)
+    medians, means, scales, categories = merged.finalize()
+    expected = whole.finalize()
+    np.testing.assert_array_equal(medians, expected[0])
+    np.testing.assert_allclose(means, expected[1], rtol=1e-12)
+    np.testing.assert_allclose(scales, expected[2], rtol=1e-12)
+    np.testing.assert_array_equal(categories, expected[3])
+
+
+def test_transformer_artifact_round_trips_for_inference(base_dir):
+    df = make_abalone_frame(800, missing_rate=0.05)
+    fn = write_abalone_csv(base_dir / "input.csv", df)
+    preprocess.preprocess_in_memory(fn, str(base_dir))
+
+    stats, params = preprocess.load_transformer(str(base_dir / "transformer" / "transformer.json"))
+
+    expected = sklearn_transform(df)
+    np.testing.assert_array_equal(preprocess.transform_features(df.drop(columns="rings"), params), expected[:, 1:])
+    assert stats.n_rows == len(df)
+    unseen = df.head(3).assign(sex="X").drop(columns="rings")
+    assert not preprocess.transform_features(unseen, params)[:, -3:].any()
+
+
+def test_fused_kernel_is_bit_compatible_with_sklearn():
+    df = make_abalone_frame(4000, missing_rate=0.05)
+    df.loc[df.index[::97], "sex"] = np.nan
+    expected = sklearn_transform(df)
+
+    _, params = preprocess.fit_in_memory(df)
+    out = np.full(expected.shape, -1.0)
+    result = preprocess.transform_into(df, params, out=out)
+
+    assert result is out
+    np.testing.assert_array_equal(out, expected)
+    np.testing.assert_array_equal(
+        preprocess.transform_into(df, params, dtype=np.float32), expected.astype(np.float32)
+    )
+
+
+def test_in_memory_medians_stay_exact_beyond_max_value_counts():
+    df = make_abalone_frame(3 * preprocess.max_value_counts, missing_rate=0.05)
+    rng = np.random.RandomState(1)
+    for column in preprocess.numeric_features:
+        df[column] += rng.uniform(0, 1e-3, size=len(df))
+    assert df["length"].nunique() > preprocess.max_value_counts
+    expected = sklearn_transform(df)
+
+    _, params = preprocess.fit_in_memory(df)
+
+    np.testing.assert_array_equal(preprocess.transform_into(df, params), expected)
+
+
+def test_in_memory_split_is_seeded_and_covers_every_row(base_dir):
+    df = make_abalone_frame(2000)
+    fn = write_abalone_csv(base_dir / "input.csv", df)
+
+    written = []
+    for _ in range(2):
+        preprocess.preprocess_in_memory(fn, str(base_dir), seed=42, batch_size=256)
+        written.append(
+            [pd.read_csv(base_dir / name / f"{name}.csv", header=None).to_numpy() for name in preprocess.split_names]
+        )
+
+    assert [len(split) for split in written[0]] == [1400, 300, 300]
+    for first, second in zip(*written):
+        np.testing.assert_array_equal(first, second)
+    union = np.concatenate(written[0])
+    expected = sklearn_transform(df)
+    np.testing.assert_allclose(union[np.lexsort(union.T)], expected[np.lexsort(expected.T)], rtol=1e-12)
+
+
+@pytest.mark.parametrize("mode", ["in-memory", "streaming"])
+def test_stratified_split_keeps_label_proportions(base_dir, mode):
+    df = make_abalone_frame(6000)
+    fn = write_abalone_csv(base_dir / "input.csv", df)
+
+    if mode == "streaming":
+        preprocess.preprocess_streaming(fn, str(base_dir), chunk_size=700, seed=3, stratify_bins=5)
+    else:
+        preprocess.preprocess_in_memory(fn, str(base_dir), seed=3, stratify_bins=5)
+
+    stats = preprocess.FeatureStatistics.from_frame(df)
+    edges = preprocess.stratum_edges(stats.label_counts, 5)
+    expected = np.bincount(np.searchsorted(edges, df["rings"], side="right"), minlength=len(edges) + 1) / len(df)
+    for name in preprocess.split_names:
+        labels = pd.read_csv(base_dir / name / f"{name}.csv", header=None)[0].to_numpy()
+        observed = np.bincount(np.searchsorted(edges, labels, side="right"), minlength=len(edges) + 1)
+        np.testing.assert_allclose(observed / len(labels), expected, atol=0.01, err_msg=name)
+
+
+def test_thread_and_process_writers_produce_identical_outputs(tmp_path):
+    df = make_abalone_frame(1500)
+    fn = write_abalone_csv(tmp_path / "input.csv", df)
+
+    outputs = {}
+    for executor in preprocess.write_executors:
+        base_dir = tmp_path / executor
+        for name in preprocess.split_names:
+            (base_dir / name).mkdir(parents=True)
+        preprocess.preprocess_in_memory(fn, str(base_dir), seed=1, batch_size=200, write_executor=executor)
+        outputs[executor] = [
+            (base_dir / folder / f"{folder}.csv").read_bytes()
+            for folder in preprocess.split_names + ("features",)
+        ]
+    assert outputs["process"] == outputs["thread"]
+
+
+def test_process_writers_receive_row_positions_not_frames(tmp_path, monkeypatch):
+    df = make_abalone_frame(600)
+    _, params = preprocess.fit_in_memory(df)
+    indices = preprocess.split_indices(np.zeros(len(df), dtype=np.int64), seed=0)
+    for name in preprocess.split_names:
+        (tmp_path / name).mkdir()
+    submitted = []
+
+    class RecordingPool(preprocess.ProcessPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            submitted.extend(args)
+            return super().submit(fn, *args, **kwargs)
+
+    monkeypatch.setattr(preprocess, "ProcessPoolExecutor", RecordingPool)
+
+    results = preprocess.write_outputs(str(tmp_path), "csv", None, df, params, indices, executor="process")
+
+    assert sum(results[name][0] for name in preprocess.split_names) == len(df)
+    assert results["features"][0] == len(df)
+    assert not any(isinstance(arg, pd.DataFrame) for arg in submitted)
+    assert preprocess._shared_frame is None
+
+
+class FakeFeatureStoreRuntime(object):
+    """In-memory featurestore-runtime that throttles above a concurrency limit."""
+
+    def __init__(self, max_concurrency=3, invalid_ids=()):
+        from botocore.exceptions import ClientError
+
+        self.error = ClientError
+        self.max_concurrency = max_concurrency
+        self.invalid_ids = set(invalid_ids)
+        self.records = {}
+        self.target_stores = []
+        self.in_flight = 0
+        self.throttled = 0
+        self.lock = threading.Lock()
+
+    def put_record(self, FeatureGroupName, Record, TargetStores=None):
+        record = {feature["FeatureName"]: feature["ValueAsString"] for feature in Record}
+        with self.lock:
+            self.in_flight += 1
+            throttle = self.in_flight > self.max_concurrency
+            self.throttled += int(throttle)
+        try:
+            if throttle:
+                raise self.error({"Error": {"Code": "ThrottlingException"}}, "PutRecord")
+            if record["record_id"] in self.invalid_ids:
+                raise self.error({"Error": {"Code": "ValidationError"}}, "PutRecord")
+            time.sleep(0.001)
+            with self.lock:
+                self.records[record["record_id"]] = record
+                self.target_stores.append(TargetStores)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+def no_sleep(seconds):
+    pass
+
+
+def feature_store_frame(n_rows):
+    df = make_abalone_frame(n_rows, missing_rate=0.05)
+    df["event_time"] = "1700000000"
+    df["record_id"] = df.index.astype(str)
+    return df
+
+
+def test_ingester_backs_off_on_throttling_and_reports_failures():
+    df = feature_store_frame(600)
+    client = FakeFeatureStoreRuntime(max_concurrency=3, invalid_ids={"5", "17"})
+    ingester = preprocess.FeatureStoreIngester(
+        client, "abalone", max_workers=12, max_attempts=20, sleep=no_sleep
+    )
+
+    report = ingester.ingest([df.iloc[:200], df.iloc[200:]])
+
+    assert client.throttled > 0
+    assert report.throttled > 0 and report.min_concurrency <= 3
+    assert report.failed == 2 and sorted(report.failed_record_ids) == ["17", "5"]
+    assert report.errors["ValidationError"] == 2
+    assert report.ingested == len(df) - 2 == len(client.records)
+    present = df.index[df.notna().all(axis=1)][0]
+    record = client.records[str(present)]
+    assert record["sex"] == df.loc[present, "sex"] and float(record["length"]) == df.loc[present, "length"]
+    missing = df.index[df["length"].isna()][0]
+    assert "length" not in client.records[str(missing)]
+
+
+def test_a_burst_of_throttles_halves_concurrency_once():
+    concurrency = preprocess.AdaptiveConcurrency(8)
+    tickets = [concurrency.__enter__() for _ in range(8)]
+
+    limits = [concurrency.on_throttle(ticket) for ticket in tickets]
+
+    assert limits == [4] * 8
+    for _ in tickets:
+        concurrency.__exit__(None, None, None)
+    with concurrency as ticket:
+        assert concurrency.on_throttle(ticket) == 2
+
+
+def test_ingestion_report_merges_across_processes():
+    df = feature_store_frame(300)
+
+    report = preprocess.ingest_feature_frames(
+        [df], "abalone", FakeFeatureStoreRuntime, max_processes=2, batch_size=50,
+        max_workers=2, sleep=no_sleep,
+    )
+
+    assert report.ingested == len(df) and report.failed == 0
+    assert preprocess.IngestionReport.from_dict(report.to_dict()).to_dict() == report.to_dict()
+
+
+class FakeSageMaker(object):
+    def __init__(self, statuses):
+        self.statuses = list(statuses)
+
+    def describe_feature_group(self, FeatureGroupName):
+        status = self.statuses.pop(0) if len(self.statuses) > 1 else self.statuses[0]
+        return {"FeatureGroupName": FeatureGroupName, "FeatureGroupStatus": status, "FailureReason": "bad role"}
+
+
+def test_feature_group_waiter_backs_off_until_created():
+    delays = []
+    description = preprocess.wait_for_feature_group(
+        FakeSageMaker(["Creating"] * 4 + ["Created"]), "abalone", initial_delay=1, max_delay=5, sleep=delays.append
+    )
+    assert description["FeatureGroupStatus"] == "Created"
+    assert delays == [1, 2, 4, 5]
+
+
+def test_feature_group_waiter_times_out_and_reports_failures():
+    delays = []
+    with pytest.raises(TimeoutError):
+        preprocess.wait_for_feature_group(
+            FakeSageMaker(["Creating"]), "abalone", timeout=10, initial_delay=1, sleep=delays.append
+        )
+    assert sum(delays) <= 10
+    with pytest.raises(RuntimeError, match="bad role"):
+        preprocess.wait_for_feature_group(FakeSageMaker(["CreateFailed"]), "abalone", sleep=delays.append)
+
+
+def test_record_keys_are_stable_across_chunks_and_need_id_columns():
+    df = make_abalone_frame(500)
+    df["id"] = np.arange(len(df))
+    df = pd.concat([df, df.iloc[:20]], ignore_index=True)
+
+    keys, contents = preprocess.RecordKeys(["id"])(df)
+    chunked = preprocess.RecordKeys(["id"])
+    chunk_keys = np.concatenate([chunked(df.iloc[i:i + 97])[0] for i in range(0, len(df), 97)])
+
+    assert len(np.unique(keys)) == 500
+    np.testing.assert_array_equal(keys, chunk_keys)
+    np.testing.assert_array_equal(keys[:20], keys[500:])
+    np.testing.assert_array_equal(contents[:20], contents[500:])
+    with pytest.raises(ValueError, match="record id columns"):
+        preprocess.RecordKeys(None)
+
+
+def test_delta_index_selects_new_and_changed_records(tmp_path):
+    df = make_abalone_frame(300)
+    df["id"] = np.arange(len(df))
+    record_keys = preprocess.RecordKeys(["id"])
+    uri = str(tmp_path / "delta" / "index.npz")
+
+    index = preprocess.DeltaIndex.load(uri)
+    keys, contents = record_keys(df)
+    assert index.changed(keys, contents).all()
+    index.update(keys, contents).save(uri)
+
+    changed_df = pd.concat([df, make_abalone_frame(5, seed=1).assign(id=np.arange(300, 305))], ignore_index=True)
+    changed_df.loc[[3, 42], "length"] += 0.5
+    index = preprocess.DeltaIndex.load(uri)
+    keys, contents = record_keys(changed_df)
+    changed = index.changed(keys, contents)
+    assert np.flatnonzero(changed).tolist() == [3, 42, 300, 301, 302, 303, 304]
+    index = index.update(keys, contents)
+    assert len(index) == 305 and not index.changed(keys, contents).any()
+
+
+def test_delta_ingestion_skips_unchanged_records_on_rerun(tmp_path, monkeypatch):
+    from concurrent.futures import Future
+
+    client = FakeFeatureStoreRuntime(max_concurrency=100)
+    monkeypatch.setattr(preprocess, "featurestore_runtime_client", lambda region, max_workers: client)
+    ready = Future()
+    ready.set_result(True)
+    df = make_abalone_frame(200)
+    df["id"] = np.arange(len(df))
+
+    def ingest(frame):
+        return preprocess.write_to_feature_store(
+            frame, "abalone", "us-east-1", "role", feature_group_ready=ready,
+            delta_index_uri=str(tmp_path / "index.npz"), record_id_columns=["id"],
+        )
+
+    assert ingest(df).ingested == 200
+    ids = set(client.records)
+    assert ingest(df).ingested == 0
+    df.loc[7, "height"] += 1.0
+    assert ingest([df.iloc[:100], df.iloc[100:]]).ingested == 1
+    assert set(client.records) == ids and client.target_stores == [None] * 201
+    assert sorted(float(r["height"]) for r in client.records.values()) == sorted(df["height"])
+    with pytest.raises(ValueError, match="record_id_columns"):
+        preprocess.write_to_feature_store(
+            df, "abalone", "us-east-1", "role", feature_group_ready=ready, delta_index_uri=str(tmp_path / "index.npz")
+        )
+
+
+def test_delta_ingestion_from_the_command_line_puts_only_changed_rows(tmp_path, monkeypatch):
+    from concurrent.futures import Future
+
+    client = FakeFeatureStoreRuntime(max_concurrency=100)
+    ready = Future()
+    ready.set_result(True)
+    monkeypatch.setattr(preprocess, "featurestore_runtime_client", lambda region, max_workers: client)
+    monkeypatch.setattr(preprocess, "start_feature_group_setup", lambda *args: ready)
+    monkeypatch.setenv("SAGEMAKER_ROLE_ARN", "role")
+    monkeypatch.setenv("PROCESSING_BASE_DIR", str(tmp_path / "processing"))
+    for split in ("train", "validation", "test"):
+        (tmp_path / "processing" / split).mkdir(parents=True)
+    df = make_abalone_frame(200)
+
+    def run(record_id_columns=",".join(preprocess.feature_columns_names)):
+        before = len(client.target_stores)
+        preprocess.main([
+            "--input-data", write_abalone_csv(tmp_path / "abalone.csv", df),
+            "--feature-group-name", "abalone",
+            "--enable-feature-store", "true",
+            "--feature-store-ingestion", "delta",
+            "--delta-index-uri", str(tmp_path / "delta"),
+            "--record-id-columns", record_id_columns,
+        ])
+        return len(client.target_stores) - before
+
+    assert run() == 200
+    assert (tmp_path / "delta" / "abalone" / "index.npz").exists()
+    assert run() == 0
+    df.loc[7, "rings"] += 1
+    assert run() == 1
+    with pytest.raises(SystemExit):
+        run("id")
+
+
+def test_offline_snapshot_writes_partitioned_parquet_and_latest_rows_online(tmp_path, monkeypatch):
+    pq = pytest.importorskip("pyarrow.parquet")
+    from concurrent.futures import Future
+
+    client = FakeFeatureStoreRuntime(max_concurrency=100)
+    monkeypatch.setattr(preprocess, "featurestore_runtime_client", lambda region, max_workers: client)
+    resolved = tmp_path / "offline-store" / "data"
+    ready = Future()
+    ready.set_result({"OfflineStoreConfig": {"S3StorageConfig": {"ResolvedOutputS3Uri": str(resolved)}}})
+    df = make_abalone_frame(120, missing_rate=0.05)
+    df["id"] = np.arange(len(df)) % 40
+
+    report = preprocess.write_to_feature_store(
+        df, "abalone", "us-east-1", "role", feature_group_ready=ready,
+        record_id_columns=["id"], offline_snapshot=True,
+    )
+
+    files = list(resolved.glob("year=*/month=*/day=*/hour=*/*.parquet"))
+    assert len(files) == 1
+    table = pq.read_table(files[0])
+    assert table.schema.equals(preprocess.offline_store_schema())
+    assert table.num_rows == 120 and not any(table.column("is_deleted").to_pylist())
+    np.testing.assert_array_equal(table.column("rings").to_numpy(), df["rings"].astype(int))
+    assert report.ingested == 40 == len(client.records) == len(client.target_stores)
+    assert client.target_stores == [["OnlineStore"]] * 40
+    last = df.iloc[-40:]
+    assert sorted(float(r["whole_weight"]) for r in client.records.values()) == sorted(last["whole_weight"])
+    with pytest.raises(ValueError, match="record_id_columns"):
+        preprocess.write_to_feature_store(
+            df, "abalone", "us-east-1", "role", feature_group_ready=ready, offline_snapshot=True
+        )